@@ -1,5 +1,12 @@
+import json
+from decimal import Decimal
 from django.contrib import admin
-from .models import Product,Category,Order
+from django.contrib.auth import admin as auth_admin, forms as auth_forms
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+from .models import Product,Category,Order,User,GuestUser,ShippingAddress
+from .inventory import held_stock, set_stock_shards
 
 # personalized the admin dashboard
 
@@ -7,25 +14,185 @@ admin.site.site_header = "KLINSEPT DASHBOARD "
 admin.site.site_title = "Klinsept"
 admin.site.index_title = "Welcome to Your your Dashboard"
 
+# changelists below the threshold get an exact count, it is cheap there
+ESTIMATE_THRESHOLD = 10000
+PRICE_RANGES = [(0, 10), (10, 50), (50, 100), (100, 500), (500, None)]
+
+
+# the planner's row estimate for the queryset, None where there is no planner to ask
+def estimated_count(queryset):
+    if connection.vendor != 'postgresql':
+        return None
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+# COUNT(*) scans the whole table on postgres, big changelists page through the estimate instead.
+# only the unfiltered list, the planner's guess for a filter or search can be far off and those
+# lists are narrowed by an index anyway
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        if self.object_list.query.where:
+            return super().count
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate > ESTIMATE_THRESHOLD:
+            return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # skips the second, unfiltered count next to the filtered one
+    show_full_result_count = False
+    # autocomplete lookups page through the model too, keep them on the primary key
+    ordering = ('-pk',)
+
+
+# fixed buckets instead of one choice per distinct price
+class PriceRangeFilter(admin.SimpleListFilter):
+    title = 'price'
+    parameter_name = 'price_range'
+
+    def lookups(self, request, model_admin):
+        return [
+            (f"{low}-{high or ''}", f"{low} - {high}" if high else f"{low} +")
+            for low, high in PRICE_RANGES
+        ]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        low, _, high = self.value().partition('-')
+        try:
+            queryset = queryset.filter(price__gte=Decimal(low))
+            return queryset.filter(price__lt=Decimal(high)) if high else queryset
+        except ArithmeticError:
+            return queryset.none()
+
+
+class StockFilter(admin.SimpleListFilter):
+    title = 'stock'
+    parameter_name = 'in_stock'
+
+    def lookups(self, request, model_admin):
+        return [('yes', 'In stock'), ('no', 'Out of stock')]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'yes':
+            return queryset.filter(stock__gt=0)
+        if self.value() == 'no':
+            return queryset.filter(stock=0)
+        return queryset
+
 # Register your models here.
 
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name','description','price','category')  # Fields to display in the list view
-    search_fields = ['name']  # Add a search bar for product names
-    list_filter = ('name','price','category')  # Filter products by price in the admin panel
+class ProductAdmin(LargeTableAdmin):
+    list_display = ('name','description','price','stock','category')  # Fields to display in the list view
+    list_select_related = ('category',)
+    search_fields = ['name', 'sku__exact']  # Add a search bar for product names
+    list_filter = (PriceRangeFilter, StockFilter, 'category')  # categories are a short list, prices go in ranges
+    autocomplete_fields = ['category']
+    readonly_fields = ('shard_count',)  # changed with the shard_stock command, it moves the stock too
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        field = super().formfield_for_dbfield(db_field, request, **kwargs)
+        if db_field.name == 'stock':
+            field.help_text = "Units on hand, what carts and unpaid orders hold is taken off when saved"
+        return field
+
+    # the stock entered is the count on hand, Product.stock is what is left after the reservations.
+    # a sharded product's stock lives in its shards, a new value is spread over them
+    def save_model(self, request, obj, form, change):
+        stock_changed = change and 'stock' in form.changed_data
+        if stock_changed and not obj.shard_count:
+            # the admin saves in a transaction, the lock holds reservations off until it commits
+            list(Product.objects.select_for_update().filter(id=obj.id).values_list('id', flat=True))
+            obj.stock = max(0, obj.stock - held_stock([obj.id]).get(obj.id, 0))
+        super().save_model(request, obj, form, change)
+        if stock_changed and obj.shard_count:
+            set_stock_shards(obj.id, obj.shard_count, obj.stock)
 
 admin.site.register(Product, ProductAdmin)
 
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('name','description')
     search_fields = ['name']
-    list_filter = ['name']
 
 admin.site.register(Category,CategoryAdmin)
 
-class OrderAdmin(admin.ModelAdmin):
-    list_display = ('user','guest_user','shipping_address','total_price','status','shipping_cost','tax','tracking_id')
-    search_fields = ['tracking_id']
-    list_filter = ['status']
+class OrderAdmin(LargeTableAdmin):
+    list_display = ('user','guest_user','shipping_address','total_price','status','shipping_cost','tax','tracking_id','created_at')
+    list_select_related = ('user', 'guest_user', 'shipping_address')
+    search_fields = ['tracking_id__exact']  # exact match uses the unique index
+    list_filter = ['status', 'created_at']  # fixed choices, no distinct values query
+    autocomplete_fields = ['user', 'guest_user', 'shipping_address']
+    readonly_fields = Order.TOTAL_FIELDS  # follow the items, see reconcile_order_totals
+
+admin.site.register(Order,OrderAdmin)
+
+# the customer admins back the autocomplete widgets on orders
+
+# django's user forms, keyed on email since the model has no username
+class UserCreationForm(auth_forms.AdminUserCreationForm):
+    class Meta:
+        model = User
+        fields = ('email', 'first_name', 'last_name', 'phone_number')
+
+
+class UserChangeForm(auth_forms.UserChangeForm):
+    class Meta:
+        model = User
+        fields = '__all__'
+
+
+# django's UserAdmin for hashed passwords and the password change form
+class UserAdmin(LargeTableAdmin, auth_admin.UserAdmin):
+    form = UserChangeForm
+    add_form = UserCreationForm
+    list_display = ('email','first_name','last_name','phone_number','is_staff')
+    list_filter = ('is_staff', 'is_superuser', 'is_active')
+    search_fields = ['email', 'first_name', 'last_name']
+    fieldsets = (
+        (None, {'fields': ('email', 'password')}),
+        ('Personal info', {'fields': ('first_name', 'last_name', 'phone_number')}),
+        ('Permissions', {'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions')}),
+        ('Important dates', {'fields': ('last_login', 'date_joined')}),
+    )
+    add_fieldsets = (
+        (None, {
+            'classes': ('wide',),
+            'fields': ('email', 'first_name', 'last_name', 'phone_number', 'usable_password', 'password1', 'password2'),
+        }),
+    )
+    readonly_fields = ('last_login', 'date_joined')
+    # only superusers hand out staff access and permissions
+    privilege_fields = ('is_staff', 'is_superuser', 'groups', 'user_permissions')
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly = super().get_readonly_fields(request, obj)
+        if request.user.is_superuser:
+            return readonly
+        return tuple(readonly) + self.privilege_fields
+
+    # nor can anyone else change a superuser's email or password
+    def has_change_permission(self, request, obj=None):
+        if obj is not None and obj.is_superuser and not request.user.is_superuser:
+            return False
+        return super().has_change_permission(request, obj)
+
+admin.site.register(User, UserAdmin)
+
+class GuestUserAdmin(LargeTableAdmin):
+    list_display = ('email','first_name','last_name','phone_number')
+    search_fields = ['email', 'first_name', 'last_name']
+
+admin.site.register(GuestUser, GuestUserAdmin)
+
+class ShippingAddressAdmin(LargeTableAdmin):
+    list_display = ('street_address','city','country','user','guest_user')
+    list_select_related = ('user', 'guest_user')
+    search_fields = ['street_address', 'city', 'zip_code']
+    autocomplete_fields = ['user', 'guest_user']
 
-admin.site.register(Order,OrderAdmin)
\ No newline at end of file
+admin.site.register(ShippingAddress, ShippingAddressAdmin)
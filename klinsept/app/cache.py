@@ -0,0 +1,126 @@
+# response cache for the catalog endpoints
+# keys carry a catalog version that signals.py bumps whenever a product or category changes,
+# so stale entries are never read again and simply expire.
+# stock moves don't bump it, every cart would empty the cache. a hit reads the live stock of the
+# products it shows instead (inventory.refresh_stock), only which products an in_stock listing
+# holds and its facet counts can lag behind the stock for up to CATALOG_CACHE_TIMEOUT
+# the key is built from the query parameters the catalog views read, a request carrying anything
+# else (or an overlong value) skips the cache, so arbitrary query strings can't each add an entry
+import hashlib
+import time
+from functools import wraps
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_HITS_KEY = 'catalog:hits'
+CATALOG_MISSES_KEY = 'catalog:misses'
+CATALOG_QUERY_PARAMS = frozenset({
+    'page', 'page_size', 'pagination', 'cursor', 'ordering', 'count',
+    'category', 'min_price', 'max_price', 'in_stock', 'facets', 'limit', 'q',
+})
+CATALOG_MAX_PARAM_LENGTH = 100
+
+
+def _incr(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # key is missing or was evicted, start it again
+        cache.set(key, 1, None)
+        return 1
+
+
+def get_catalog_version():
+    # seeded from the clock so an evicted version never falls back to one already used
+    return cache.get_or_set(CATALOG_VERSION_KEY, lambda: int(time.time() * 1000), None)
+
+
+def bump_catalog_version():
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(CATALOG_VERSION_KEY, version, None)
+        return version
+
+
+# None when the request should not be cached
+def catalog_cache_key(request):
+    params = request.query_params
+    if not set(params) <= CATALOG_QUERY_PARAMS:
+        return None
+    query = []
+    for name in sorted(params):
+        values = params.getlist(name)
+        if len(values) > 1 or len(values[0]) > CATALOG_MAX_PARAM_LENGTH:
+            return None
+        query.append((name, values[0]))
+    # the host stays in the key, pagination links in the cached data are absolute
+    url = f"{request.get_host()}{request.path}?{urlencode(query)}"
+    digest = hashlib.md5(url.encode()).hexdigest()
+    return f"catalog:{get_catalog_version()}:{digest}"
+
+
+def catalog_cache_stats():
+    hits = cache.get(CATALOG_HITS_KEY, 0)
+    misses = cache.get(CATALOG_MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else 0.0,
+    }
+
+
+def reset_catalog_cache_stats():
+    cache.delete_many([CATALOG_HITS_KEY, CATALOG_MISSES_KEY])
+
+
+# the serialized products of a cached response and whether it is a detail page
+def _cached_products(data):
+    if isinstance(data, list):
+        return data, False
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        return data['results'], False
+    if isinstance(data, dict) and 'id' in data and 'stock' in data:
+        return [data], True
+    return [], False
+
+
+# goes below @api_view so it sees the drf request, only successful responses are stored.
+# a stored etag means the view sets conditional GET validators, a hit recomputes them from
+# the live stock so it can still answer 304
+def cache_catalog_response(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        from app.conditional import not_modified_response, set_validators, product_validators
+        from app.inventory import refresh_stock
+
+        key = catalog_cache_key(request)
+        if key is None:
+            return view(request, *args, **kwargs)
+        cached = cache.get(key)
+        if cached is not None:
+            _incr(CATALOG_HITS_KEY)
+            rows, detail = _cached_products(cached['data'])
+            products = refresh_stock(rows, detail) if rows else []
+            if cached['etag']:
+                etag, last_modified = product_validators(products, listing=not detail)
+                not_modified = not_modified_response(request, etag, last_modified)
+                if not_modified is not None:
+                    return not_modified
+                return set_validators(Response(cached['data']), etag, last_modified)
+            return Response(cached['data'])
+
+        _incr(CATALOG_MISSES_KEY)
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, {
+                'data': response.data,
+                'etag': response.get('ETag'),
+            }, settings.CATALOG_CACHE_TIMEOUT)
+        return response
+    return wrapper
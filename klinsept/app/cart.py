@@ -0,0 +1,182 @@
+# per client carts kept in the cache, not in OrderItem
+# a cart belongs to the logged in user (jwt cookie) or to an anonymous cart id sent back as the
+# cart_id cookie / X-Cart-Id header. lines are {product_id: {'quantity', 'price', 'reservations'}}
+# and only become OrderItem rows in create_order, so every cart call costs O(lines in the cart).
+# a cart is one cache value, so every read-modify-write of it runs under the cart's lock
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+import jwt
+from decouple import config
+from django.conf import settings
+from django.core.cache import cache
+
+CART_COOKIE = 'cart_id'
+CART_HEADER = 'X-Cart-Id'
+CART_OPERATIONS = ('add', 'update', 'remove')
+CART_BATCH_LIMIT = 100
+CART_LOCK_SECONDS = 30  # a crashed holder lets go after this
+CART_LOCK_WAIT = 5  # how long a second request waits for the cart before giving up
+CART_LOCK_POLL = 0.05
+
+
+class CartBusy(Exception):
+    pass
+
+
+class CartStore:
+    def __init__(self, key, cart_id=None):
+        self.key = key
+        self.cart_id = cart_id
+        self._lock_depth = 0
+
+    @classmethod
+    def for_user(cls, user_id):
+        return cls(f"cart:user:{user_id}")
+
+    @classmethod
+    def for_request(cls, request):
+        token = request.COOKIES.get('jwt')
+        if token:
+            try:
+                payload = jwt.decode(token, config('SECRET'), algorithms=['HS256'])
+                return cls.for_user(payload['id'])
+            except jwt.InvalidTokenError:
+                pass
+
+        cart_id = request.COOKIES.get(CART_COOKIE) or request.headers.get(CART_HEADER)
+        try:
+            cart_id = uuid.UUID(cart_id).hex
+        except (TypeError, ValueError):
+            cart_id = uuid.uuid4().hex
+        return cls(f"cart:anon:{cart_id}", cart_id)
+
+    # cache.add only sets a missing key, so one request at a time holds the cart. reentrant, views
+    # hold it around their whole read / reserve / write sequence and the methods below take it again
+    @contextmanager
+    def lock(self):
+        if self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+
+        lock_key = f"{self.key}:lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + CART_LOCK_WAIT
+        while not cache.add(lock_key, token, CART_LOCK_SECONDS):
+            if time.monotonic() >= deadline:
+                raise CartBusy("The cart is being updated by another request, please try again")
+            time.sleep(CART_LOCK_POLL)
+        self._lock_depth = 1
+        try:
+            yield
+        finally:
+            self._lock_depth = 0
+            # not ours any more if it expired and someone else took it
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    def lines(self):
+        return cache.get(self.key, {})
+
+    # every write restarts the ttl, reads don't
+    def save(self, lines):
+        with self.lock():
+            if lines:
+                cache.set(self.key, lines, settings.CART_TTL)
+            else:
+                cache.delete(self.key)
+
+    def add(self, product, quantity, reservation_id):
+        with self.lock():
+            lines = self.lines()
+            line = lines.setdefault(product.id, {'quantity': 0, 'price': product.price, 'reservations': []})
+            line['quantity'] += quantity
+            line['reservations'].append(reservation_id)
+            self.save(lines)
+        return line
+
+    def remove(self, product_id):
+        with self.lock():
+            lines = self.lines()
+            line = lines.pop(product_id, None)
+            if line is not None:
+                self.save(lines)
+        return line
+
+    def clear(self):
+        with self.lock():
+            cache.delete(self.key)
+
+    def reservation_ids(self, lines=None):
+        lines = self.lines() if lines is None else lines
+        return [reservation for line in lines.values() for reservation in line['reservations']]
+
+    # hand the anonymous cart id back to the client. the cookie is set again on every response so it
+    # keeps up with the server side ttl, which restarts on every write
+    def attach(self, response):
+        if self.cart_id:
+            response[CART_HEADER] = self.cart_id
+            response.set_cookie(CART_COOKIE, self.cart_id, max_age=settings.CART_TTL, httponly=True, samesite='Lax')
+        return response
+
+
+def line_total(line):
+    return Decimal(line['price']) * line['quantity']
+
+
+# cart lines with their products, one query for the whole cart unless the products are already loaded
+def cart_rows(lines, products=None):
+    from app.models import Product
+
+    if products is None:
+        products = Product.objects.for_serializer().in_bulk(list(lines))
+    return [
+        {'id': product_id, 'product': products[product_id], 'quantity': line['quantity'],
+         'price': line['price'], 'line_total': line_total(line)}
+        for product_id, line in lines.items() if product_id in products
+    ]
+
+
+# validates a batch body into (op, product_id, quantity) tuples, raises ValueError with a message for the client
+def parse_cart_operations(operations):
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a non empty list")
+    if len(operations) > CART_BATCH_LIMIT:
+        raise ValueError(f"At most {CART_BATCH_LIMIT} operations per batch")
+
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise ValueError(f"Operation {index} must be an object")
+        op = operation.get('op')
+        if op not in CART_OPERATIONS:
+            raise ValueError(f"Operation {index}: op must be one of {', '.join(CART_OPERATIONS)}")
+        try:
+            product_id = int(operation.get('product_id'))
+        except (TypeError, ValueError):
+            raise ValueError(f"Operation {index}: product_id must be a number")
+        quantity = 0
+        if op != 'remove':
+            try:
+                quantity = int(operation.get('quantity', 1))
+            except (TypeError, ValueError):
+                raise ValueError(f"Operation {index}: quantity must be a number")
+            # update to 0 removes the line
+            if quantity < (1 if op == 'add' else 0):
+                raise ValueError(f"Operation {index}: quantity must be at least {1 if op == 'add' else 0}")
+        parsed.append((op, product_id, quantity))
+    return parsed
+
+
+# the quantity each product in the batch ends up with, operations apply in order
+def target_quantities(lines, operations):
+    targets = {}
+    for op, product_id, quantity in operations:
+        current = targets.get(product_id, lines[product_id]['quantity'] if product_id in lines else 0)
+        targets[product_id] = current + quantity if op == 'add' else quantity
+    return targets
@@ -0,0 +1,35 @@
+# deployment checks for the settings the app relies on
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+from django.core.exceptions import ImproperlyConfigured
+from app.utility import tracking_worker_id
+
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+# catalog versions, carts and counters live in the cache, a per process cache
+# gives every worker its own copy of them
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.DEBUG or backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        f"The default cache ({backend}) is local to each process.",
+        hint="Set CACHE_BACKEND/CACHE_LOCATION to redis or memcached, or silence app.E001 for a single process.",
+        id='app.E001',
+    )]
+
+
+# order tracking ids need a worker id per process, see app.utility.generate_tracking_id.
+# only a warning, commands that never create orders (migrate, send_outbox) still run
+@register()
+def check_tracking_worker_id(app_configs, **kwargs):
+    try:
+        tracking_worker_id()
+    except ImproperlyConfigured as e:
+        return [Warning(str(e), hint="Leave TRACKING_WORKER_ID empty to lease one per process from the cache.", id='app.W002')]
+    return []
@@ -0,0 +1,54 @@
+# conditional GET helpers, validators come from the updated_at of the objects in a response
+# and a matching If-None-Match / If-Modified-Since gets a 304 before anything is serialized
+import hashlib
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from app.cache import get_catalog_version
+
+
+def make_etag(*parts):
+    digest = hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def latest(*timestamps):
+    timestamps = [ts for ts in timestamps if ts is not None]
+    return max(timestamps) if timestamps else None
+
+
+# category and listing membership are not covered by product.updated_at, the catalog version is.
+# a listing also changes when a product is deleted or moves to another page, which no updated_at
+# shows, so listings get no Last-Modified and are validated by their etag alone.
+# the stock is in the etag too, a sharded product's stock moves without touching updated_at
+def product_validators(products, listing=False):
+    etag = make_etag(get_catalog_version(), *(f"{p.id}:{p.updated_at.isoformat()}:{p.stock}" for p in products))
+    return etag, None if listing else latest(*(p.updated_at for p in products))
+
+
+# expects an order from Order.objects.for_serializer(), the items and products are already loaded
+def order_validators(order):
+    items = order.items.all()
+    shipping_updated = order.shipping_address.updated_at if order.shipping_address else None
+    last_modified = latest(
+        order.updated_at, shipping_updated,
+        *(item.updated_at for item in items), *(item.product.updated_at for item in items),
+    )
+    etag = make_etag(order.id, last_modified.isoformat(), len(items))
+    return etag, last_modified
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+# returns a 304 when the client copy is still fresh, otherwise None
+def not_modified_response(request, etag, last_modified):
+    epoch = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=epoch)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
@@ -0,0 +1,66 @@
+# order confirmation emails
+# orders load with OrderQuerySet.for_email (one query plus one items prefetch however many orders),
+# the context is flat values so rendering never touches the database, and the templates are
+# compiled once and kept by the cached template loader (the default for DjangoTemplates with
+# APP_DIRS), so re-sending after an incident is one bulk insert into the outbox per chunk
+from django.template.loader import get_template
+from app.models import Order, OutboxEmail
+from app.outbox import outbox_email
+
+ORDER_CONFIRMATION_SUBJECT = "Order Confirmation - Klinsept"
+ORDER_CONFIRMATION_HTML = 'emails/order_confirmation.html'
+ORDER_CONFIRMATION_TEXT = 'emails/order_confirmation.txt'
+RENDER_CHUNK_SIZE = 500
+
+
+def confirmation_context(order):
+    customer = order.user or order.guest_user
+    address = order.shipping_address
+    return {
+        'user_name': customer.first_name if customer else '',
+        'tracking_no': order.tracking_id,
+        'order_items': [
+            {'name': item.product.name, 'quantity': item.quantity, 'price': item.price, 'line_total': item.line_total}
+            for item in order.items.all()
+        ],
+        'total_price': order.total_price,
+        'shipping_cost': order.shipping_cost,
+        'tax': order.tax,
+        'street_address': address.street_address if address else '',
+        'city': address.city if address else '',
+        'state': address.state if address else '',
+        'zip_code': address.zip_code if address else '',
+        'country': address.country if address else '',
+    }
+
+
+def confirmation_recipient(order):
+    customer = order.user or order.guest_user
+    return customer.email if customer else None
+
+
+# (order, recipient, text, html) for every order that has someone to send to
+def render_confirmations(orders):
+    html_template = get_template(ORDER_CONFIRMATION_HTML)
+    text_template = get_template(ORDER_CONFIRMATION_TEXT)
+    for order in orders:
+        recipient = confirmation_recipient(order)
+        if recipient is None:
+            continue
+        context = confirmation_context(order)
+        yield order, recipient, text_template.render(context), html_template.render(context)
+
+
+# queues one confirmation per order and returns how many were queued
+def queue_order_confirmations(order_ids, chunk_size=RENDER_CHUNK_SIZE):
+    order_ids = list(order_ids)
+    queued = 0
+    for start in range(0, len(order_ids), chunk_size):
+        orders = Order.objects.for_email().filter(id__in=order_ids[start:start + chunk_size]).order_by('id')
+        emails = [
+            outbox_email(ORDER_CONFIRMATION_SUBJECT, [recipient], body=text, html=html)
+            for _, recipient, text, html in render_confirmations(orders)
+        ]
+        OutboxEmail.objects.bulk_create(emails)
+        queued += len(emails)
+    return queued
@@ -0,0 +1,121 @@
+# streaming exports for finance
+# rows are generated from .iterator(chunk_size=...) so only one chunk of orders (and their
+# prefetched items) is in memory at a time, whatever the size of the export
+import csv
+import json
+from datetime import timedelta
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from app.models import Order, OrderItem, Product
+from app.reports import day_start
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+ORDER_FIELDS = [
+    'order_id', 'tracking_id', 'status', 'created_at', 'customer_email',
+    'street_address', 'city', 'state', 'zip_code', 'country',
+    'subtotal', 'shipping_cost', 'tax', 'total_price', 'item_count',
+]
+ITEM_FIELDS = ['product_id', 'sku', 'product_name', 'quantity', 'price', 'line_total']
+PRODUCT_FIELDS = ['id', 'sku', 'name', 'category', 'price', 'stock', 'created_at', 'updated_at']
+# spreadsheets run a cell starting with these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+# csv.writer wants a file, this one hands back what it is given
+class Echo:
+    def write(self, value):
+        return value
+
+
+def export_orders(start=None, end=None, status=None):
+    orders = Order.objects.select_related('user', 'guest_user', 'shipping_address').prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product').only(
+            'order_id', 'product_id', 'product__sku', 'product__name', 'quantity', 'price', 'line_total'
+        ).order_by('id'))
+    ).order_by('id')
+    if start:
+        orders = orders.filter(created_at__gte=day_start(start))
+    if end:
+        orders = orders.filter(created_at__lt=day_start(end + timedelta(days=1)))
+    if status:
+        orders = orders.filter(status=status)
+    return orders
+
+
+def export_products(start=None, end=None):
+    products = Product.objects.select_related('category').defer('search_vector', 'description').order_by('id')
+    if start:
+        products = products.filter(created_at__gte=day_start(start))
+    if end:
+        products = products.filter(created_at__lt=day_start(end + timedelta(days=1)))
+    return products
+
+
+def order_row(order):
+    customer = order.user or order.guest_user
+    address = order.shipping_address
+    return {
+        'order_id': order.id, 'tracking_id': order.tracking_id, 'status': order.status,
+        'created_at': order.created_at.isoformat(), 'customer_email': customer.email if customer else None,
+        'street_address': address.street_address if address else None, 'city': address.city if address else None,
+        'state': address.state if address else None, 'zip_code': address.zip_code if address else None,
+        'country': address.country if address else None,
+        'subtotal': order.subtotal, 'shipping_cost': order.shipping_cost, 'tax': order.tax,
+        'total_price': order.total_price, 'item_count': order.item_count,
+    }
+
+
+def item_row(item):
+    return {
+        'product_id': item.product_id, 'sku': item.product.sku, 'product_name': item.product.name,
+        'quantity': item.quantity, 'price': item.price, 'line_total': item.line_total,
+    }
+
+
+def product_row(product):
+    return {
+        'id': product.id, 'sku': product.sku, 'name': product.name, 'category': product.category.name,
+        'price': product.price, 'stock': product.stock,
+        'created_at': product.created_at.isoformat(), 'updated_at': product.updated_at.isoformat(),
+    }
+
+
+# customer and catalog text goes to finance spreadsheets, a leading quote keeps it text
+def csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+# csv has one line per item (an order without items still gets a line), ndjson one object per order
+def stream_orders(orders, output, chunk_size=EXPORT_CHUNK_SIZE):
+    if output == 'ndjson':
+        for order in orders.iterator(chunk_size=chunk_size):
+            row = order_row(order)
+            row['items'] = [item_row(item) for item in order.items.all()]
+            yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+        return
+
+    writer = csv.writer(Echo())
+    yield writer.writerow(ORDER_FIELDS + ITEM_FIELDS)
+    for order in orders.iterator(chunk_size=chunk_size):
+        row = order_row(order)
+        items = order.items.all() or [None]
+        for item in items:
+            line = {**row, **(item_row(item) if item else {})}
+            yield writer.writerow([csv_cell(line.get(field)) for field in ORDER_FIELDS + ITEM_FIELDS])
+
+
+def stream_products(products, output, chunk_size=EXPORT_CHUNK_SIZE):
+    if output == 'ndjson':
+        for product in products.iterator(chunk_size=chunk_size):
+            yield json.dumps(product_row(product), cls=DjangoJSONEncoder) + '\n'
+        return
+
+    writer = csv.writer(Echo())
+    yield writer.writerow(PRODUCT_FIELDS)
+    for product in products.iterator(chunk_size=chunk_size):
+        row = product_row(product)
+        yield writer.writerow([csv_cell(row[field]) for field in PRODUCT_FIELDS])
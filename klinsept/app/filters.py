@@ -0,0 +1,98 @@
+# catalog filters and facet counts for the product listing
+# facets are disjunctive, each one is counted with every other active filter but not its own
+# so the sidebar keeps showing the alternatives, and all of them come from one grouped query
+from decimal import Decimal, InvalidOperation
+from django.db.models import Count, Q
+
+PRICE_BUCKETS = [
+    (Decimal('0'), Decimal('25')),
+    (Decimal('25'), Decimal('50')),
+    (Decimal('50'), Decimal('100')),
+    (Decimal('100'), Decimal('250')),
+    (Decimal('250'), None),
+]
+
+
+def _decimal(value, name):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f"{name} must be a number")
+
+
+# ?category=1,2&min_price=10&max_price=50&in_stock=true, raises ValueError on bad input
+def parse_product_filters(params):
+    filters = {}
+    category = params.get('category')
+    if category:
+        ids = [part for part in category.split(',') if part]
+        if not all(part.isdigit() for part in ids):
+            raise ValueError("category must be a comma separated list of ids")
+        filters['category'] = Q(category_id__in=ids)
+
+    price = Q()
+    if params.get('min_price'):
+        price &= Q(price__gte=_decimal(params['min_price'], 'min_price'))
+    if params.get('max_price'):
+        price &= Q(price__lte=_decimal(params['max_price'], 'max_price'))
+    if price:
+        filters['price'] = price
+
+    if params.get('in_stock') == 'true':
+        filters['stock'] = Q(stock__gt=0)
+    return filters
+
+
+def filter_products(queryset, filters):
+    return queryset.filter(*filters.values())
+
+
+def _without(filters, name):
+    q = Q()
+    for key, value in filters.items():
+        if key != name:
+            q &= value
+    return q
+
+
+def _count(q):
+    return Count('id', filter=q) if q else Count('id')
+
+
+def _bucket(low, high):
+    q = Q(price__gte=low)
+    if high is not None:
+        q &= Q(price__lt=high)
+    return q
+
+
+def product_facets(queryset, filters):
+    aggregates = {
+        'category_count': _count(_without(filters, 'category')),
+        'in_stock_count': _count(_without(filters, 'stock') & Q(stock__gt=0)),
+    }
+    for index, (low, high) in enumerate(PRICE_BUCKETS):
+        aggregates[f'price_{index}'] = _count(_without(filters, 'price') & _bucket(low, high))
+
+    rows = list(
+        queryset.order_by()
+        .values('category_id', 'category__name')
+        .annotate(**aggregates)
+        .order_by('category__name')
+    )
+    # only the category facet depends on the grouping, the rest are summed across groups
+    return {
+        'category': [
+            {'id': row['category_id'], 'name': row['category__name'], 'count': row['category_count']}
+            for row in rows
+        ],
+        'price': [
+            {
+                'min': str(low),
+                'max': str(high) if high is not None else None,
+                'count': sum(row[f'price_{index}'] for row in rows),
+            }
+            for index, (low, high) in enumerate(PRICE_BUCKETS)
+        ],
+        'in_stock': sum(row['in_stock_count'] for row in rows),
+    }
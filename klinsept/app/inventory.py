@@ -0,0 +1,270 @@
+# stock reservations
+# stock only moves through single conditional UPDATEs (stock = stock - n WHERE stock >= n),
+# so concurrent checkouts can't oversell and no request ever rewrites the whole product row.
+# hot products can opt in to sharded stock (Product.shard_count > 0): their stock is split over
+# StockShard rows, each reservation takes from a random shard, and Product.stock becomes an
+# aggregate refreshed by reconcile_stock_shards
+import random
+from django.db import transaction
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F, Q, Sum, Case, When, Value, IntegerField
+from django.utils import timezone
+from app.models import Product, StockReservation, StockShard
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id, quantity):
+        self.product_id = product_id
+        self.quantity = quantity
+        super().__init__(f"Insufficient stock for product {product_id}, requested {quantity}")
+
+
+class ReservationExpired(Exception):
+    pass
+
+
+# raises Product.DoesNotExist or InsufficientStock, nothing is taken in that case
+def reserve_stock(product_id, quantity, order_item=None):
+    with transaction.atomic():
+        take_stock(product_id, quantity)
+        reservation = StockReservation.objects.create(product_id=product_id, order_item=order_item, quantity=quantity)
+    return reservation
+
+
+# the unsharded case is the single conditional UPDATE, sharded products only cost the extra lookup
+def take_stock(product_id, quantity):
+    updated = Product.objects.filter(id=product_id, shard_count=0, stock__gte=quantity).update(
+        stock=F('stock') - quantity, updated_at=timezone.now()
+    )
+    if updated:
+        return
+    shard_count = Product.objects.filter(id=product_id).values_list('shard_count', flat=True).first()
+    if shard_count is None:
+        raise Product.DoesNotExist(f"Product {product_id} does not exist")
+    if not shard_count or not _take_from_shards(product_id, quantity):
+        raise InsufficientStock(product_id, quantity)
+
+
+def give_back_stock(product_id, quantity, now=None):
+    now = now or timezone.now()
+    if Product.objects.filter(id=product_id, shard_count=0).update(stock=F('stock') + quantity, updated_at=now):
+        return
+    shards = list(StockShard.objects.filter(product_id=product_id).values_list('shard', flat=True))
+    if shards:
+        StockShard.objects.filter(product_id=product_id, shard=random.choice(shards)).update(
+            quantity=F('quantity') + quantity, updated_at=now
+        )
+    else:
+        # a sharded product without its shard rows keeps the stock on the product, it is never dropped
+        Product.objects.filter(id=product_id).update(stock=F('stock') + quantity, updated_at=now)
+
+
+def _take_from_shards(product_id, quantity):
+    now = timezone.now()
+    # random order spreads concurrent reservations over the shards, a lost race just moves on to the next one
+    shards = list(StockShard.objects.filter(product_id=product_id, quantity__gte=quantity).values_list('shard', flat=True))
+    random.shuffle(shards)
+    for shard in shards:
+        if StockShard.objects.filter(product_id=product_id, shard=shard, quantity__gte=quantity).update(
+            quantity=F('quantity') - quantity, updated_at=now
+        ):
+            return True
+
+    # no single shard holds enough, take it from several under a lock on all of them
+    with transaction.atomic():
+        locked = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('-quantity', 'shard'))
+        if sum(shard.quantity for shard in locked) < quantity:
+            return False
+        remaining = quantity
+        for shard in locked:
+            taken = min(shard.quantity, remaining)
+            shard.quantity -= taken
+            shard.updated_at = now
+            remaining -= taken
+            if not remaining:
+                break
+        StockShard.objects.bulk_update(locked, ['quantity', 'updated_at'])
+    return True
+
+
+# opts a product in or out of sharded stock, shards=0 folds the shards back into Product.stock.
+# stock is a new count on hand (imports and admin edits of sharded products), what is still held
+# is taken off it. by default the current total is kept
+def set_stock_shards(product_id, shards, stock=None):
+    with transaction.atomic():
+        # the shard rows are locked first, like rebalance_stock_shards does, so no reservation
+        # takes from them between the sum and the rewrite
+        locked = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('shard'))
+        product = Product.objects.select_for_update().get(id=product_id)
+        if stock is not None:
+            total = max(0, stock - held_stock([product_id]).get(product_id, 0))
+        else:
+            total = sum(shard.quantity for shard in locked) if locked else product.stock
+        StockShard.objects.filter(product_id=product_id).delete()
+        if shards:
+            StockShard.objects.bulk_create([
+                StockShard(product_id=product_id, shard=shard, quantity=quantity)
+                for shard, quantity in enumerate(_spread(total, shards))
+            ])
+        Product.objects.filter(id=product_id).update(stock=total, shard_count=shards, updated_at=timezone.now())
+    return total
+
+
+# evens the shards out again and writes their sum to Product.stock
+def rebalance_stock_shards(product_id):
+    with transaction.atomic():
+        shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('shard'))
+        if not shards:
+            # nothing to even out, the stock is on the product (see give_back_stock)
+            return Product.objects.filter(id=product_id).values_list('stock', flat=True).first()
+        total = sum(shard.quantity for shard in shards)
+        now = timezone.now()
+        for shard, quantity in zip(shards, _spread(total, len(shards))):
+            shard.quantity = quantity
+            shard.updated_at = now
+        StockShard.objects.bulk_update(shards, ['quantity', 'updated_at'])
+        Product.objects.filter(id=product_id).exclude(stock=total).update(stock=total, updated_at=now)
+    return total
+
+
+# stock already taken by carts and unpaid orders, {product_id: quantity}. Product.stock is what is
+# left to reserve, so a count of the goods on hand (an import feed, an admin edit) minus this is the
+# new stock. lock the product rows or their shards first, a reservation can't move in between then
+def held_stock(product_ids):
+    rows = StockReservation.objects.filter(
+        Q(status='Held') | Q(status='Claimed', order_item__order__status='Pending'),
+        product_id__in=product_ids,
+    ).values('product_id').annotate(total=Sum('quantity')).order_by('product_id')
+    return {row['product_id']: row['total'] for row in rows}
+
+
+# live stock, the sum of the shards for sharded products
+def available_stock(product):
+    if not product.shard_count:
+        return product.stock
+    total = StockShard.objects.filter(product_id=product.id).aggregate(total=Sum('quantity'))['total']
+    return product.stock if total is None else total
+
+
+# cached catalog responses are only rebuilt when the catalog itself changes, their stock moves
+# with every cart so a cache hit writes the live figures over it, one query for the whole page.
+# rows are the serialized products, the detail page sums a sharded product's shards like the view.
+# returns the products for the validators, rows of deleted products are left as they are
+def refresh_stock(rows, detail=False):
+    products = Product.objects.only('id', 'stock', 'shard_count', 'updated_at').in_bulk(
+        [row['id'] for row in rows]
+    )
+    for row in rows:
+        product = products.get(row['id'])
+        if product is not None:
+            if detail:
+                product.stock = available_stock(product)
+            row['stock'] = product.stock
+    return [products[row['id']] for row in rows if row['id'] in products]
+
+
+def _spread(total, shards):
+    return [total // shards + (1 if shard < total % shards else 0) for shard in range(shards)]
+
+
+# puts held stock back, one UPDATE per product however many reservations there are
+def release_reservations(reservations):
+    with transaction.atomic():
+        held = reservations.filter(status='Held')
+        totals = held.values('product_id').annotate(total=Sum('quantity')).order_by('product_id')
+        now = timezone.now()
+        for row in totals:
+            give_back_stock(row['product_id'], row['total'], now)
+        return held.update(status='Released', updated_at=now)
+
+
+# cart reservations live as long as the cart, every cart write pushes them forward
+def touch_reservations(reservation_ids):
+    if reservation_ids:
+        StockReservation.objects.filter(id__in=reservation_ids, status='Held').update(updated_at=timezone.now())
+
+
+# carts that expired from the cache leave their reservations held, give that stock back
+def release_expired_cart_reservations():
+    cutoff = timezone.now() - timedelta(seconds=settings.CART_TTL)
+    return release_reservations(
+        StockReservation.objects.filter(status='Held', updated_at__lt=cutoff)
+    )
+
+
+# moves each cart line's reservations onto its new order item in one UPDATE, claims is
+# [(order_item, reservation ids)], fails if any of them expired meanwhile
+def claim_reservations(claims):
+    owners = {reservation_id: item.id for item, reservation_ids in claims for reservation_id in reservation_ids}
+    if not owners:
+        return
+    claimed = StockReservation.objects.filter(id__in=owners, status='Held', order_item__isnull=True).update(
+        order_item_id=Case(
+            *[When(id=reservation_id, then=Value(item_id)) for reservation_id, item_id in owners.items()],
+            output_field=IntegerField(),
+        ),
+        status='Claimed',
+        updated_at=timezone.now(),
+    )
+    if claimed != len(owners):
+        raise ReservationExpired("Some cart reservations expired")
+
+
+# re-reserves several cart lines at once, changes maps product_id -> (its reservation ids, new quantity).
+# the still held quantity of each line is swapped for one reservation of the new quantity, with a single
+# conditional UPDATE moving the stock of every product by the difference. raises InsufficientStock with
+# nothing changed, returns ({product_id: new reservation}, {product_id: stock taken, negative if given back})
+def rebalance_reservations(changes):
+    try:
+        with transaction.atomic():
+            ids = [reservation_id for reservation_ids, _ in changes.values() for reservation_id in reservation_ids]
+            held = {}
+            rows = StockReservation.objects.select_for_update().filter(
+                id__in=ids, status='Held', order_item__isnull=True
+            ).values_list('product_id', 'quantity')
+            for product_id, quantity in rows:
+                held[product_id] = held.get(product_id, 0) + quantity
+
+            deltas = {product_id: quantity - held.get(product_id, 0) for product_id, (_, quantity) in changes.items()}
+            deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+            now = timezone.now()
+            if deltas:
+                condition = Q()
+                for product_id, delta in deltas.items():
+                    condition |= Q(id=product_id, shard_count=0, stock__gte=delta) if delta > 0 else Q(id=product_id, shard_count=0)
+                updated = Product.objects.filter(condition).update(
+                    stock=F('stock') - Case(
+                        *[When(id=product_id, then=Value(delta)) for product_id, delta in deltas.items()],
+                        output_field=IntegerField(),
+                    ),
+                    updated_at=now,
+                )
+                if updated != len(deltas):
+                    # sharded products don't match the UPDATE above, they move through their shards
+                    sharded = list(Product.objects.filter(id__in=deltas, shard_count__gt=0).values_list('id', flat=True))
+                    for product_id in sharded:
+                        if deltas[product_id] < 0:
+                            give_back_stock(product_id, -deltas[product_id], now)
+                        elif not _take_from_shards(product_id, deltas[product_id]):
+                            raise InsufficientStock(product_id, deltas[product_id])
+                    if updated + len(sharded) != len(deltas):
+                        raise InsufficientStock(None, None)
+
+            StockReservation.objects.filter(id__in=ids, status='Held', order_item__isnull=True).update(
+                status='Released', updated_at=now
+            )
+            created = StockReservation.objects.bulk_create([
+                StockReservation(product_id=product_id, quantity=quantity)
+                for product_id, (_, quantity) in changes.items() if quantity
+            ])
+    except InsufficientStock as e:
+        if e.product_id is not None:
+            raise
+        # rolled back by now, find a product that was short for the error
+        taken = {product_id: delta for product_id, delta in deltas.items() if delta > 0}
+        stock = dict(Product.objects.filter(id__in=taken).values_list('id', 'stock'))
+        product_id = next((product_id for product_id, delta in taken.items() if stock.get(product_id, 0) < delta), None)
+        raise InsufficientStock(product_id, taken.get(product_id))
+
+    return {reservation.product_id: reservation for reservation in created}, deltas
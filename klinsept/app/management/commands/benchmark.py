@@ -0,0 +1,208 @@
+import json
+import math
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from app.models import User, Product, Order
+from app.cart import CartStore
+
+BENCH_EMAIL = 'benchmark@klinsept.test'
+BENCH_PASSWORD = 'benchmark-password'
+# served through the catalog cache (app/cache.py), each runs cold with the cache cleared before
+# every request and again as <name>_warm, answered from the cache
+CACHED_SCENARIOS = frozenset({
+    'products', 'products_cursor', 'products_facets', 'product_detail', 'related_products', 'product_search',
+})
+
+
+def percentile(values, pct):
+    # nearest rank
+    ordered = sorted(values)
+    index = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = "Benchmark the API endpoints in process against the current database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--endpoint', action='append', help="Only run these endpoints, can be repeated")
+        parser.add_argument('--clear-cache', action='store_true',
+                            help="Also clear the cache before every cart, order and login request")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+        parser.add_argument('--compare', help="Baseline JSON to check for regressions")
+        parser.add_argument('--threshold', type=float, default=0.2, help="Allowed p95 slowdown against the baseline")
+
+    def handle(self, *args, **options):
+        # the best stocked product so the cart scenarios don't sell out mid run
+        self.product = Product.objects.filter(stock__gt=0).order_by('-stock', 'id').first()
+        if self.product is None:
+            raise CommandError("No products in stock, seed the database first (generate_load_data)")
+
+        scenarios = self.scenarios()
+        if options['endpoint']:
+            unknown = set(options['endpoint']) - set(scenarios)
+            if unknown:
+                raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+            scenarios = {name: scenarios[name] for name in options['endpoint']}
+
+        runs = {}
+        for name, scenario in scenarios.items():
+            if name in CACHED_SCENARIOS:
+                runs[name] = (scenario, True)
+                runs[f'{name}_warm'] = (scenario, False)
+            else:
+                runs[name] = (scenario, options['clear_cache'])
+
+        # everything the run writes is rolled back so the seeded data stays as it was
+        with transaction.atomic():
+            self.client = Client(HTTP_X_API_KEY=settings.API_KEY)
+            self.login()
+            results = {
+                name: self.run(scenario, options['iterations'], options['warmup'], clear_cache)
+                for name, (scenario, clear_cache) in runs.items()
+            }
+            transaction.set_rollback(True)
+
+        self.print_results(results)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump({'vendor': connection.vendor, 'iterations': options['iterations'], 'endpoints': results},
+                          handle, indent=2)
+        if options['compare']:
+            self.compare(results, options['compare'], options['threshold'])
+
+    # each scenario returns (prepare, request), prepare runs untimed before every request
+    def scenarios(self):
+        product_id = self.product.id
+        return {
+            'products': (None, lambda _: self.client.get(reverse('get_products'))),
+            'products_cursor': (None, lambda _: self.client.get(reverse('get_products'), {'pagination': 'cursor'})),
+            'products_facets': (None, lambda _: self.client.get(reverse('get_products'), {'facets': 'true'})),
+            'product_detail': (None, lambda _: self.client.get(reverse('get_individual_product', args=[product_id]))),
+            'related_products': (None, lambda _: self.client.get(reverse('get_related_products', args=[product_id]))),
+            'product_search': (None, lambda _: self.client.get(reverse('search_products'), {'q': self.product.name.split()[0]})),
+            'cart_add': (None, lambda _: self.add_to_cart()),
+            'cart_batch': (self.batch_products, self.cart_batch),
+            'cart_list': (None, lambda _: self.client.get(reverse('get_items_incart'))),
+            'cart_remove': (self.cart_item, lambda item: self.client.delete(reverse('remove_items_from_cart', args=[item]))),
+            'order_create': (self.cart_item, self.create_order),
+            'order_history': (None, lambda _: self.client.get(reverse('user_orders'))),
+            'order_get': (self.latest_order, lambda order_id: self.client.get(reverse('get__individual_order'), {'order_id': order_id})),
+            'login': (None, lambda _: self.login()),
+        }
+
+    def login(self):
+        user = User.objects.filter(email=BENCH_EMAIL).first()
+        if user is None:
+            user = User.objects.create_user(email=BENCH_EMAIL, password=BENCH_PASSWORD, first_name='Bench', last_name='Mark')
+        # a cart left by an earlier run points at reservations that were rolled back
+        CartStore.for_user(user.id).clear()
+        return self.client.post(reverse('login_user'), {'email': BENCH_EMAIL, 'password': BENCH_PASSWORD},
+                                content_type='application/json')
+
+    def add_to_cart(self):
+        return self.client.post(reverse('add_to_cart'), {'product_id': self.product.id, 'quantity': 1},
+                                content_type='application/json')
+
+    # empties the cart of the batch products again before each timed batch, so stock doesn't run out
+    def batch_products(self):
+        if not hasattr(self, '_batch_products'):
+            self._batch_products = list(
+                Product.objects.filter(stock__gt=0).order_by('-stock', 'id').values_list('id', flat=True)[:10]
+            )
+        self.cart_batch([{'op': 'remove', 'product_id': product_id} for product_id in self._batch_products])
+        return [{'op': 'add', 'product_id': product_id, 'quantity': 1} for product_id in self._batch_products]
+
+    def cart_batch(self, operations):
+        return self.client.post(reverse('cart_batch'), {'operations': operations}, content_type='application/json')
+
+    def cart_item(self):
+        response = self.add_to_cart()
+        if response.status_code != 200:
+            raise CommandError(f"Adding to the cart failed: {response.content.decode()}")
+        return response.json()['id']
+
+    def create_order(self, _=None):
+        return self.client.post(reverse('create_order'), {
+            'address': '1 Bench Road', 'city': 'Nairobi', 'state': 'Nairobi', 'zip_code': '00100', 'country': 'Kenya',
+        }, content_type='application/json')
+
+    def latest_order(self):
+        order = Order.objects.order_by('-id').first()
+        if order:
+            return order.id
+        self.cart_item()
+        return self.create_order().json()['order_id']
+
+    def run(self, scenario, iterations, warmup, clear_cache):
+        prepare, request = scenario
+        latencies, queries, errors = [], [], 0
+        for i in range(warmup + iterations):
+            # a savepoint per request, a database error on postgres aborts the transaction until it is
+            # rolled back and would otherwise fail every later measurement
+            try:
+                with transaction.atomic():
+                    argument = prepare() if prepare else None
+                    if clear_cache:
+                        cache.clear()
+                    with CaptureQueriesContext(connection) as captured:
+                        started = time.perf_counter()
+                        response = request(argument)
+                        elapsed = time.perf_counter() - started
+            except DatabaseError:
+                errors += i >= warmup
+                continue
+            if i < warmup:
+                continue
+            latencies.append(elapsed * 1000)
+            queries.append(len(captured))
+            errors += response.status_code >= 400
+        if not latencies:
+            raise CommandError(f"Every request failed with a database error ({errors})")
+
+        total = sum(latencies) / 1000
+        return {
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'throughput_rps': round(iterations / total, 1) if total else None,
+            'queries': max(queries),
+            'errors': errors,
+        }
+
+    def print_results(self, results):
+        self.stdout.write(f"{'endpoint':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}{'errors':>8}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<24}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+                f"{result['throughput_rps']:>10}{result['queries']:>9}{result['errors']:>8}"
+            )
+
+    # more queries than the baseline or a p95 past the threshold fails the run
+    def compare(self, results, baseline_path, threshold):
+        with open(baseline_path) as handle:
+            baseline = json.load(handle)['endpoints']
+
+        regressions = []
+        for name, result in results.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            if result['queries'] > before['queries']:
+                regressions.append(f"{name}: {before['queries']} -> {result['queries']} queries")
+            if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+            if result['errors'] > before['errors']:
+                regressions.append(f"{name}: {before['errors']} -> {result['errors']} errors")
+
+        if regressions:
+            raise CommandError("Benchmark regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline_path}"))
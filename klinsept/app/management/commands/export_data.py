@@ -0,0 +1,36 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from app.exports import EXPORT_FORMATS, EXPORT_CHUNK_SIZE, export_orders, export_products, stream_orders, stream_products
+
+
+def date_arg(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = "Stream orders or products to a CSV or NDJSON file, same rows as the export endpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['orders', 'products'])
+        parser.add_argument('--output', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--file', help="Write here instead of stdout")
+        parser.add_argument('--start', type=date_arg, help="YYYY-MM-DD")
+        parser.add_argument('--end', type=date_arg, help="YYYY-MM-DD")
+        parser.add_argument('--status', choices=['Paid', 'Pending'], help="Orders only")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if options['kind'] == 'orders':
+            rows = stream_orders(export_orders(options['start'], options['end'], options['status']),
+                                 options['output'], options['chunk_size'])
+        elif options['status']:
+            raise CommandError("--status only applies to orders")
+        else:
+            rows = stream_products(export_products(options['start'], options['end']), options['output'], options['chunk_size'])
+
+        if not options['file']:
+            for row in rows:
+                self.stdout.write(row, ending='')
+            return
+        with open(options['file'], 'w', newline='') as handle:
+            handle.writelines(rows)
@@ -0,0 +1,253 @@
+import itertools
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from app.models import (
+    User, GuestUser, Category, Product, Order, OrderItem, ShippingAddress, Payment, Review
+)
+from app.search import update_search_index
+from app.cache import bump_catalog_version
+
+FIRST_NAMES = ['James', 'Mary', 'Amina', 'Wanjiru', 'Otieno', 'Li', 'Sofia', 'Mateo', 'Aisha', 'Noah', 'Grace', 'Kofi']
+LAST_NAMES = ['Kamau', 'Smith', 'Ochieng', 'Garcia', 'Mwangi', 'Chen', 'Njeri', 'Brown', 'Mensah', 'Kimani']
+CITIES = [('Nairobi', 'Nairobi', 'Kenya'), ('Mombasa', 'Mombasa', 'Kenya'), ('Kampala', 'Central', 'Uganda'),
+          ('Lagos', 'Lagos', 'Nigeria'), ('Austin', 'Texas', 'USA'), ('Berlin', 'Berlin', 'Germany')]
+# timestamps count back from here, so a seed gives the same rows whenever it is run
+DEFAULT_ANCHOR = '2025-01-01'
+# the seed goes into the tracking ids, '#S' + 8 hex digits of seed + '-' + 9 of the order number
+# fills Order.tracking_id (20 characters) exactly and can't clash with generate_tracking_id's ids
+MAX_SEED = 16 ** 8 - 1
+WORDS = ['classic', 'smart', 'portable', 'organic', 'premium', 'compact', 'wireless', 'handmade', 'durable', 'eco']
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    # let bulk_create keep generated created_at/updated_at instead of stamping now()
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a deterministic, production sized synthetic dataset"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=42, help=f"0 to {MAX_SEED}")
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--guests', type=int, default=500)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--reviews', type=int, default=5000)
+        parser.add_argument('--days', type=int, default=365, help="Spread orders over this many days")
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--anchor', default=DEFAULT_ANCHOR,
+                            help="YYYY-MM-DD, the newest possible timestamp (midnight UTC), 'now' for the current time")
+
+    def handle(self, *args, **options):
+        if not 0 <= options['seed'] <= MAX_SEED:
+            raise CommandError(f"--seed must be from 0 to {MAX_SEED}")
+        self.rng = random.Random(options['seed'])
+        self.seed = options['seed']
+        self.tag = f"seed{options['seed']}"
+        self.batch_size = options['batch_size']
+        self.now = self.anchor(options['anchor'])
+        self.days = options['days']
+
+        if User.objects.filter(email__endswith=f"@{self.tag}.load.test").exists():
+            raise CommandError(f"Load data for seed {options['seed']} already exists, use another --seed")
+
+        started = time.monotonic()
+        with explicit_timestamps(User, GuestUser, Category, Product, Order, OrderItem, ShippingAddress, Payment, Review):
+            users = self.step('users', self.create_users, options['users'])
+            guests = self.step('guest users', self.create_guests, options['guests'])
+            addresses = self.step('shipping addresses', self.create_addresses, users, guests)
+            products = self.step('products', self.create_products, options['categories'], options['products'])
+            self.step('orders', self.create_orders, options['orders'], users, guests, addresses, products)
+            self.step('reviews', self.create_reviews, options['reviews'], users, products)
+
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Load data generated in {time.monotonic() - started:.1f}s'))
+
+    def anchor(self, value):
+        if value == 'now':
+            return timezone.now()
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=dt_timezone.utc)
+        except ValueError:
+            raise CommandError(f"--anchor must be YYYY-MM-DD or now, got {value!r}")
+
+    def step(self, label, func, *args):
+        started = time.monotonic()
+        result = func(*args)
+        self.stdout.write(f'{label}: {time.monotonic() - started:.1f}s')
+        return result
+
+    def timestamp(self, skew=1.0):
+        # skew > 1 leans towards recent dates
+        return self.now - timedelta(seconds=self.days * 86400 * self.rng.random() ** skew)
+
+    def person(self):
+        return self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES), f"+2547{self.rng.randint(10000000, 99999999)}"
+
+    def create_users(self, count):
+        password = make_password('loadtest-password')  # hashing once, it is the slow part
+        ids = []
+        for batch in batched(range(count), self.batch_size):
+            rows = []
+            for i in batch:
+                first_name, last_name, phone = self.person()
+                joined = self.timestamp()
+                rows.append(User(
+                    email=f"user{i}@{self.tag}.load.test", first_name=first_name, last_name=last_name,
+                    phone_number=phone, password=password, date_joined=joined, created_at=joined, updated_at=joined,
+                ))
+            ids.extend(user.id for user in User.objects.bulk_create(rows))
+        return ids
+
+    def create_guests(self, count):
+        ids = []
+        for batch in batched(range(count), self.batch_size):
+            rows = []
+            for i in batch:
+                first_name, last_name, phone = self.person()
+                created = self.timestamp()
+                rows.append(GuestUser(
+                    email=f"guest{i}@{self.tag}.load.test", first_name=first_name, last_name=last_name,
+                    phone_number=phone, created_at=created, updated_at=created,
+                ))
+            ids.extend(guest.id for guest in GuestUser.objects.bulk_create(rows))
+        return ids
+
+    def address(self, **owner):
+        city, state, country = self.rng.choice(CITIES)
+        created = self.timestamp()
+        return ShippingAddress(
+            street_address=f"{self.rng.randint(1, 999)} {self.rng.choice(LAST_NAMES)} Road", city=city, state=state,
+            zip_code=str(self.rng.randint(10000, 99999)), country=country, created_at=created, updated_at=created, **owner
+        )
+
+    # one address per customer, keyed ('user', id) or ('guest', id)
+    def create_addresses(self, users, guests):
+        owners = [('user', user_id) for user_id in users] + [('guest', guest_id) for guest_id in guests]
+        addresses = {}
+        for batch in batched(owners, self.batch_size):
+            rows = [
+                self.address(user_id=owner_id) if kind == 'user' else self.address(guest_user_id=owner_id)
+                for kind, owner_id in batch
+            ]
+            for owner, address in zip(batch, ShippingAddress.objects.bulk_create(rows)):
+                addresses[owner] = address.id
+        return addresses
+
+    def create_products(self, category_count, count):
+        categories = Category.objects.bulk_create([
+            Category(name=f"Load {self.tag} category {i}") for i in range(category_count)
+        ])
+        products = {}
+        for batch in batched(range(count), self.batch_size):
+            rows = []
+            for i in batch:
+                # long tailed prices, most products are cheap
+                price = Decimal(str(round(min(max(self.rng.lognormvariate(3.2, 1.0), 1), 5000), 2)))
+                created = self.timestamp()
+                rows.append(Product(
+                    sku=f"{self.tag}-{i}",
+                    name=f"{self.rng.choice(WORDS).title()} {self.rng.choice(WORDS)} item {i}",
+                    description=' '.join(self.rng.choices(WORDS, k=12)),
+                    price=price, stock=self.rng.randint(0, 500), category=self.rng.choice(categories),
+                    created_at=created, updated_at=created,
+                ))
+            created_rows = Product.objects.bulk_create(rows)
+            update_search_index([product.id for product in created_rows])
+            products.update((product.id, product.price) for product in created_rows)
+        return products
+
+    def create_orders(self, count, users, guests, addresses, products):
+        product_ids = list(products)
+        self.rng.shuffle(product_ids)
+        # zipf like popularity, a few products get most of the orders
+        popularity = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(len(product_ids))))
+        customers = [('user', user_id) for user_id in users] + [('guest', guest_id) for guest_id in guests]
+        if not product_ids or not customers:
+            return
+
+        for batch in batched(range(count), self.batch_size):
+            orders, baskets = [], []
+            for i in batch:
+                kind, owner_id = self.rng.choice(customers)
+                basket = {}
+                size = 1
+                while self.rng.random() < 0.45 and size < 10:
+                    size += 1
+                for product_id in self.rng.choices(product_ids, cum_weights=popularity, k=size):
+                    basket[product_id] = basket.get(product_id, 0) + self.rng.choices([1, 2, 3, 4], [70, 18, 8, 4])[0]
+                subtotal = sum(products[product_id] * quantity for product_id, quantity in basket.items())
+                shipping = Decimal(self.rng.choice(['0.00', '5.00', '9.99']))
+                tax = (subtotal * Decimal('0.16')).quantize(Decimal('0.01'))
+                created = self.timestamp(skew=1.5)
+                orders.append(Order(
+                    user_id=owner_id if kind == 'user' else None,
+                    guest_user_id=owner_id if kind == 'guest' else None,
+                    shipping_address_id=addresses[(kind, owner_id)],
+                    subtotal=subtotal, item_count=len(basket),
+                    total_price=subtotal + shipping + tax, shipping_cost=shipping, tax=tax,
+                    status='Paid' if self.rng.random() < 0.85 else 'Pending',
+                    tracking_id=f"#S{self.seed:08X}-{i:09X}", created_at=created, updated_at=created,
+                ))
+                baskets.append(basket)
+
+            with transaction.atomic():
+                orders = Order.objects.bulk_create(orders)
+                items, payments = [], []
+                for order, basket in zip(orders, baskets):
+                    for product_id, quantity in basket.items():
+                        price = products[product_id]
+                        items.append(OrderItem(
+                            order_id=order.id, product_id=product_id, quantity=quantity, price=price,
+                            line_total=price * quantity, created_at=order.created_at, updated_at=order.created_at,
+                        ))
+                    if order.status == 'Paid':
+                        payments.append(Payment(
+                            user_id=order.user_id, shipping_address_id=order.shipping_address_id, order_id=order.id,
+                            total_price=order.total_price, status='Completed',
+                            payment_date=order.created_at, updated_at=order.created_at,
+                        ))
+                OrderItem.objects.bulk_create(items, batch_size=self.batch_size)
+                Payment.objects.bulk_create(payments, batch_size=self.batch_size)
+
+    def create_reviews(self, count, users, products):
+        if not users or not products:
+            return
+        product_ids = list(products)
+        for batch in batched(range(count), self.batch_size):
+            rows = []
+            for _ in batch:
+                created = self.timestamp()
+                rows.append(Review(
+                    product_id=self.rng.choice(product_ids), user_id=self.rng.choice(users),
+                    rating=self.rng.choices([1, 2, 3, 4, 5], [5, 7, 15, 33, 40])[0],
+                    comment=' '.join(self.rng.choices(WORDS, k=6)), created_at=created, updated_at=created,
+                ))
+            Review.objects.bulk_create(rows)
@@ -0,0 +1,163 @@
+import csv
+import json
+import time
+from decimal import Decimal, InvalidOperation
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from app.models import Category, Product
+from app.search import update_search_index
+from app.inventory import held_stock, set_stock_shards
+from app.cache import bump_catalog_version
+
+UPDATE_FIELDS = ['name', 'description', 'image', 'price', 'stock', 'category', 'updated_at']
+
+
+# streams (line number, row) one row at a time, the file is never loaded whole. a line that
+# can't be decoded or parsed comes out as (line number, error) so it is reported and skipped
+def read_rows(path, file_format):
+    with open(path, 'rb') as handle:
+        if file_format == 'csv':
+            yield from read_csv_rows(handle)
+            return
+        for line_no, line in enumerate(handle, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError('row must be a JSON object')
+            except ValueError as e:  # JSONDecodeError and UnicodeDecodeError are ValueErrors
+                yield line_no, e
+                continue
+            yield line_no, row
+
+
+def read_csv_rows(handle):
+    undecodable = []
+
+    def lines():
+        for line_no, line in enumerate(handle, start=1):
+            try:
+                yield line.decode('utf-8-sig' if line_no == 1 else 'utf-8')
+            except UnicodeDecodeError as e:
+                undecodable.append((line_no, e))
+                yield '\n'  # blank lines are skipped by the reader
+
+    reader = csv.DictReader(lines())
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            row = None
+        except csv.Error as e:
+            row = e
+        yield from undecodable
+        undecodable.clear()
+        if row is None:
+            return
+        yield reader.line_num, row
+
+
+class Command(BaseCommand):
+    help = "Upsert products from a CSV or JSONL feed keyed on sku, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        batch_size = options['batch_size']
+
+        self.categories = dict(Category.objects.values_list('name', 'id'))
+        batch = {}
+        imported = skipped = 0
+        started = time.monotonic()
+
+        try:
+            for line_no, row in read_rows(path, file_format):
+                try:
+                    if isinstance(row, Exception):
+                        raise row
+                    product = self.build_product(row)
+                except (KeyError, ValueError, TypeError, InvalidOperation, csv.Error) as e:
+                    skipped += 1
+                    self.stderr.write(f'Skipping row {line_no}: {e!r}')
+                    continue
+                # the same sku twice in one statement is rejected by ON CONFLICT, last row wins
+                batch[product.sku] = product
+                if len(batch) >= batch_size:
+                    imported += self.flush(batch)
+                    self.report(imported, started)
+        except FileNotFoundError:
+            raise CommandError(f'No such file: {path}')
+        imported += self.flush(batch)
+
+        if imported:
+            bump_catalog_version()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} products, skipped {skipped} rows in {elapsed:.1f}s '
+            f'({imported / elapsed if elapsed else imported:.0f} rows/s)'
+        ))
+
+    def category_id(self, name):
+        name = str(name or '').strip()
+        if not name:
+            raise ValueError('category is required')
+        if name not in self.categories:
+            category, _ = Category.objects.get_or_create(name=name)
+            self.categories[name] = category.id
+        return self.categories[name]
+
+    def build_product(self, row):
+        sku = str(row['sku']).strip()
+        if not sku:
+            raise ValueError('sku is required')
+        stock = int(row.get('stock') or 0)
+        if stock < 0:
+            raise ValueError('stock must not be negative')
+        return Product(
+            sku=sku,
+            name=row['name'],
+            description=row.get('description') or '',
+            image=row.get('image') or None,
+            price=Decimal(str(row['price'])),
+            stock=stock,
+            category_id=self.category_id(row['category']),
+        )
+
+    def flush(self, batch):
+        if not batch:
+            return 0
+        skus = list(batch)
+        with transaction.atomic():
+            sharded = list(Product.objects.filter(sku__in=skus, shard_count__gt=0).values_list('sku', 'id', 'shard_count'))
+            # the feed counts the goods on hand, carts and unpaid orders already took theirs out
+            # of Product.stock. the rows stay locked until the upsert so no reservation slips in
+            existing = dict(
+                Product.objects.select_for_update().filter(sku__in=skus, shard_count=0).order_by('id').values_list('id', 'sku')
+            )
+            for product_id, held in held_stock(existing).items():
+                product = batch[existing[product_id]]
+                product.stock = max(0, product.stock - held)
+            Product.objects.bulk_create(
+                batch.values(),
+                update_conflicts=True,
+                unique_fields=['sku'],
+                update_fields=UPDATE_FIELDS,
+            )
+            # the stock of sharded products lives in their shards, the next reconcile would
+            # overwrite the upserted Product.stock with the old shard sum
+            for sku, product_id, shard_count in sharded:
+                set_stock_shards(product_id, shard_count, batch[sku].stock)
+            # bulk writes skip the post_save receivers, reindex the batch directly
+            update_search_index(Product.objects.filter(sku__in=skus).values_list('id', flat=True))
+        batch.clear()
+        return len(skus)
+
+    def report(self, imported, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'{imported} rows, {imported / elapsed if elapsed else imported:.0f} rows/s')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from app.orders import reconcile_order_totals
+
+
+class Command(BaseCommand):
+    help = "Check the stored order totals against their items and fix the ones that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help="Only report the drift")
+
+    def handle(self, *args, **options):
+        stats = reconcile_order_totals(options['batch_size'], fix=not options['dry_run'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {stats['checked']} orders, {stats['drifted']} drifted, {stats['fixed']} fixed in {stats['seconds']}s"
+        ))
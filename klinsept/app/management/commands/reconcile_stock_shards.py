@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from app.models import Product
+from app.inventory import rebalance_stock_shards
+
+
+class Command(BaseCommand):
+    help = "Even out the stock shards of sharded products and write their sum back to Product.stock"
+
+    def handle(self, *args, **options):
+        product_ids = Product.objects.filter(shard_count__gt=0).order_by('id').values_list('id', flat=True)
+        count = 0
+        for product_id in product_ids:
+            rebalance_stock_shards(product_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Reconciled stock shards for {count} products'))
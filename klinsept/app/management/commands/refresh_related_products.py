@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from app.models import Product, Watermark
+from app.related import TOP_K, refresh_related_products, stale_product_ids
+from app.cache import bump_catalog_version
+
+WATERMARK = 'related_products'
+
+
+class Command(BaseCommand):
+    help = "Refresh the precomputed related products for products changed since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Rebuild every product instead of only stale ones")
+        parser.add_argument('--top-k', type=int, default=TOP_K, help="Neighbours kept per product")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        watermark, _ = Watermark.objects.get_or_create(name=WATERMARK)
+        # take the new watermark before reading so changes made during the run are picked up next time
+        started = timezone.now()
+
+        if options['full'] or watermark.value is None:
+            product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+        else:
+            product_ids = sorted(stale_product_ids(watermark.value))
+
+        refreshed = 0
+        batch_size = options['batch_size']
+        for start in range(0, len(product_ids), batch_size):
+            refreshed += refresh_related_products(product_ids[start:start + batch_size], options['top_k'])
+
+        watermark.value = started
+        watermark.save()
+        if refreshed:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Refreshed related products for {refreshed} products'))
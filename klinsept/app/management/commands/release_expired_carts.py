@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from app.inventory import release_expired_cart_reservations
+
+
+class Command(BaseCommand):
+    help = "Give back the stock held by carts that expired from the cache"
+
+    def handle(self, *args, **options):
+        released = release_expired_cart_reservations()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired cart reservations'))
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from app.models import Order
+from app.emails import RENDER_CHUNK_SIZE, queue_order_confirmations
+from app.reports import day_start
+
+
+def date_arg(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = "Queue the confirmation email again for the given orders, or every order placed in a date range"
+
+    def add_arguments(self, parser):
+        parser.add_argument('order_ids', nargs='*', type=int)
+        parser.add_argument('--start', type=date_arg, help="YYYY-MM-DD, orders placed on or after this day")
+        parser.add_argument('--end', type=date_arg, help="YYYY-MM-DD, orders placed on or before this day")
+        parser.add_argument('--status', choices=['Paid', 'Pending'])
+        parser.add_argument('--chunk-size', type=int, default=RENDER_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if options['order_ids']:
+            order_ids = options['order_ids']
+        elif options['start'] or options['end']:
+            orders = Order.objects.order_by('id')
+            if options['start']:
+                orders = orders.filter(created_at__gte=day_start(options['start']))
+            if options['end']:
+                orders = orders.filter(created_at__lt=day_start(options['end'] + timedelta(days=1)))
+            if options['status']:
+                orders = orders.filter(status=options['status'])
+            order_ids = orders.values_list('id', flat=True)
+        else:
+            raise CommandError("Give order ids or a --start/--end range")
+
+        started = timezone.now()
+        queued = queue_order_confirmations(order_ids, options['chunk_size'])
+        seconds = (timezone.now() - started).total_seconds()
+        self.stdout.write(self.style.SUCCESS(f"Queued {queued} confirmation emails in {seconds:.1f}s, send_outbox delivers them"))
@@ -0,0 +1,26 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app.orders import rollback_pending_orders
+
+
+class Command(BaseCommand):
+    help = "Give back the stock of unpaid pending orders and delete them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.PENDING_ORDER_TTL,
+                            help="Seconds a pending order is kept before it is rolled back")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help="Keep running, one pass every --interval seconds")
+        parser.add_argument('--interval', type=int, default=60)
+
+    def handle(self, *args, **options):
+        while True:
+            stats = rollback_pending_orders(options['older_than'], options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Rolled back {stats['orders']} orders ({stats['items']} items, {stats['units']} units) in "
+                f"{stats['batches']} batches with {stats['stock_updates']} stock updates, {stats['seconds']}s"
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from app.outbox import OUTBOX_BATCH_SIZE, purge_sent_emails, send_outbox
+
+
+class Command(BaseCommand):
+    help = "Deliver queued emails from the outbox in batches over one mail server connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help="Keep running, one pass every --interval seconds")
+        parser.add_argument('--interval', type=int, default=5)
+        parser.add_argument('--keep-days', type=int, default=7, help="Delete sent emails older than this")
+
+    def handle(self, *args, **options):
+        while True:
+            stats = send_outbox(options['batch_size'])
+            purged = purge_sent_emails(options['keep_days'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Sent {stats['sent']} emails in {stats['batches']} batches, {stats['retried']} to retry, "
+                f"{stats['failed']} failed, {purged} old emails purged, {stats['seconds']}s"
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Product
+from app.inventory import set_stock_shards
+
+
+class Command(BaseCommand):
+    help = "Split the stock of hot products over several counter rows, --shards 0 turns it off again"
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='+', type=int)
+        parser.add_argument('--shards', type=int, default=8)
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shards'] <= 256:
+            raise CommandError("--shards must be between 0 and 256")
+        for product_id in options['product_ids']:
+            try:
+                total = set_stock_shards(product_id, options['shards'])
+            except Product.DoesNotExist:
+                raise CommandError(f"Product {product_id} does not exist")
+            self.stdout.write(f"product {product_id}: {total} in stock over {options['shards']} shards")
@@ -1,6 +1,8 @@
 # override the need for username for superadmin
 
 from django.contrib.auth.models import BaseUserManager
+from django.db import models
+from django.db.models import Prefetch
 
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -22,3 +24,45 @@ class CustomUserManager(BaseUserManager):
             raise ValueError("Superuser must have is_superuser=True.")
 
         return self.create_user(email, password, **extra_fields)
+
+
+# product read path, loads related rows in bulk so serializers don't query per row
+class ProductQuerySet(models.QuerySet):
+    def for_serializer(self):
+        # the search vector is never serialized, don't ship it over the wire
+        return self.select_related('category').defer('search_vector')
+
+
+# the items of an order with their products, for prefetch_related / prefetch_related_objects
+def order_items_prefetch():
+    from app.models import OrderItem
+
+    items = OrderItem.objects.select_related('product__category').defer('product__search_vector').order_by('id')
+    return Prefetch('items', queryset=items)
+
+
+# order read path, OrderSerializer and the confirmation email need nothing past these two queries
+class OrderQuerySet(models.QuerySet):
+    def for_serializer(self):
+        return self.select_related('user', 'guest_user', 'shipping_address').prefetch_related(order_items_prefetch())
+
+    # the columns the confirmation email shows, see app/emails.py
+    def for_email(self):
+        from app.models import OrderItem
+
+        items = OrderItem.objects.select_related('product').only(
+            'order_id', 'quantity', 'price', 'line_total', 'product__name'
+        ).order_by('id')
+        return self.select_related('user', 'guest_user', 'shipping_address').only(
+            'tracking_id', 'total_price', 'shipping_cost', 'tax',
+            'user__first_name', 'user__email', 'guest_user__first_name', 'guest_user__email',
+            'shipping_address__street_address', 'shipping_address__city', 'shipping_address__state',
+            'shipping_address__zip_code', 'shipping_address__country',
+        ).prefetch_related(Prefetch('items', queryset=items))
+
+    # list rows, item_count is kept on the order so nothing is joined
+    def summaries(self):
+        return self.only(
+            'id', 'tracking_id', 'status', 'total_price', 'shipping_cost', 'tax', 'item_count', 'created_at',
+            'user_id', 'guest_user_id',
+        )
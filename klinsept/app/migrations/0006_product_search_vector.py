@@ -0,0 +1,54 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:20
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# the GIN index only exists on postgres, sqlite gets an FTS5 table instead (see app/search.py)
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "UPDATE app_product SET search_vector = "
+            "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+        )
+        schema_editor.execute("CREATE INDEX app_product_search_gin ON app_product USING gin (search_vector)")
+    elif schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("CREATE VIRTUAL TABLE app_product_fts USING fts5(name, description)")
+        schema_editor.execute(
+            "INSERT INTO app_product_fts (rowid, name, description) SELECT id, name, description FROM app_product"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS app_product_search_gin")
+    elif schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS app_product_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='product',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='app_product_search_gin'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_search_index, drop_search_index),
+            ],
+        ),
+    ]
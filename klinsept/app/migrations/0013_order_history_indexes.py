@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at'], name='app_order_user_id_7682e1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['guest_user', 'created_at'], name='app_order_guest_u_c2974e_idx'),
+        ),
+    ]
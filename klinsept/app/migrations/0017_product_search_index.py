@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_email_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchIndex',
+            fields=[
+                ('product', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='app.product')),
+            ],
+            options={
+                'db_table': 'app_product_fts',
+                'managed': False,
+            },
+        ),
+    ]
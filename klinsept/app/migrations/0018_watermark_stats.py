@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermark',
+            name='stats',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
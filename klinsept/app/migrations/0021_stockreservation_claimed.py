@@ -0,0 +1,30 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:14
+
+from django.db import migrations, models
+
+
+# holds that already belong to an order item stop being cart holds
+def mark_claimed(apps, schema_editor):
+    StockReservation = apps.get_model('app', 'StockReservation')
+    StockReservation.objects.filter(status='Held', order_item__isnull=False).update(status='Claimed')
+
+
+def mark_held(apps, schema_editor):
+    StockReservation = apps.get_model('app', 'StockReservation')
+    StockReservation.objects.filter(status='Claimed').update(status='Held')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_outbox_email_expiry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockreservation',
+            name='status',
+            field=models.CharField(choices=[('Held', 'Held'), ('Claimed', 'Claimed'), ('Released', 'Released')], default='Held', max_length=20),
+        ),
+        migrations.RunPython(mark_claimed, mark_held),
+    ]
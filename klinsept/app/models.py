@@ -1,10 +1,14 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.expressions import Combinable
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import RegexValidator, MaxValueValidator, MinValueValidator
-from .utility import generate_otp
+from .utility import OTP_LIFETIME, generate_otp
 from datetime import timedelta
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
-from app.managers import CustomUserManager
+from app.managers import CustomUserManager, ProductQuerySet, OrderQuerySet
 
 
 class User(AbstractUser):
@@ -29,7 +33,7 @@ class User(AbstractUser):
 
     def is_otp_valid(self):
         if self.otp_expiration:
-            return timezone.now() < self.otp_expiration + timedelta(minutes=2)
+            return timezone.now() < self.otp_expiration + OTP_LIFETIME
         return False
 
     def __str__(self):
@@ -48,18 +52,48 @@ class Category(models.Model):
 
 
 class Product(models.Model):
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)  # supplier identifier, import_catalog upserts on it
     name = models.CharField(max_length=100)
     description = models.TextField()
     image = models.URLField(max_length=500, blank=True, null=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.IntegerField(default=0, validators=[MinValueValidator(0)])
+    # 0 keeps stock in the row above, otherwise it lives in StockShard rows and stock is their reconciled sum
+    shard_count = models.PositiveSmallIntegerField(default=0)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # weighted name + description vector, kept up to date by app.search.update_search_index
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # keyset pagination walks these, see ProductCursorPagination
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['price', 'id']),
+            GinIndex(fields=['search_vector'], name='app_product_search_gin'),
+            # catalog filters, see app/filters.py
+            models.Index(fields=['category', 'price']),
+            models.Index(fields=['stock']),
+        ]
 
     def __str__(self):
         return self.name
 
+# the sqlite FTS5 table (rowid = product id, see app/search.py), mapped only so search can join it.
+# nothing is created for it, postgres searches Product.search_vector instead
+class ProductSearchIndex(models.Model):
+    product = models.OneToOneField(
+        Product, primary_key=True, db_column='rowid', db_constraint=False, on_delete=models.DO_NOTHING,
+        related_name='search_index',
+    )
+
+    class Meta:
+        managed = False
+        db_table = 'app_product_fts'
+
 class GuestUser(models.Model):
     first_name = models.CharField(max_length=50,null=True,blank=True)
     last_name = models.CharField(max_length=50,null=True,blank=True)
@@ -90,21 +124,57 @@ class Order(models.Model):
     guest_user = models.ForeignKey(GuestUser, on_delete=models.CASCADE, related_name='orders', null=True, blank=True)
     shipping_address = models.ForeignKey(ShippingAddress, on_delete=models.CASCADE, related_name='orders',null=True, blank=True)
     total_price = models.DecimalField(max_digits=10, decimal_places=2,default=0.00)
+    # sum of the items' line_total and their number, kept up to date with F() updates as items are
+    # saved or deleted (see app/signals.py), reconcile_order_totals fixes any drift
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    item_count = models.PositiveIntegerField(default=0)
     status = models.CharField(max_length=50,choices=[('Paid','Paid'),('Pending','Pending')],default="Pending") 
     shipping_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     tax = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     tracking_id = models.CharField(max_length=20,unique=True,blank=True,null=True)
+    # Idempotency-Key of the create_order request, a retry with the same key gets this order back
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     # to be added shipping cost and tax if provided by client
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # order history, see get_user_orders
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['guest_user', 'created_at']),
+            # sales rollups, days are read by created_at and changes found by updated_at (see app/reports.py)
+            models.Index(fields=['created_at']),
+            models.Index(fields=['updated_at']),
+        ]
+
+    # moved by F() updates, not by saving the instance
+    TOTAL_FIELDS = ('subtotal', 'item_count', 'total_price')
+
     def save(self, *args, **kwargs):
-        # Calculate the subtotal (sum of line_total from all order items)
+        # the subtotal is maintained as items change, add shipping cost and tax
         if not self.total_price:
-            order_subtotal = sum(item.line_total for item in self.items.all())
-            # Add shipping cost and tax
-            self.total_price = order_subtotal + self.shipping_cost + self.tax
+            self.total_price = self.subtotal + self.shipping_cost + self.tax
+        # an instance loaded before its items changed holds old totals, a full row save would write
+        # them over the F() updates. existing orders only save the totals when update_fields names them
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTAL_FIELDS
+            ]
+        # a new shipping cost or tax moves the total, added to the subtotal the row holds
+        if {'shipping_cost', 'tax'} & set(update_fields) and 'total_price' not in update_fields:
+            self.total_price = F('subtotal') + self.shipping_cost + self.tax
+            update_fields = [*update_fields, 'total_price']
+        kwargs['update_fields'] = update_fields
         super().save(*args, **kwargs)
+        if isinstance(self.total_price, Combinable):
+            self.refresh_from_db(fields=self.TOTAL_FIELDS)
     
     def __str__(self):
         user_email = self.user.email if self.user else (self.guest_user.email if self.guest_user else "Guest")
@@ -132,6 +202,13 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
+    # remember what the order totals already count for this row, the signals apply the difference
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._counted = (instance.__dict__.get('order_id'), instance.__dict__.get('line_total'))
+        return instance
+
     def save(self, *args, **kwargs):
         # Calculate line_total as quantity * price before saving
         self.line_total = self.quantity * self.price  
@@ -168,3 +245,126 @@ class Review(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
 
+# stock taken out of Product.stock for a cart line, see app/inventory.py
+class StockReservation(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    order_item = models.ForeignKey(OrderItem, on_delete=models.SET_NULL, related_name='reservations', null=True, blank=True)
+    quantity = models.IntegerField(validators=[MinValueValidator(1)])
+    # Held by a cart, Claimed once an order item owns it (until the order is paid or rolled back), Released when given back.
+    # cart expiry only ever looks at Held, a claimed hold stays put even if its order item is deleted
+    status = models.CharField(max_length=20, choices=[('Held','Held'),('Claimed','Claimed'),('Released','Released')], default='Held')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} ({self.status})"
+
+
+# a slice of a hot product's stock, reservations spread over the shards instead of queueing on one row
+class StockShard(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards')
+    shard = models.PositiveSmallIntegerField()
+    quantity = models.IntegerField(default=0, validators=[MinValueValidator(0)])
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'shard'], name='unique_stock_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}/{self.shard}: {self.quantity}"
+
+
+# top-K neighbours per product, filled by the refresh_related_products command (see app/related.py)
+class RelatedProduct(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'rank']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='unique_related_product'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.related_id} ({self.rank})"
+
+
+# paid sales per day, overall, per product and per category, filled by refresh_sales_rollups
+class DailySales(models.Model):
+    DIMENSIONS = [('all', 'All'), ('product', 'Product'), ('category', 'Category')]
+
+    day = models.DateField()
+    dimension = models.CharField(max_length=10, choices=DIMENSIONS)
+    dimension_id = models.PositiveIntegerField(default=0)  # product or category id, 0 for all
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # sum of line totals
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dimension', 'dimension_id', 'day']),
+            models.Index(fields=['dimension', 'day']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'dimension', 'dimension_id'], name='unique_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.dimension}:{self.dimension_id} {self.revenue}"
+
+
+# a day that lost a paid order since the last rollup refresh, the order itself is gone so
+# refresh_sales_rollups can't find the day from the orders table
+class StaleSalesDay(models.Model):
+    day = models.DateField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.day)
+
+
+# last processed timestamp for incremental jobs, and what their last run did
+class Watermark(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    value = models.DateTimeField(null=True, blank=True)
+    stats = models.JSONField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+# transactional email written by requests and delivered by the send_outbox command (see app/outbox.py)
+class OutboxEmail(models.Model):
+    STATUSES = [('Pending', 'Pending'), ('Sent', 'Sent'), ('Failed', 'Failed')]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+    html = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254, blank=True)  # blank sends from DEFAULT_FROM_EMAIL
+    recipients = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUSES, default='Pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # due time, pushed forward while a worker holds the email and by the retry backoff
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # not sent at all after this, e.g. an otp that is no longer valid
+    expires_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.recipients)} ({self.status})"
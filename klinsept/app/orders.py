@@ -0,0 +1,137 @@
+# order jobs that run off the request path
+# pending orders that were never paid give their stock back and are deleted, a batch at a time,
+# with one UPDATE per product and one bulk delete per batch.
+# order totals (subtotal, item_count, total_price) move with F() updates as items change and
+# are recomputed from the items with subqueries when they need checking
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Abs, Coalesce
+from django.utils import timezone
+from app.models import Order, OrderItem, StockReservation, Watermark
+from app.inventory import give_back_stock
+
+ROLLBACK_WATERMARK = 'orders_rollback'
+
+
+def rollback_order_batch(order_ids):
+    with transaction.atomic():
+        # an order could have been paid since it was picked, only roll back what is still pending
+        order_ids = list(
+            Order.objects.select_for_update().filter(id__in=order_ids, status='Pending').values_list('id', flat=True)
+        )
+        if not order_ids:
+            return {'orders': 0, 'items': 0, 'units': 0, 'stock_updates': 0}
+
+        totals = (
+            OrderItem.objects.filter(order_id__in=order_ids)
+            .values('product_id')
+            .annotate(total=Sum('quantity'))
+            .order_by('product_id')
+        )
+        now = timezone.now()
+        units = stock_updates = 0
+        for row in totals:
+            give_back_stock(row['product_id'], row['total'], now)
+            stock_updates += 1
+            units += row['total']
+        # the stock is back, the order's reservations must never give it back a second time
+        StockReservation.objects.filter(order_item__order_id__in=order_ids, status='Claimed').update(
+            status='Released', updated_at=now
+        )
+        _, deleted = Order.objects.filter(id__in=order_ids).delete()
+        items = deleted.get(OrderItem._meta.label, 0)
+    return {'orders': len(order_ids), 'items': items, 'units': units, 'stock_updates': stock_updates}
+
+
+# returns the run metrics, the last run is also kept in its Watermark row for rollback_stats()
+def rollback_pending_orders(older_than=None, batch_size=500):
+    older_than = settings.PENDING_ORDER_TTL if older_than is None else older_than
+    started = time.monotonic()
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    expired = Order.objects.filter(status='Pending', created_at__lte=cutoff).order_by('id')
+
+    stats = {'orders': 0, 'items': 0, 'units': 0, 'stock_updates': 0, 'batches': 0}
+    last_id = 0
+    while True:
+        order_ids = list(expired.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+        if not order_ids:
+            break
+        last_id = order_ids[-1]
+        for key, value in rollback_order_batch(order_ids).items():
+            stats[key] += value
+        stats['batches'] += 1
+
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    finished_at = timezone.now()
+    stats['finished_at'] = finished_at.isoformat()
+    Watermark.objects.update_or_create(name=ROLLBACK_WATERMARK, defaults={'value': finished_at, 'stats': stats})
+    return stats
+
+
+def rollback_stats():
+    return Watermark.objects.filter(name=ROLLBACK_WATERMARK).values_list('stats', flat=True).first()
+
+
+def adjust_order_totals(order_id, line_total, item_count):
+    if order_id is None or not (line_total or item_count):
+        return
+    Order.objects.filter(id=order_id).update(
+        subtotal=F('subtotal') + line_total,
+        total_price=F('total_price') + line_total,
+        item_count=F('item_count') + item_count,
+        updated_at=timezone.now(),
+    )
+
+
+# the real subtotal and item count of the outer order, for annotate() and update()
+def order_total_subqueries():
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    subtotal = Coalesce(
+        Subquery(items.annotate(total=Sum('line_total')).values('total')), Value(Decimal('0.00')),
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+    item_count = Coalesce(Subquery(items.annotate(count=Count('id')).values('count')), Value(0))
+    return subtotal, item_count
+
+
+def recompute_order_totals(orders):
+    subtotal, item_count = order_total_subqueries()
+    return orders.update(
+        subtotal=subtotal, item_count=item_count,
+        total_price=subtotal + F('shipping_cost') + F('tax'), updated_at=timezone.now(),
+    )
+
+
+# orders whose stored totals don't match their items, half a cent of slack for backends
+# that sum decimals as floats
+def drifted_orders(orders):
+    subtotal, item_count = order_total_subqueries()
+    return orders.annotate(actual_subtotal=subtotal, actual_count=item_count).annotate(
+        subtotal_drift=Abs(F('subtotal') - F('actual_subtotal')),
+        total_drift=Abs(F('total_price') - F('actual_subtotal') - F('shipping_cost') - F('tax')),
+    ).filter(
+        ~Q(item_count=F('actual_count')) | Q(subtotal_drift__gte=Decimal('0.005')) | Q(total_drift__gte=Decimal('0.005'))
+    )
+
+
+# walks every order in id batches, one query to find the drifted ones and one UPDATE to fix them
+def reconcile_order_totals(batch_size=1000, fix=True):
+    started = time.monotonic()
+    stats = {'checked': 0, 'drifted': 0, 'fixed': 0}
+    last_id = 0
+    while True:
+        order_ids = list(Order.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not order_ids:
+            break
+        last_id = order_ids[-1]
+        drifted = list(drifted_orders(Order.objects.filter(id__in=order_ids)).values_list('id', flat=True))
+        stats['checked'] += len(order_ids)
+        stats['drifted'] += len(drifted)
+        if fix and drifted:
+            stats['fixed'] += recompute_order_totals(Order.objects.filter(id__in=drifted))
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
@@ -0,0 +1,132 @@
+# transactional email off the request path
+# requests write OutboxEmail rows inside their own transaction (queue_email), so an email goes out
+# exactly when the change it reports was committed and no request waits on the mail server.
+# send_outbox claims due rows a batch at a time and delivers them over one reused connection,
+# failed sends are retried with exponential backoff until MAX_ATTEMPTS or the email's expires_at.
+# once an email is sent or given up its body is cleared, the outbox doesn't keep otps or receipts
+import time
+from datetime import timedelta
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+from app.models import OutboxEmail
+
+OUTBOX_BATCH_SIZE = 100
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30  # doubled after every failed attempt
+RETRY_MAX_SECONDS = 3600
+# a claimed batch stays with its worker this long, a worker that dies lets it come back after that.
+# a slow batch renews the claim on what is left once half of it has gone
+CLAIM_SECONDS = 300
+
+
+# unsaved, for callers that bulk_create many at once
+def outbox_email(subject, recipients, body='', html='', from_email='', expires_at=None):
+    return OutboxEmail(subject=subject, recipients=list(recipients), body=body, html=html, from_email=from_email or '',
+                       expires_at=expires_at)
+
+
+def queue_email(subject, recipients, body='', html='', from_email='', expires_at=None):
+    email = outbox_email(subject, recipients, body, html, from_email, expires_at)
+    email.save()
+    return email
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+# due emails for this worker, pushed out of the other workers' reach before the lock is let go
+def claim_batch(batch_size, now):
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='Pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if emails:
+            extend_claim(emails, now)
+    return emails
+
+
+def extend_claim(emails, now):
+    OutboxEmail.objects.filter(id__in=[email.id for email in emails], status='Pending').update(
+        next_attempt_at=now + timedelta(seconds=CLAIM_SECONDS)
+    )
+
+
+def build_message(email, connection):
+    message = EmailMultiAlternatives(
+        subject=email.subject, body=email.body, from_email=email.from_email or None, to=email.recipients,
+        connection=connection,
+    )
+    if email.html:
+        message.attach_alternative(email.html, 'text/html')
+    return message
+
+
+def send_batch(emails, connection):
+    stats = {'sent': 0, 'retried': 0, 'failed': 0}
+    renew_at = timezone.now() + timedelta(seconds=CLAIM_SECONDS / 2)
+    for index, email in enumerate(emails):
+        now = timezone.now()
+        if now >= renew_at:
+            extend_claim(emails[index:], now)
+            renew_at = now + timedelta(seconds=CLAIM_SECONDS / 2)
+        if email.expires_at and email.expires_at <= now:
+            email.status = 'Failed'
+            email.last_error = 'Expired before it could be sent'
+            stats['failed'] += 1
+            continue
+
+        email.attempts += 1
+        try:
+            connection.open()  # no-op while the connection is up
+            build_message(email, connection).send()
+        except Exception as error:
+            email.last_error = f"{type(error).__name__}: {error}"
+            retry_at = timezone.now() + retry_delay(email.attempts)
+            if email.attempts >= MAX_ATTEMPTS or (email.expires_at and retry_at >= email.expires_at):
+                email.status = 'Failed'
+                stats['failed'] += 1
+            else:
+                email.next_attempt_at = retry_at
+                stats['retried'] += 1
+            # the failure may have been the connection, the next email reconnects
+            connection.close()
+        else:
+            email.status = 'Sent'
+            email.sent_at = timezone.now()
+            email.last_error = ''
+            stats['sent'] += 1
+    OutboxEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    # nothing will read the content again
+    done = [email.id for email in emails if email.status != 'Pending']
+    if done:
+        OutboxEmail.objects.filter(id__in=done).update(body='', html='')
+    return stats
+
+
+# delivers everything that is due, max_batches bounds one run
+def send_outbox(batch_size=OUTBOX_BATCH_SIZE, max_batches=None):
+    started = time.monotonic()
+    stats = {'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0}
+    connection = get_connection()
+    try:
+        while max_batches is None or stats['batches'] < max_batches:
+            emails = claim_batch(batch_size, timezone.now())
+            if not emails:
+                break
+            for key, value in send_batch(emails, connection).items():
+                stats[key] += value
+            stats['batches'] += 1
+    finally:
+        connection.close()
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def purge_sent_emails(older_than_days):
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    deleted, _ = OutboxEmail.objects.filter(status='Sent', sent_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,78 @@
+# keyset cursor pagination over a (field, id) ordering
+# drf's CursorPagination only filters on the first ordering field and walks ties with an OFFSET,
+# so a page deep inside a run of equal prices scans the whole run. here the cursor position holds
+# both values and the page filters on (field > v) OR (field = v AND id > i), which the
+# (field, id) indexes answer directly whatever the number of ties
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+POSITION_SEPARATOR = '|'
+
+
+class KeysetCursorPagination(CursorPagination):
+    # ordering must be exactly two fields in the same direction, the second one unique
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = [
+            instance[field.lstrip('-')] if isinstance(instance, dict) else getattr(instance, field.lstrip('-'))
+            for field in ordering
+        ]
+        return POSITION_SEPARATOR.join(str(value) for value in values)
+
+    def keyset_filter(self, position, reverse):
+        value, separator, last_id = position.rpartition(POSITION_SEPARATOR)
+        if not separator:
+            raise NotFound(self.invalid_cursor_message)
+        field, tiebreak = (name.lstrip('-') for name in self.ordering)
+        # (cursor reversed) XOR (ordering descending) walks towards smaller values
+        lookup = 'lt' if reverse != self.ordering[0].startswith('-') else 'gt'
+        return Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'{tiebreak}__{lookup}': last_id})
+
+    # CursorPagination.paginate_queryset with the keyset filter, links and offsets are drf's
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+
+        queryset = queryset.order_by(*(_reverse_ordering(self.ordering) if reverse else self.ordering))
+        try:
+            if current_position is not None:
+                queryset = queryset.filter(self.keyset_filter(current_position, reverse))
+            results = list(queryset[offset:offset + self.page_size + 1])
+        except (ValidationError, ValueError):
+            # a hand made cursor with a value the column can't hold
+            raise NotFound(self.invalid_cursor_message)
+        self.page = results[:self.page_size]
+
+        has_following_position = len(results) > len(self.page)
+        following_position = (
+            self._get_position_from_instance(results[-1], self.ordering) if has_following_position else None
+        )
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None or offset > 0
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
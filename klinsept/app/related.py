@@ -0,0 +1,96 @@
+# precomputed related products
+# each product keeps its TOP_K best neighbours in RelatedProduct, scored on
+# co-occurrence in orders, same category and price proximity
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Count, Q
+from app.models import Product, OrderItem, RelatedProduct
+
+TOP_K = 20
+CO_OCCURRENCE_WEIGHT = 0.5
+CATEGORY_WEIGHT = 0.3
+PRICE_WEIGHT = 0.2
+
+
+def price_proximity(a, b):
+    high = max(a, b)
+    if not high:
+        return 1.0
+    return 1.0 - min(float(abs(a - b) / high), 1.0)
+
+
+def _co_occurrence(product_id, limit):
+    orders = OrderItem.objects.filter(product_id=product_id, order__isnull=False).values('order_id')
+    rows = (
+        OrderItem.objects.filter(order_id__in=orders)
+        .exclude(product_id=product_id)
+        .values('product_id')
+        .annotate(orders=Count('order_id', distinct=True))
+        .order_by('-orders')[:limit]
+    )
+    return {row['product_id']: row['orders'] for row in rows}
+
+
+def _price_neighbours(product, limit):
+    # both walks use the (category, price) index so large categories stay cheap
+    same_category = Product.objects.filter(category_id=product.category_id).exclude(id=product.id)
+    above = same_category.filter(price__gte=product.price).order_by('price').values('id', 'price', 'category_id')[:limit]
+    below = same_category.filter(price__lt=product.price).order_by('-price').values('id', 'price', 'category_id')[:limit]
+    return list(above) + list(below)
+
+
+def rank_related(product, top_k=TOP_K):
+    co_counts = _co_occurrence(product.id, top_k * 2)
+    candidates = {row['id']: row for row in _price_neighbours(product, top_k * 2)}
+    missing = set(co_counts) - set(candidates)
+    if missing:
+        for row in Product.objects.filter(id__in=missing).values('id', 'price', 'category_id'):
+            candidates[row['id']] = row
+
+    most_co = max(co_counts.values(), default=0)
+    scored = []
+    for candidate_id, row in candidates.items():
+        score = (
+            CO_OCCURRENCE_WEIGHT * (co_counts.get(candidate_id, 0) / most_co if most_co else 0.0)
+            + CATEGORY_WEIGHT * (1.0 if row['category_id'] == product.category_id else 0.0)
+            + PRICE_WEIGHT * price_proximity(Decimal(product.price), Decimal(row['price']))
+        )
+        scored.append((score, candidate_id))
+    scored.sort(key=lambda pair: (-pair[0], pair[1]))
+    return scored[:top_k]
+
+
+def refresh_related_products(product_ids, top_k=TOP_K):
+    products = list(Product.objects.filter(id__in=product_ids).only('id', 'price', 'category_id'))
+    rows = []
+    for product in products:
+        for rank, (score, related_id) in enumerate(rank_related(product, top_k), start=1):
+            rows.append(RelatedProduct(product_id=product.id, related_id=related_id, rank=rank, score=score))
+
+    with transaction.atomic():
+        RelatedProduct.objects.filter(product_id__in=[product.id for product in products]).delete()
+        RelatedProduct.objects.bulk_create(rows)
+    return len(products)
+
+
+# products whose lists may be stale since the last run: changed products, lists that point at
+# a changed product, and products in orders placed since then. products added to a category
+# only show up in their neighbours' lists after a full refresh
+def stale_product_ids(since):
+    changed = set(Product.objects.filter(updated_at__gt=since).values_list('id', flat=True))
+    pointing = set(RelatedProduct.objects.filter(related_id__in=changed).values_list('product_id', flat=True))
+    ordered = set(
+        OrderItem.objects.filter(Q(order__created_at__gt=since) | Q(order__updated_at__gt=since))
+        .values_list('product_id', flat=True)
+    )
+    return changed | pointing | ordered
+
+
+def get_related_products(product_id, limit):
+    entries = (
+        RelatedProduct.objects.filter(product_id=product_id)
+        .select_related('related__category')
+        .defer('related__search_vector')
+        .order_by('rank')[:limit]
+    )
+    return [entry.related for entry in entries]
@@ -0,0 +1,117 @@
+# daily sales rollups
+# dashboards only read DailySales. refreshing rebuilds whole days from the paid orders, so a day
+# always matches its orders exactly, however they changed. revenue is the sum of line totals,
+# so product and category rows add up to the day's total
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from app.models import Order, OrderItem, DailySales, StaleSalesDay
+
+MAX_RUN_DAYS = 31
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+# days holding an order that changed after since
+def changed_days(since):
+    orders = Order.objects.filter(updated_at__gt=since) if since else Order.objects.all()
+    days = orders.annotate(day=TruncDate('created_at')).values_list('day', flat=True).order_by().distinct()
+    return sorted(set(days))
+
+
+# (ids, days) of the days that lost a paid order, the ids are deleted once the days are rebuilt
+def stale_days():
+    stale = list(StaleSalesDay.objects.values_list('id', 'day'))
+    return [stale_id for stale_id, _ in stale], {day for _, day in stale}
+
+
+# consecutive days are refreshed together, a handful of grouped queries per run of days
+def day_runs(days):
+    run = []
+    for day in sorted(days):
+        if run and (day - run[-1] != timedelta(days=1) or len(run) == MAX_RUN_DAYS):
+            yield run
+            run = []
+        run.append(day)
+    if run:
+        yield run
+
+
+def refresh_daily_sales(days):
+    rows = 0
+    for run in day_runs(days):
+        rows += _refresh_run(run[0], run[-1])
+    return rows
+
+
+# every day from scratch, days that no longer have orders lose their rows too
+def rebuild_daily_sales():
+    with transaction.atomic():
+        DailySales.objects.all().delete()
+        days = changed_days(None)
+        return days, refresh_daily_sales(days)
+
+
+def _refresh_run(first, last):
+    start, end = day_start(first), day_start(last + timedelta(days=1))
+    orders = Order.objects.filter(status='Paid', created_at__gte=start, created_at__lt=end)
+    items = OrderItem.objects.filter(order__in=orders).annotate(day=TruncDate('order__created_at'))
+    totals = {'revenue': Sum('line_total'), 'orders': Count('order_id', distinct=True), 'units': Sum('quantity')}
+
+    order_counts = dict(
+        orders.annotate(day=TruncDate('created_at')).values('day').annotate(count=Count('id')).order_by().values_list('day', 'count')
+    )
+    rows = []
+    for row in items.values('day').annotate(**totals).order_by():
+        rows.append(DailySales(day=row['day'], dimension='all', revenue=row['revenue'],
+                               orders=order_counts.get(row['day'], row['orders']), units=row['units']))
+    for dimension, field in (('product', 'product_id'), ('category', 'product__category_id')):
+        for row in items.values('day', field).annotate(**totals).order_by():
+            rows.append(DailySales(day=row['day'], dimension=dimension, dimension_id=row[field],
+                                   revenue=row['revenue'], orders=row['orders'], units=row['units']))
+
+    with transaction.atomic():
+        DailySales.objects.filter(day__gte=first, day__lte=last).delete()
+        DailySales.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def average_basket(revenue, orders):
+    return (Decimal(revenue) / orders).quantize(Decimal('0.01')) if orders else Decimal('0.00')
+
+
+def _with_average(row):
+    row['average_basket'] = average_basket(row['revenue'], row['orders'])
+    return row
+
+
+# one row per day with sales, for the whole shop or one product / category
+def sales_by_day(start, end, dimension='all', dimension_id=0):
+    rows = (
+        DailySales.objects.filter(dimension=dimension, dimension_id=dimension_id, day__gte=start, day__lte=end)
+        .order_by('day').values('day', 'revenue', 'orders', 'units')
+    )
+    return [_with_average(row) for row in rows]
+
+
+# best selling products or categories over the range
+def top_sellers(start, end, dimension, limit):
+    rows = (
+        DailySales.objects.filter(dimension=dimension, day__gte=start, day__lte=end)
+        .values('dimension_id')
+        .annotate(revenue=Sum('revenue'), orders=Sum('orders'), units=Sum('units'))
+        .order_by('-revenue', 'dimension_id')[:limit]
+    )
+    return [_with_average({'id': row.pop('dimension_id'), **row}) for row in rows]
+
+
+def range_totals(rows):
+    revenue = sum((row['revenue'] for row in rows), Decimal('0.00'))
+    orders = sum(row['orders'] for row in rows)
+    units = sum(row['units'] for row in rows)
+    return {'revenue': revenue, 'orders': orders, 'units': units, 'average_basket': average_basket(revenue, orders)}
@@ -0,0 +1,81 @@
+# product full text search
+# postgres keeps a weighted tsvector on Product with a GIN index, sqlite keeps an FTS5 table
+# (app_product_fts, rowid = product id) so the same endpoint can be tested without postgres
+import re
+from django.db import connection
+from django.db.models import BooleanField, F, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'english'
+FTS_TABLE = 'app_product_fts'
+
+# name matches outrank description matches
+POSTGRES_VECTOR_SQL = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def _fts5_query(terms):
+    # quote every word so user input can't inject fts5 syntax, prefix match the words
+    words = re.findall(r'\w+', terms)
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+def update_search_index(product_ids):
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                f"UPDATE app_product SET search_vector = {POSTGRES_VECTOR_SQL} WHERE id IN ({placeholders})",
+                product_ids,
+            )
+        elif connection.vendor == 'sqlite':
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", product_ids)
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+                f"SELECT id, name, description FROM app_product WHERE id IN ({placeholders})",
+                product_ids,
+            )
+
+
+def remove_from_search_index(product_ids):
+    # postgres drops the vector with the row
+    product_ids = list(product_ids)
+    if connection.vendor != 'sqlite' or not product_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", product_ids)
+
+
+# returns the matching products best match first, terms is raw user input
+def search_products(queryset, terms):
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        query = SearchQuery(terms, config=SEARCH_CONFIG, search_type='websearch')
+        return (
+            queryset.filter(search_vector=query)
+            .annotate(rank=SearchRank(F('search_vector'), query))
+            .order_by('-rank', 'id')
+        )
+
+    if connection.vendor == 'sqlite':
+        match = _fts5_query(terms)
+        if not match:
+            return queryset.none()
+        # the index table is joined once (ProductSearchIndex) instead of a correlated subquery per row,
+        # bm25 is lower for better matches and weights name over description like the postgres vector
+        return (
+            queryset.filter(search_index__isnull=False)
+            .filter(RawSQL(f"{FTS_TABLE} MATCH %s", (match,), output_field=BooleanField()))
+            .annotate(rank=RawSQL(f"bm25({FTS_TABLE}, 10.0, 1.0)", (), output_field=FloatField()))
+            .order_by('rank', 'id')
+        )
+
+    # no search index on other databases, plain scan
+    return queryset.filter(Q(name__icontains=terms) | Q(description__icontains=terms)).order_by('id')
@@ -49,6 +49,7 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields = ['id', 'name', 'description', 'image', 'price', 'stock', 'category', 'created_at', 'updated_at']
 
+    # reads the preloaded category, query with Product.objects.for_serializer() to avoid a query per row
     def get_category(self, obj):
         return [obj.category.name]  
     
@@ -60,6 +61,19 @@ class OrderItemSerializer(serializers.ModelSerializer):
         model = OrderItem
         fields = ['id', 'product', 'quantity', 'price', 'line_total']
 
+# a line of the cache backed cart, id is the product id
+class CartItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    product = ProductSerializer(read_only=True)
+    quantity = serializers.IntegerField()
+    price = serializers.DecimalField(max_digits=10, decimal_places=2)
+    line_total = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+class CartSerializer(serializers.Serializer):
+    cart = CartItemSerializer(many=True)
+    count = serializers.IntegerField()
+    total = serializers.DecimalField(max_digits=12, decimal_places=2)
+
 class ShippingAddressSerializer(serializers.ModelSerializer):
     class Meta:
         model = ShippingAddress
@@ -75,6 +89,22 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ['id', 'user','guest_user', 'items','shipping_cost','tax', 'total_price','shipping_address','tracking_id']
 
+# order history row, no nested items or products, query with Order.objects.summaries()
+class OrderSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ['id', 'tracking_id', 'status', 'total_price', 'shipping_cost', 'tax', 'item_count', 'created_at']
+
+
+# a DailySales row, or a product / category summed over a range (id set instead of day)
+class SalesRowSerializer(serializers.Serializer):
+    day = serializers.DateField(required=False)
+    id = serializers.IntegerField(required=False)
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    orders = serializers.IntegerField()
+    units = serializers.IntegerField()
+    average_basket = serializers.DecimalField(max_digits=14, decimal_places=2)
+
 
 class PaymentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,63 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from app.models import Product, Category, Order, OrderItem, StaleSalesDay
+from app.cache import bump_catalog_version
+from app.search import update_search_index, remove_from_search_index
+from app.orders import adjust_order_totals, recompute_order_totals
+
+
+# any catalog write invalidates every cached catalog response
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    # stock or price only saves don't touch the indexed text
+    if update_fields and not {'name', 'description'} & set(update_fields):
+        return
+    update_search_index([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    remove_from_search_index([instance.pk])
+
+
+# order totals follow their items with F() updates, bulk_create and queryset.update() skip this,
+# callers set the totals themselves (create_order) or run reconcile_order_totals
+@receiver(post_save, sender=OrderItem)
+def count_order_item(sender, instance, created, **kwargs):
+    counted_order_id, counted_total = (None, None) if created else getattr(instance, '_counted', (None, None))
+    if created:
+        adjust_order_totals(instance.order_id, instance.line_total, 1)
+    elif counted_total is None:
+        # saved without being loaded first, nothing to diff against
+        recompute_order_totals(Order.objects.filter(id=instance.order_id))
+    elif counted_order_id == instance.order_id:
+        adjust_order_totals(instance.order_id, instance.line_total - counted_total, 0)
+    else:
+        adjust_order_totals(counted_order_id, -counted_total, -1)
+        adjust_order_totals(instance.order_id, instance.line_total, 1)
+    instance._counted = (instance.order_id, instance.line_total)
+
+
+@receiver(post_delete, sender=OrderItem)
+def uncount_order_item(sender, instance, origin=None, **kwargs):
+    # the order itself is being deleted
+    if getattr(origin, 'model', type(origin)) is Order:
+        return
+    order_id, line_total = getattr(instance, '_counted', (instance.order_id, instance.line_total))
+    adjust_order_totals(order_id, -line_total, -1)
+
+
+# a deleted paid order leaves its day's sales rollup behind, refresh_sales_rollups rebuilds it
+@receiver(post_delete, sender=Order)
+def mark_sales_day_stale(sender, instance, **kwargs):
+    if instance.status == 'Paid' and instance.created_at:
+        StaleSalesDay.objects.create(day=timezone.localdate(instance.created_at))
@@ -1,3 +1,1777 @@
-from django.test import TestCase
+import base64
+import csv
+import json
+import os
+import smtplib
+import tempfile
+import threading
+import time
+from io import StringIO
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.utils import timezone
+from django.db.models import Sum
+from app.models import (
+    Category, Product, Order, OrderItem, User, GuestUser, Payment, Review, ShippingAddress, StockReservation, StockShard,
+    DailySales, OutboxEmail, StaleSalesDay,
+)
+from app.inventory import claim_reservations, give_back_stock, reserve_stock, set_stock_shards, InsufficientStock
+from app.cache import catalog_cache_stats
+from app.orders import rollback_pending_orders
+from app import utility
+from app.utility import generate_tracking_id, tracking_worker_id
+from app.checks import check_tracking_worker_id
+from app.admin import EstimatedCountPaginator
+from app.exports import export_orders, stream_orders
+from app import outbox
+from app.outbox import claim_batch, send_batch, send_outbox, queue_email, MAX_ATTEMPTS
+from app.emails import queue_order_confirmations
+from app import cart as cart_module
+from app.cart import CartBusy, CartStore
+from app.management.commands.generate_load_data import MAX_SEED
 
-# Create your tests here.
+
+# api requests carry the key, and the cache (catalog responses, carts) starts out empty
+class ApiTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.headers = {'HTTP_X_API_KEY': settings.API_KEY}
+
+
+class ProductReadQueryTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        categories = [Category.objects.create(name=f"Category {i}") for i in range(5)]
+        self.products = [
+            Product.objects.create(
+                name=f"Product {i}", description="desc", price=10 + i, stock=5,
+                category=categories[i % len(categories)]
+            )
+            for i in range(30)
+        ]
+
+    def test_product_list_query_count_is_constant(self):
+        # one COUNT for the paginator and one SELECT joined with category
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('get_products'), {'page_size': 30}, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 30)
+        self.assertEqual(response.data['results'][0]['category'], [self.products[0].category.name])
+
+    def test_product_detail_query_count(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get_individual_product', args=[self.products[0].id]), **self.headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_related_products_query_count(self):
+        call_command('refresh_related_products', stdout=StringIO())
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get_related_products', args=[self.products[0].id]), **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 5)
+
+    def test_missing_products_are_404(self):
+        missing = Product.objects.order_by('-id').first().id + 1
+        for name in ('get_individual_product', 'get_related_products'):
+            response = self.client.get(reverse(name, args=[missing]), **self.headers)
+            self.assertEqual(response.status_code, 404)
+
+
+class ProductCursorPaginationTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Books")
+        # repeated prices so the id tie breaker is exercised
+        for i in range(25):
+            Product.objects.create(name=f"Book {i}", description="desc", price=5 + i % 4, stock=1, category=category)
+
+    def walk(self, params):
+        ids = []
+        url = reverse('get_products')
+        response = self.client.get(url, params, **self.headers)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data['results'])
+            if not response.data['next']:
+                return ids, response
+            response = self.client.get(response.data['next'], **self.headers)
+
+    def test_cursor_walk_returns_every_product_once(self):
+        ids, response = self.walk({'pagination': 'cursor', 'page_size': 10})
+        self.assertEqual(sorted(ids), sorted(Product.objects.values_list('id', flat=True)))
+        self.assertNotIn('count', response.data)
+
+    def test_cursor_orders_by_price(self):
+        ids, _ = self.walk({'pagination': 'cursor', 'ordering': 'price', 'page_size': 7})
+        expected = list(Product.objects.order_by('price', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_cursor_pages_filter_on_price_and_id_without_offset(self):
+        url = reverse('get_products')
+        first = self.client.get(url, {'pagination': 'cursor', 'ordering': 'price', 'page_size': 4}, **self.headers)
+        with CaptureQueriesContext(connection) as captured:
+            second = self.client.get(first.data['next'], **self.headers)
+        self.assertNotIn('OFFSET', captured[0]['sql'])
+        back = self.client.get(second.data['previous'], **self.headers)
+        self.assertEqual([item['id'] for item in back.data['results']], [item['id'] for item in first.data['results']])
+
+        ids = [item['id'] for item in second.data['results']]
+        expected = list(Product.objects.order_by('price', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected[4:8])
+
+    def test_forged_cursor_is_not_found(self):
+        cursor = base64.b64encode(b'p=cheap%7C1').decode()
+        response = self.client.get(reverse('get_products'),
+                                   {'pagination': 'cursor', 'ordering': 'price', 'cursor': cursor}, **self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_page_skips_count_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get_products'), {'pagination': 'cursor'}, **self.headers)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_cursor_count_is_optional(self):
+        response = self.client.get(reverse('get_products'), {'pagination': 'cursor', 'count': 'true'}, **self.headers)
+        self.assertEqual(response.data['count'], 25)
+
+    def test_page_number_contract_is_kept(self):
+        response = self.client.get(reverse('get_products'), {'page': 2}, **self.headers)
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 10)
+
+
+class CatalogCacheTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name="Garden")
+        self.product = Product.objects.create(name="Rake", description="desc", price=12, stock=4, category=self.category)
+
+    def test_repeated_reads_are_served_from_cache(self):
+        url = reverse('get_individual_product', args=[self.product.id])
+        self.client.get(url, **self.headers)
+        # the live stock is the only query of a hit
+        with self.assertNumQueries(1):
+            response = self.client.get(url, **self.headers)
+        self.assertEqual(response.data['name'], "Rake")
+        self.assertEqual(catalog_cache_stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_stock_moves_keep_cached_responses(self):
+        detail = reverse('get_individual_product', args=[self.product.id])
+        listing = reverse('get_products')
+        other = Product.objects.create(name="Hoe", description="desc", price=9, stock=2, category=self.category)
+        other_etag = self.client.get(reverse('get_individual_product', args=[other.id]), **self.headers)['ETag']
+        etag = self.client.get(detail, **self.headers)['ETag']
+        self.client.get(listing, **self.headers)
+        reserve_stock(self.product.id, 3)
+
+        response = self.client.get(detail, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stock'], 1)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get(listing, **self.headers)
+        self.assertEqual([row['stock'] for row in response.data['results']], [1, 2])
+        response = self.client.get(reverse('get_individual_product', args=[other.id]), HTTP_IF_NONE_MATCH=other_etag, **self.headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(catalog_cache_stats()['misses'], 3)
+
+    def test_product_save_invalidates_cached_responses(self):
+        url = reverse('get_products')
+        self.client.get(url, **self.headers)
+        self.product.price = 15
+        self.product.save()
+        response = self.client.get(url, **self.headers)
+        self.assertEqual(response.data['results'][0]['price'], '15.00')
+
+    def test_category_change_invalidates_cached_responses(self):
+        url = reverse('get_individual_product', args=[self.product.id])
+        self.client.get(url, **self.headers)
+        self.category.name = "Outdoors"
+        self.category.save()
+        response = self.client.get(url, **self.headers)
+        self.assertEqual(response.data['category'], ["Outdoors"])
+
+    def test_product_delete_invalidates_cached_responses(self):
+        url = reverse('get_products')
+        self.client.get(url, **self.headers)
+        self.product.delete()
+        response = self.client.get(url, **self.headers)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_only_known_query_params_are_cached(self):
+        url = reverse('get_products')
+        self.client.get(url, {'page': 1, 'in_stock': 'true'}, **self.headers)
+        # same parameters in another order share the entry
+        with self.assertNumQueries(1):
+            self.client.get(url + '?in_stock=true&page=1', **self.headers)
+        for junk in ({'utm_source': 'x'}, {'page': [1, 2]}, {'category': '1' * 200}):
+            self.client.get(url, junk, **self.headers)
+        self.assertEqual(catalog_cache_stats()['misses'], 1)
+
+
+class SharedCacheCheckTest(TestCase):
+    def test_process_local_cache_fails_outside_debug(self):
+        from app.checks import check_shared_cache
+
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['app.E001'])
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                               'LOCATION': 'redis://127.0.0.1:6379/1'}}):
+            self.assertEqual(check_shared_cache(None), [])
+        with self.settings(DEBUG=True):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class ConditionalGetTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Toys")
+        self.product = Product.objects.create(name="Kite", description="desc", price=8, stock=3, category=category)
+
+    def test_product_detail_returns_304_for_matching_etag(self):
+        url = reverse('get_individual_product', args=[self.product.id])
+        response = self.client.get(url, **self.headers)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], **self.headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_product_list_returns_304_until_a_product_changes(self):
+        url = reverse('get_products')
+        etag = self.client.get(url, **self.headers)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 304)
+        self.product.stock = 2
+        self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_product_list_has_no_last_modified(self):
+        url = reverse('get_products')
+        response = self.client.get(url, **self.headers)
+        self.assertNotIn('Last-Modified', response)
+        # a deleted product leaves the updated_at of the remaining rows as they were
+        Product.objects.create(name="Ball", description="desc", price=3, stock=1, category=self.product.category)
+        last_modified = self.client.get(reverse('get_individual_product', args=[self.product.id]), **self.headers)['Last-Modified']
+        Product.objects.filter(name="Ball").delete()
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_product_detail_honors_if_modified_since(self):
+        url = reverse('get_individual_product', args=[self.product.id])
+        last_modified = self.client.get(url, **self.headers)['Last-Modified']
+        cache.clear()
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified, **self.headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_order_returns_304_until_an_item_changes(self):
+        order = Order.objects.create(total_price=16)
+        item = OrderItem.objects.create(order=order, product=self.product, quantity=2, price=8)
+        url = reverse('get__individual_order')
+        etag = self.client.get(url, {'order_id': order.id}, **self.headers)['ETag']
+        response = self.client.get(url, {'order_id': order.id}, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 304)
+        item.quantity = 3
+        item.save()
+        response = self.client.get(url, {'order_id': order.id}, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+
+
+class ProductSearchTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        kitchen = Category.objects.create(name="Kitchen")
+        self.outdoors = Category.objects.create(name="Outdoors")
+        self.knife = Product.objects.create(name="Chef Knife", description="Forged steel blade", price=40, stock=3, category=kitchen)
+        self.pan = Product.objects.create(name="Frying Pan", description="Pairs well with a knife", price=25, stock=3, category=kitchen)
+        self.pocket = Product.objects.create(name="Pocket Knife", description="Folding blade", price=15, stock=3, category=self.outdoors)
+
+    def search(self, **params):
+        response = self.client.get(reverse('search_products'), params, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def test_name_matches_rank_above_description_matches(self):
+        ids = self.search(q='knife')
+        self.assertEqual(set(ids), {self.knife.id, self.pan.id, self.pocket.id})
+        self.assertEqual(ids[-1], self.pan.id)
+
+    def test_category_filter(self):
+        self.assertEqual(self.search(q='blade', category=str(self.outdoors.id)), [self.pocket.id])
+        self.assertEqual(self.search(q='blade', category='outdoors'), [self.pocket.id])
+
+    def test_index_follows_product_updates(self):
+        self.pan.name = "Skillet"
+        self.pan.description = "Cast iron"
+        self.pan.save()
+        self.assertEqual(self.search(q='skillet'), [self.pan.id])
+        self.assertNotIn(self.pan.id, self.search(q='knife'))
+        self.pocket.delete()
+        self.assertEqual(self.search(q='folding'), [])
+
+    def test_search_input_is_not_fts_syntax(self):
+        self.assertEqual(self.search(q='knife" OR "pan'), [])
+
+    def test_missing_terms(self):
+        response = self.client.get(reverse('search_products'), **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class ProductFacetTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.books = Category.objects.create(name="Books")
+        self.games = Category.objects.create(name="Games")
+        Product.objects.create(name="Novel", description="desc", price=10, stock=0, category=self.books)
+        Product.objects.create(name="Atlas", description="desc", price=30, stock=2, category=self.books)
+        Product.objects.create(name="Chess", description="desc", price=60, stock=1, category=self.games)
+        Product.objects.create(name="Console", description="desc", price=300, stock=5, category=self.games)
+
+    def get(self, **params):
+        return self.client.get(reverse('get_products'), params, **self.headers)
+
+    def test_filters(self):
+        response = self.get(category=str(self.games.id), min_price='50', max_price='100')
+        self.assertEqual([p['name'] for p in response.data['results']], ["Chess"])
+        response = self.get(in_stock='true')
+        self.assertEqual(response.data['count'], 3)
+
+    def test_invalid_filter(self):
+        self.assertEqual(self.get(min_price='cheap').status_code, 400)
+        self.assertEqual(self.get(category='books').status_code, 400)
+
+    def test_facets_come_from_one_query(self):
+        # paginator count, page, facets
+        with self.assertNumQueries(3):
+            response = self.get(facets='true')
+        facets = response.data['facets']
+        self.assertEqual(facets['category'], [
+            {'id': self.books.id, 'name': "Books", 'count': 2},
+            {'id': self.games.id, 'name': "Games", 'count': 2},
+        ])
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [1, 1, 1, 0, 1])
+        self.assertEqual(facets['in_stock'], 3)
+
+    def test_facets_ignore_their_own_filter(self):
+        facets = self.get(facets='true', category=str(self.books.id), in_stock='true').data['facets']
+        # the category facet still lists games, narrowed by the stock filter
+        self.assertEqual([c['count'] for c in facets['category']], [1, 2])
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [0, 1, 0, 0, 0])
+        # the stock facet is narrowed by category only
+        self.assertEqual(facets['in_stock'], 1)
+
+
+class RelatedProductsTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tools = Category.objects.create(name="Tools")
+        self.paint = Category.objects.create(name="Paint")
+        self.hammer = Product.objects.create(name="Hammer", description="desc", price=20, stock=5, category=self.tools)
+        self.mallet = Product.objects.create(name="Mallet", description="desc", price=22, stock=5, category=self.tools)
+        self.saw = Product.objects.create(name="Saw", description="desc", price=90, stock=5, category=self.tools)
+        self.brush = Product.objects.create(name="Brush", description="desc", price=5, stock=5, category=self.paint)
+
+    def related(self, product, **params):
+        response = self.client.get(reverse('get_related_products', args=[product.id]), params, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.data]
+
+    def refresh(self, *args):
+        call_command('refresh_related_products', *args, stdout=StringIO())
+
+    def test_ranked_by_price_proximity_within_category(self):
+        self.refresh()
+        self.assertEqual(self.related(self.hammer), ["Mallet", "Saw"])
+
+    def test_co_occurrence_outranks_category(self):
+        order = Order.objects.create(total_price=25)
+        OrderItem.objects.create(order=order, product=self.hammer, quantity=1, price=20)
+        OrderItem.objects.create(order=order, product=self.brush, quantity=1, price=5)
+        self.refresh()
+        self.assertEqual(self.related(self.hammer), ["Brush", "Mallet", "Saw"])
+
+    def test_limit_bounds_the_list(self):
+        self.refresh()
+        self.assertEqual(self.related(self.hammer, limit=1), ["Mallet"])
+
+    def test_incremental_refresh_picks_up_changes(self):
+        self.refresh()
+        self.saw.price = 21
+        self.saw.save()
+        self.refresh()
+        self.assertEqual(self.related(self.hammer), ["Saw", "Mallet"])
+
+    def test_falls_back_to_category_before_first_refresh(self):
+        self.assertEqual(self.related(self.hammer), ["Mallet", "Saw"])
+
+
+class ImportCatalogTest(TestCase):
+    def write(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_csv_import_upserts_on_sku(self):
+        path = self.write('.csv', (
+            "sku,name,description,price,stock,category\n"
+            "A-1,Lamp,Desk lamp,30.00,4,Lighting\n"
+            "A-2,Bulb,LED bulb,3.50,100,Lighting\n"
+            "A-3,Broken,,not-a-price,1,Lighting\n"
+        ))
+        call_command('import_catalog', path, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(Category.objects.filter(name="Lighting").count(), 1)
+
+        path = self.write('.csv', "sku,name,description,price,stock,category\nA-1,Lamp,Desk lamp,25.00,2,Lighting\n")
+        call_command('import_catalog', path, stdout=StringIO())
+        lamp = Product.objects.get(sku="A-1")
+        self.assertEqual((Product.objects.count(), lamp.price, lamp.stock), (2, 25, 2))
+
+    def test_import_sets_the_stock_of_sharded_products(self):
+        header = "sku,name,description,price,stock,category\n"
+        call_command('import_catalog', self.write('.csv', header + "H-1,Console,,300,10,Games\n"), stdout=StringIO())
+        product = Product.objects.get(sku="H-1")
+        set_stock_shards(product.id, 4)
+        call_command('import_catalog', self.write('.csv', header + "H-1,Console,,300,6,Games\n"), stdout=StringIO())
+        self.assertEqual(sorted(product.stock_shards.values_list('quantity', flat=True)), [1, 1, 2, 2])
+        call_command('reconcile_stock_shards', stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual((product.shard_count, product.stock), (4, 6))
+
+    def test_import_takes_held_stock_off_the_feed_count(self):
+        header = "sku,name,description,price,stock,category\n"
+        call_command('import_catalog', self.write('.csv', header + "B-1,Bench,,80,10,Garden\n"), stdout=StringIO())
+        product = Product.objects.get(sku="B-1")
+        reserve_stock(product.id, 3)
+        paid = Order.objects.create(status='Paid')
+        item = OrderItem.objects.create(order=paid, product=product, quantity=2, price=80)
+        claim_reservations([(item, [reserve_stock(product.id, 2).id])])
+        # the feed still counts the 3 in a cart, the 2 paid for have left the warehouse
+        call_command('import_catalog', self.write('.csv', header + "B-1,Bench,,80,12,Garden\n"), stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 9)
+
+    def test_jsonl_import_in_batches(self):
+        lines = [
+            json.dumps({'sku': f"J-{i}", 'name': f"Item {i}", 'price': "1.00", 'stock': i, 'category': f"Cat {i % 3}"})
+            for i in range(25)
+        ]
+        # a repeated sku inside one batch keeps the last row
+        lines.append(json.dumps({'sku': "J-0", 'name': "Item 0 v2", 'price': "2.00", 'stock': 1, 'category': "Cat 0"}))
+        path = self.write('.jsonl', "\n".join(lines))
+        out = StringIO()
+        call_command('import_catalog', path, batch_size=10, stdout=out)
+        self.assertEqual(Product.objects.count(), 25)
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(Product.objects.get(sku="J-0").name, "Item 0 v2")
+        self.assertIn("rows/s", out.getvalue())
+
+    def test_malformed_lines_are_skipped(self):
+        path = self.write('.jsonl', "\n".join([
+            json.dumps({'sku': "M-1", 'name': "Mug", 'price': "4", 'category': "Kitchen"}),
+            '{"sku": "M-2", "name": ',
+            '["not", "an", "object"]',
+            json.dumps({'sku': "M-3", 'name': "Nameless category", 'price': "4", 'category': " "}),
+            json.dumps({'sku': "M-4", 'name': "Bowl", 'price': "6", 'category': "Kitchen"}),
+        ]))
+        err = StringIO()
+        call_command('import_catalog', path, stdout=StringIO(), stderr=err)
+        self.assertEqual(sorted(Product.objects.values_list('sku', flat=True)), ["M-1", "M-4"])
+        self.assertEqual([line.split(':')[0] for line in err.getvalue().splitlines()],
+                         ['Skipping row 2', 'Skipping row 3', 'Skipping row 4'])
+        self.assertFalse(Category.objects.filter(name='').exists())
+
+    def test_undecodable_csv_line_is_skipped(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b"sku,name,description,price,stock,category\nB-1,Box,,2,1,Storage\nB-2,Bad \xff,,2,1,Storage\n"
+                    b"B-3,Bin,,3,1,Storage\n")
+        self.addCleanup(os.remove, path)
+        err = StringIO()
+        call_command('import_catalog', path, stdout=StringIO(), stderr=err)
+        self.assertEqual(sorted(Product.objects.values_list('sku', flat=True)), ["B-1", "B-3"])
+        self.assertIn('Skipping row 3', err.getvalue())
+
+    def test_imported_products_are_searchable(self):
+        path = self.write('.jsonl', json.dumps({'sku': "S-1", 'name': "Umbrella", 'price': "9", 'category': "Rain"}))
+        call_command('import_catalog', path, stdout=StringIO())
+        response = self.client.get(reverse('search_products'), {'q': 'umbrella'}, HTTP_X_API_KEY=settings.API_KEY)
+        self.assertEqual(response.data['count'], 1)
+
+
+class GenerateLoadDataTest(TestCase):
+    options = dict(users=20, guests=10, categories=3, products=40, orders=60, reviews=30, batch_size=25)
+
+    def generate(self, seed):
+        call_command('generate_load_data', seed=seed, stdout=StringIO(), **self.options)
+        return list(Order.objects.order_by('tracking_id').values_list(
+            'tracking_id', 'total_price', 'status', 'created_at', 'updated_at'
+        ))
+
+    def test_generates_requested_rows(self):
+        self.generate(1)
+        self.assertEqual(User.objects.count(), 20)
+        self.assertEqual(GuestUser.objects.count(), 10)
+        self.assertEqual(Product.objects.count(), 40)
+        self.assertEqual(Order.objects.count(), 60)
+        self.assertEqual(Review.objects.count(), 30)
+        self.assertEqual(Payment.objects.count(), Order.objects.filter(status='Paid').count())
+        self.assertFalse(OrderItem.objects.filter(order__isnull=True).exists())
+        # order totals line up with their items
+        order = Order.objects.first()
+        subtotal = sum(item.line_total for item in order.items.all())
+        self.assertEqual(order.total_price, subtotal + order.shipping_cost + order.tax)
+
+    def test_same_seed_gives_same_data(self):
+        first = self.generate(7)
+        for model in (Order, Product, Category, User, GuestUser):
+            model.objects.all().delete()
+        self.assertEqual(self.generate(7), first)
+
+    def test_timestamps_count_back_from_the_anchor(self):
+        orders = self.generate(5)
+        newest = max(order[3] for order in orders)
+        self.assertLess(newest, datetime(2025, 1, 1, tzinfo=dt_timezone.utc))
+        self.assertGreater(min(order[3] for order in orders), datetime(2024, 1, 1, tzinfo=dt_timezone.utc))
+        with self.assertRaises(CommandError):
+            call_command('generate_load_data', seed=6, anchor='soon', stdout=StringIO(), **self.options)
+
+    def test_tracking_ids_fit_the_column(self):
+        orders = self.generate(MAX_SEED)
+        self.assertEqual({len(order[0]) for order in orders}, {20})
+        with self.assertRaises(CommandError):
+            self.generate(MAX_SEED + 1)
+
+    def test_refuses_to_reuse_a_seed(self):
+        self.generate(3)
+        with self.assertRaises(CommandError):
+            self.generate(3)
+
+
+class BenchmarkCommandTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name="Bench")
+        for i in range(5):
+            Product.objects.create(name=f"Bench item {i}", description="desc", price=10, stock=1000, category=category)
+
+    def test_writes_results_and_rolls_back(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('benchmark', iterations=3, warmup=1, output=path, stdout=StringIO())
+        with open(path) as f:
+            endpoints = json.load(f)['endpoints']
+        self.assertIn('products', endpoints)
+        # catalog endpoints are measured cold and from the cache
+        self.assertGreater(endpoints['products']['queries'], endpoints['products_warm']['queries'])
+        self.assertEqual(set(endpoints['order_create']), {'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries', 'errors'})
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_query_count_regression_fails(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'endpoints': {'product_detail': {'p50_ms': 1000, 'p95_ms': 1000, 'p99_ms': 1000, 'queries': 0, 'errors': 0}}}, f)
+        self.addCleanup(os.remove, path)
+        with self.assertRaises(CommandError):
+            call_command('benchmark', iterations=2, warmup=0, endpoint=['product_detail'], clear_cache=True, compare=path, stdout=StringIO())
+
+    def test_database_error_is_one_error_not_the_rest_of_the_run(self):
+        from app.management.commands.benchmark import Command
+
+        calls = []
+
+        def flaky(_):
+            calls.append(1)
+            if len(calls) == 2:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT * FROM no_such_table")
+            return self.client.get(reverse('get_products'), HTTP_X_API_KEY=settings.API_KEY)
+
+        command = Command(stdout=StringIO())
+        command.product = Product.objects.first()
+        result = command.run((None, flaky), iterations=4, warmup=0, clear_cache=False)
+        self.assertEqual((len(calls), result['errors']), (4, 1))
+
+
+class StockReservationTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Audio")
+        self.product = Product.objects.create(name="Headphones", description="desc", price=50, stock=3, category=category)
+
+    def add(self, quantity, product_id=None):
+        return self.client.post(reverse('add_to_cart'), {'product_id': product_id or self.product.id, 'quantity': quantity},
+                                content_type='application/json', **self.headers)
+
+    def test_add_to_cart_reserves_stock(self):
+        response = self.add(2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['product']['stock'], 1)
+        response = self.add(1)
+        self.assertEqual(response.data['quantity'], 3)
+        self.assertEqual(response.data['line_total'], '150.00')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(StockReservation.objects.filter(product=self.product, status='Held').count(), 2)
+
+    def test_insufficient_stock_changes_nothing(self):
+        response = self.add(4)
+        self.assertEqual(response.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_bad_input(self):
+        self.assertEqual(self.add(0).status_code, 400)
+        self.assertEqual(self.add('many').status_code, 400)
+        self.assertEqual(self.add(1, product_id=999999).status_code, 404)
+
+    def test_remove_from_cart_releases_stock(self):
+        item_id = self.add(2).data['id']
+        response = self.client.delete(reverse('remove_items_from_cart', args=[item_id]), **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(StockReservation.objects.get().status, 'Released')
+
+
+class StockReservationConcurrencyTest(TransactionTestCase):
+    def race(self, product, threads):
+        barrier = threading.Barrier(threads)
+        outcomes = []
+
+        def reserve():
+            try:
+                barrier.wait()
+                reserve_stock(product.id, 1)
+                outcomes.append('reserved')
+            except InsufficientStock:
+                outcomes.append('sold out')
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=reserve) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return outcomes
+
+    def test_no_oversell_under_concurrent_reservations(self):
+        category = Category.objects.create(name="Flash sale")
+        product = Product.objects.create(name="Hot item", description="desc", price=5, stock=10, category=category)
+        outcomes = self.race(product, 25)
+
+        product.refresh_from_db()
+        self.assertEqual(outcomes.count('reserved'), 10)
+        self.assertEqual(outcomes.count('sold out'), 15)
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(StockReservation.objects.filter(product=product).count(), 10)
+
+    def test_no_oversell_with_sharded_stock(self):
+        category = Category.objects.create(name="Flash sale")
+        product = Product.objects.create(name="Hot item", description="desc", price=5, stock=10, category=category)
+        set_stock_shards(product.id, 4)
+        outcomes = self.race(product, 25)
+
+        self.assertEqual(outcomes.count('reserved'), 10)
+        self.assertEqual(StockShard.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'], 0)
+        self.assertEqual(StockReservation.objects.filter(product=product).count(), 10)
+
+
+class StockShardTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Flash sale")
+        self.product = Product.objects.create(name="Console", description="desc", price=300, stock=10, category=category)
+        call_command('shard_stock', self.product.id, '--shards', '4', stdout=StringIO())
+
+    def shards(self):
+        return list(self.product.stock_shards.order_by('shard').values_list('quantity', flat=True))
+
+    def add(self, quantity):
+        return self.client.post(reverse('add_to_cart'), {'product_id': self.product.id, 'quantity': quantity},
+                                content_type='application/json', **self.headers)
+
+    def test_stock_is_split_over_the_shards(self):
+        self.assertEqual(self.shards(), [3, 3, 2, 2])
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.shard_count, self.product.stock), (4, 10))
+
+    def test_reservations_take_from_the_shards(self):
+        self.assertEqual(self.add(2).status_code, 200)
+        self.assertEqual(sum(self.shards()), 8)
+        # the product row isn't touched, it catches up on reconcile
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+        response = self.client.get(reverse('get_individual_product', args=[self.product.id]), **self.headers)
+        self.assertEqual(response.data['stock'], 8)
+
+        call_command('reconcile_stock_shards', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 8)
+        self.assertEqual(self.shards(), [2, 2, 2, 2])
+
+    def test_large_reservations_span_shards(self):
+        self.assertEqual(self.add(7).status_code, 200)
+        self.assertEqual(sum(self.shards()), 3)
+        self.assertEqual(self.add(4).status_code, 400)
+        self.client.delete(reverse('remove_items_from_cart', args=[self.product.id]), **self.headers)
+        self.assertEqual(sum(self.shards()), 10)
+
+    def test_batch_and_unsharding(self):
+        response = self.client.post(reverse('cart_batch'), {'operations': [
+            {'op': 'add', 'product_id': self.product.id, 'quantity': 6},
+        ]}, content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(self.shards()), 4)
+        call_command('shard_stock', self.product.id, '--shards', '0', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.shard_count, self.product.stock), (0, 4))
+        self.assertEqual(self.shards(), [])
+        self.assertEqual(self.add(4).status_code, 200)
+        self.assertEqual(self.add(1).status_code, 400)
+
+    def test_stock_given_back_without_shard_rows_is_kept(self):
+        StockShard.objects.filter(product=self.product).delete()
+        give_back_stock(self.product.id, 3)
+        call_command('reconcile_stock_shards', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 13)
+        # sharding again spreads what the product holds
+        set_stock_shards(self.product.id, 2)
+        self.assertEqual(self.shards(), [7, 6])
+
+
+class CartStoreTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Stationery")
+        self.pen = Product.objects.create(name="Pen", description="desc", price=2, stock=50, category=category)
+        self.pad = Product.objects.create(name="Notepad", description="desc", price=4, stock=50, category=category)
+
+    def add(self, client, product, quantity=1):
+        response = client.post(reverse('add_to_cart'), {'product_id': product.id, 'quantity': quantity},
+                               content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def checkout(self, client):
+        return client.post(reverse('create_order'), {
+            'guest_email': 'guest@example.com', 'address': '1 Road', 'city': 'Nairobi', 'state': 'Nairobi',
+            'zip_code': '00100', 'country': 'Kenya',
+        }, content_type='application/json', **self.headers)
+
+    def test_carts_are_per_client(self):
+        first, second = self.client_class(), self.client_class()
+        response = self.add(first, self.pen, 2)
+        self.assertIn('cart_id', response.cookies)
+        # renewed as the cart is used, not only when it is created
+        self.assertEqual(self.add(first, self.pen).cookies['cart_id'].value, response.cookies['cart_id'].value)
+        self.add(second, self.pad)
+        self.assertEqual([item['id'] for item in first.get(reverse('get_items_incart'), **self.headers).data], [self.pen.id])
+        self.assertEqual([item['id'] for item in second.get(reverse('get_items_incart'), **self.headers).data], [self.pad.id])
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_cart_header_identifies_the_cart(self):
+        cart_id = self.add(self.client, self.pen)['X-Cart-Id']
+        response = self.client_class().get(reverse('get_items_incart'), HTTP_X_CART_ID=cart_id, **self.headers)
+        self.assertEqual(len(response.data), 1)
+
+    def test_reading_the_cart_is_one_query(self):
+        self.add(self.client, self.pen)
+        self.add(self.client, self.pad)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get_items_incart'), **self.headers)
+        self.assertEqual({item['line_total'] for item in response.data}, {'2.00', '4.00'})
+
+    def test_remove_uses_the_product_id(self):
+        self.add(self.client, self.pen, 3)
+        self.add(self.client, self.pad)
+        response = self.client.delete(reverse('remove_items_from_cart', args=[self.pen.id]), **self.headers)
+        self.assertEqual([item['id'] for item in response.data['cart']], [self.pad.id])
+        self.pen.refresh_from_db()
+        self.assertEqual(self.pen.stock, 50)
+        response = self.client.delete(reverse('remove_items_from_cart', args=[self.pen.id]), **self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_create_order_turns_the_cart_into_order_items(self):
+        self.add(self.client, self.pen, 2)
+        self.add(self.client, self.pen)
+        self.add(self.client, self.pad)
+        response = self.checkout(self.client)
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(id=response.data['order_id'])
+        self.assertEqual(order.total_price, 10)
+        self.assertEqual(sorted(order.items.values_list('product_id', 'quantity')), [(self.pen.id, 3), (self.pad.id, 1)])
+        self.assertFalse(StockReservation.objects.filter(order_item__isnull=True).exists())
+        self.assertEqual(self.client.get(reverse('get_items_incart'), **self.headers).data, [])
+        self.assertEqual(self.checkout(self.client).status_code, 400)
+
+    def test_expired_carts_give_stock_back(self):
+        self.add(self.client, self.pen, 5)
+        StockReservation.objects.update(updated_at=timezone.now() - timedelta(seconds=settings.CART_TTL + 1))
+        call_command('release_expired_carts', stdout=StringIO())
+        self.pen.refresh_from_db()
+        self.assertEqual(self.pen.stock, 50)
+        # the cart is still cached here, checking it out must not sell stock that was given back
+        self.assertEqual(self.checkout(self.client).status_code, 409)
+        self.assertFalse(Order.objects.exists())
+
+    def test_deleted_orders_do_not_look_like_expired_carts(self):
+        self.add(self.client, self.pen, 3)
+        order = Order.objects.get(id=self.checkout(self.client).data['order_id'])
+        self.assertEqual(set(StockReservation.objects.values_list('status', flat=True)), {'Claimed'})
+        order.delete()
+        StockReservation.objects.update(updated_at=timezone.now() - timedelta(seconds=settings.CART_TTL + 1))
+        call_command('release_expired_carts', stdout=StringIO())
+        self.pen.refresh_from_db()
+        self.assertEqual(self.pen.stock, 47)
+
+    def test_adds_from_two_requests_keep_both_lines(self):
+        cart_id = self.add(self.client, self.pen)['X-Cart-Id']
+        first, second = CartStore(f"cart:anon:{cart_id}"), CartStore(f"cart:anon:{cart_id}")
+        first.add(self.pad, 1, 0)
+        second.add(self.pad, 2, 0)
+        self.assertEqual({product_id: line['quantity'] for product_id, line in first.lines().items()},
+                         {self.pen.id: 1, self.pad.id: 3})
+
+    def test_a_locked_cart_turns_writers_away(self):
+        cart_id = self.add(self.client, self.pen)['X-Cart-Id']
+        wait, cart_module.CART_LOCK_WAIT = cart_module.CART_LOCK_WAIT, 0
+        try:
+            with CartStore(f"cart:anon:{cart_id}").lock():
+                response = self.client.post(reverse('add_to_cart'), {'product_id': self.pad.id},
+                                            content_type='application/json', **self.headers)
+                self.assertEqual(response.status_code, 409)
+                with self.assertRaises(CartBusy):
+                    CartStore(f"cart:anon:{cart_id}").clear()
+        finally:
+            cart_module.CART_LOCK_WAIT = wait
+        # nothing was reserved for the turned away add, and the lock is free again
+        self.pad.refresh_from_db()
+        self.assertEqual(self.pad.stock, 50)
+        self.assertEqual(self.checkout(self.client).status_code, 201)
+
+
+class CartBatchTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Kitchen")
+        self.products = [
+            Product.objects.create(name=f"Cup {i}", description="desc", price=3, stock=10, category=category)
+            for i in range(20)
+        ]
+
+    def batch(self, operations):
+        return self.client.post(reverse('cart_batch'), {'operations': operations},
+                                content_type='application/json', **self.headers)
+
+    def stock(self):
+        return dict(Product.objects.values_list('id', 'stock'))
+
+    def test_restoring_a_cart_is_a_fixed_number_of_queries(self):
+        operations = [{'op': 'add', 'product_id': product.id, 'quantity': 2} for product in self.products]
+        # products, one stock update and one insert, plus the savepoint pair
+        with self.assertNumQueries(5):
+            response = self.batch(operations)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 40)
+        self.assertEqual(response.data['total'], '120.00')
+        self.assertEqual({item['product']['stock'] for item in response.data['cart']}, {8})
+        self.assertEqual(set(self.stock().values()), {8})
+        self.assertEqual(StockReservation.objects.filter(status='Held').count(), 20)
+
+    def test_update_and_remove_move_stock_both_ways(self):
+        first, second, third = self.products[:3]
+        self.batch([{'op': 'add', 'product_id': first.id, 'quantity': 4}, {'op': 'add', 'product_id': second.id}])
+        response = self.batch([
+            {'op': 'update', 'product_id': first.id, 'quantity': 1},
+            {'op': 'remove', 'product_id': second.id},
+            {'op': 'add', 'product_id': third.id, 'quantity': 3},
+            {'op': 'add', 'product_id': third.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({item['id']: item['quantity'] for item in response.data['cart']}, {first.id: 1, third.id: 4})
+        stock = self.stock()
+        self.assertEqual((stock[first.id], stock[second.id], stock[third.id]), (9, 10, 6))
+        held = StockReservation.objects.filter(status='Held').values_list('product_id', 'quantity')
+        self.assertEqual(sorted(held), sorted([(first.id, 1), (third.id, 4)]))
+
+    def test_short_stock_changes_nothing(self):
+        first, second = self.products[:2]
+        self.batch([{'op': 'add', 'product_id': first.id}])
+        response = self.batch([
+            {'op': 'update', 'product_id': first.id, 'quantity': 5},
+            {'op': 'add', 'product_id': second.id, 'quantity': 11},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['product_id'], second.id)
+        stock = self.stock()
+        self.assertEqual((stock[first.id], stock[second.id]), (9, 10))
+        self.assertEqual(self.client.get(reverse('get_items_incart'), **self.headers).data[0]['quantity'], 1)
+
+    def test_bad_operations(self):
+        self.assertEqual(self.batch([]).status_code, 400)
+        self.assertEqual(self.batch([{'op': 'drop', 'product_id': 1}]).status_code, 400)
+        self.assertEqual(self.batch([{'op': 'add', 'product_id': self.products[0].id, 'quantity': 0}]).status_code, 400)
+        response = self.batch([{'op': 'add', 'product_id': 999999}])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['product_ids'], [999999])
+
+
+class RollbackPendingOrdersTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Garden")
+        self.rake = Product.objects.create(name="Rake", description="desc", price=5, stock=100, category=category)
+        self.hose = Product.objects.create(name="Hose", description="desc", price=9, stock=100, category=category)
+
+    def order(self, status='Pending', age=120, **items):
+        products = {'rake': self.rake, 'hose': self.hose}
+        order = Order.objects.create(status=status, total_price=1)
+        for name, quantity in items.items():
+            reservation = reserve_stock(products[name].id, quantity)
+            item = OrderItem.objects.create(order=order, product=products[name], quantity=quantity, price=1)
+            claim_reservations([(item, [reservation.id])])
+        Order.objects.filter(id=order.id).update(created_at=timezone.now() - timedelta(seconds=age))
+        return order
+
+    def stock(self):
+        return dict(Product.objects.values_list('name', 'stock'))
+
+    def test_expired_pending_orders_give_stock_back(self):
+        for _ in range(5):
+            self.order(rake=2, hose=1)
+        paid = self.order(status='Paid', rake=1)
+        fresh = self.order(age=0, hose=3)
+        out = StringIO()
+        call_command('rollback_pending_orders', '--batch-size', '2', stdout=out)
+
+        self.assertEqual(set(Order.objects.values_list('id', flat=True)), {paid.id, fresh.id})
+        self.assertEqual(self.stock(), {'Rake': 99, 'Hose': 97})
+        self.assertIn('Rolled back 5 orders (10 items, 15 units) in 3 batches with 6 stock updates', out.getvalue())
+        # released with the order, the cart expiry job must not restore them a second time
+        StockReservation.objects.update(updated_at=timezone.now() - timedelta(seconds=settings.CART_TTL + 1))
+        call_command('release_expired_carts', stdout=StringIO())
+        self.assertEqual(self.stock(), {'Rake': 99, 'Hose': 97})
+
+    def test_queries_do_not_grow_with_orders(self):
+        # the first run creates the stats row, later runs update it
+        rollback_pending_orders()
+        for _ in range(3):
+            self.order(rake=1, hose=1)
+        with CaptureQueriesContext(connection) as few:
+            rollback_pending_orders()
+        for _ in range(30):
+            self.order(rake=1, hose=1)
+        with CaptureQueriesContext(connection) as many:
+            rollback_pending_orders()
+        self.assertEqual(len(few), len(many))
+
+    def test_endpoint_reports_the_last_run(self):
+        response = self.client.get(reverse('check_pending_orders'), **self.headers)
+        self.assertNotIn('last_run', response.data)
+        self.order(rake=4)
+        rollback_pending_orders()
+        # kept in the database, a cache flush or restart doesn't lose it
+        cache.clear()
+        response = self.client.get(reverse('check_pending_orders'), **self.headers)
+        self.assertEqual(response.data['last_run']['orders'], 1)
+        self.assertEqual(response.data['pending_orders'], 0)
+        self.assertEqual(self.stock()['Rake'], 100)
+
+
+class CreateOrderTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Books")
+        self.products = [
+            Product.objects.create(name=f"Book {i}", description="desc", price=10, stock=50, category=category)
+            for i in range(5)
+        ]
+
+    def fill_cart(self, client=None):
+        client = client or self.client
+        client.post(reverse('cart_batch'), {'operations': [
+            {'op': 'add', 'product_id': product.id, 'quantity': 2} for product in self.products
+        ]}, content_type='application/json', **self.headers)
+
+    def checkout(self, client=None, email='reader@example.com', **headers):
+        client = client or self.client
+        return client.post(reverse('create_order'), {
+            'guest_email': email, 'address': '1 Road', 'city': 'Nairobi', 'state': 'Nairobi',
+            'zip_code': '00100', 'country': 'Kenya',
+        }, content_type='application/json', **self.headers, **headers)
+
+    def test_order_is_written_in_a_fixed_number_of_queries(self):
+        GuestUser.objects.create(email='reader@example.com')
+        self.fill_cart()
+        # guest, address, order, items, claim, response prefetch, plus the savepoint pair
+        with self.assertNumQueries(8):
+            response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get()
+        self.assertTrue(order.tracking_id)
+        self.assertEqual(response.data['order']['tracking_id'], order.tracking_id)
+        self.assertEqual(len(response.data['order']['items']), 5)
+        self.assertEqual(order.total_price, 100)
+        self.assertEqual(StockReservation.objects.filter(order_item__order=order).count(), 5)
+
+    def test_retries_with_the_same_key_return_the_original_order(self):
+        self.fill_cart()
+        first = self.checkout(HTTP_IDEMPOTENCY_KEY='checkout-1')
+        again = self.checkout(HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(again.status_code, 201)
+        self.assertEqual(again['Idempotent-Replayed'], 'true')
+        self.assertEqual(again.data, first.data)
+        self.assertEqual(Order.objects.count(), 1)
+
+        # a new key checks out the (now empty) cart again
+        self.assertEqual(self.checkout(HTTP_IDEMPOTENCY_KEY='checkout-2').status_code, 400)
+
+    def test_a_retry_waiting_on_the_cart_gets_the_original_order(self):
+        self.fill_cart()
+        responses = []
+        lock = CartStore.lock
+
+        # the retry arrives first and waits for the cart while the original request runs
+        def original_runs_first(cart):
+            if not responses:
+                responses.append(None)
+                responses[0] = self.checkout(HTTP_IDEMPOTENCY_KEY='checkout-1')
+            return lock(cart)
+
+        CartStore.lock = original_runs_first
+        try:
+            retry = self.checkout(HTTP_IDEMPOTENCY_KEY='checkout-1')
+        finally:
+            CartStore.lock = lock
+        self.assertEqual((responses[0].status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['order_id'], responses[0].data['order_id'])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_a_key_belongs_to_one_customer(self):
+        self.fill_cart()
+        self.checkout(HTTP_IDEMPOTENCY_KEY='shared')
+        other = self.client_class()
+        self.fill_cart(other)
+        response = self.checkout(other, email='someone@example.com', HTTP_IDEMPOTENCY_KEY='shared')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_claims_leave_nothing_behind(self):
+        self.fill_cart()
+        StockReservation.objects.update(updated_at=timezone.now() - timedelta(seconds=settings.CART_TTL + 1))
+        call_command('release_expired_carts', stdout=StringIO())
+        self.assertEqual(self.checkout().status_code, 409)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(GuestUser.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class OrderReadQueryTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(email='buyer@example.com', password='pass12345', first_name='Ada')
+        address = ShippingAddress.objects.create(user=user, street_address='1 Road', city='Nairobi', state='Nairobi',
+                                                 zip_code='00100', country='Kenya')
+        self.order = Order.objects.create(user=user, shipping_address=address, total_price=1, tracking_id='#READ1')
+
+    def add_items(self, count):
+        categories = [Category.objects.create(name=f"Aisle {i}") for i in range(count)]
+        for i, category in enumerate(categories):
+            product = Product.objects.create(name=f"Item {i}", description="desc", price=3, stock=5, category=category)
+            OrderItem.objects.create(order=self.order, product=product, quantity=1, price=3)
+
+    def test_order_detail_is_two_queries_whatever_the_size(self):
+        self.add_items(12)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('get__individual_order'), {'order_id': self.order.id}, **self.headers)
+        self.assertEqual(len(response.data['items']), 12)
+        self.assertEqual(response.data['user']['email'], 'buyer@example.com')
+        self.assertEqual(response.data['items'][0]['product']['category'], ['Aisle 0'])
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('get__individual_order'), {'order_id': self.order.id},
+                                       HTTP_IF_NONE_MATCH=response['ETag'], **self.headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_confirmation_email_is_two_reads_whatever_the_size(self):
+        self.add_items(12)
+        # two reads and the outbox insert
+        with self.assertNumQueries(3):
+            response = self.client.post(reverse('send_email'), {'order_id': self.order.id},
+                                        content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        send_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Item 11', mail.outbox[0].alternatives[0][0])
+
+
+class OrderHistoryTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Tools")
+        self.product = Product.objects.create(name="Saw", description="desc", price=12, stock=5, category=category)
+        self.user = User.objects.create_user(email='history@example.com', password='pass12345')
+        self.guest = GuestUser.objects.create(email='guest@example.com')
+        now = timezone.now()
+        for i in range(25):
+            order = Order.objects.create(user=self.user, total_price=12, tracking_id=f"#U{i}",
+                                         status='Paid' if i % 5 else 'Pending')
+            for _ in range(i % 3 + 1):
+                OrderItem.objects.create(order=order, product=self.product, quantity=1, price=12)
+            Order.objects.filter(id=order.id).update(created_at=now - timedelta(hours=i))
+        for i in range(3):
+            Order.objects.create(guest_user=self.guest, total_price=12, tracking_id=f"#G{i}")
+        self.client.post(reverse('login_user'), {'email': 'history@example.com', 'password': 'pass12345'},
+                         content_type='application/json', **self.headers)
+
+    def test_pages_walk_the_history_newest_first(self):
+        url = reverse('user_orders')
+        tracking_ids = []
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url, **self.headers)
+            self.assertEqual(response.status_code, 200)
+            tracking_ids += [order['tracking_id'] for order in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(tracking_ids, [f"#U{i}" for i in range(25)])
+
+    def test_rows_are_summaries(self):
+        row = self.client.get(reverse('user_orders'), **self.headers).data['results'][2]
+        self.assertEqual(row['item_count'], 3)
+        self.assertNotIn('items', row)
+        self.assertEqual(set(row), {'id', 'tracking_id', 'status', 'total_price', 'shipping_cost', 'tax', 'item_count', 'created_at'})
+
+    def test_status_filter(self):
+        response = self.client.get(reverse('user_orders'), {'status': 'Pending'}, **self.headers)
+        self.assertEqual([order['tracking_id'] for order in response.data['results']], ['#U0', '#U5', '#U10', '#U15', '#U20'])
+        response = self.client.get(reverse('user_orders'), {'status': 'Lost'}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_guests_prove_one_tracking_id(self):
+        guest = self.client_class()
+        response = guest.get(reverse('user_orders'), {'guest_email': 'guest@example.com', 'tracking_id': '#G1'}, **self.headers)
+        self.assertEqual(sorted(order['tracking_id'] for order in response.data['results']), ['#G0', '#G1', '#G2'])
+        response = guest.get(reverse('user_orders'), {'guest_email': 'guest@example.com', 'tracking_id': '#U1'}, **self.headers)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(guest.get(reverse('user_orders'), **self.headers).status_code, 401)
+
+
+class TrackingIdTest(TestCase):
+    def test_ids_are_unique_and_time_ordered(self):
+        ids = []
+
+        def generate():
+            ids.extend(generate_tracking_id() for _ in range(5000))
+
+        workers = [threading.Thread(target=generate) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len(set(ids)), 20000)
+        self.assertTrue(all(len(tracking_id) == 20 and tracking_id[0] == '#' for tracking_id in ids))
+        later = generate_tracking_id()
+        self.assertGreater(later, max(ids))
+
+    def test_worker_id_must_be_in_range(self):
+        with self.settings(TRACKING_WORKER_ID='3'):
+            self.assertEqual(tracking_worker_id(), 3)
+        with self.settings(TRACKING_WORKER_ID=''):
+            self.assertIsNone(tracking_worker_id())
+            self.assertEqual(check_tracking_worker_id(None), [])
+        for value in ('1024', '-1', 'web-1'):
+            with self.settings(TRACKING_WORKER_ID=value), self.assertRaises(ImproperlyConfigured):
+                tracking_worker_id()
+        with self.settings(TRACKING_WORKER_ID='web-1'):
+            self.assertEqual([error.id for error in check_tracking_worker_id(None)], ['app.W002'])
+
+    def test_processes_lease_their_own_worker_id(self):
+        state = utility._tracking_state
+        try:
+            with self.settings(TRACKING_WORKER_ID=''):
+                workers = set()
+                for _ in range(3):
+                    # as after a fork, the new process leases an id of its own
+                    state['pid'] = None
+                    generate_tracking_id()
+                    workers.add(state['worker'])
+                self.assertEqual(len(workers), 3)
+
+                # a lease that lapsed and went to another process is given up for a free id
+                taken = state['worker']
+                cache.set(utility.TRACKING_WORKER_KEY.format(taken), 'other', None)
+                state['renewed'] -= utility.TRACKING_WORKER_RENEW + 1
+                generate_tracking_id()
+                self.assertNotEqual(state['worker'], taken)
+        finally:
+            state['pid'] = None
+
+    def test_ids_end_in_random_characters(self):
+        first, second = generate_tracking_id(), generate_tracking_id()
+        # consecutive ids differ in the sequence and in the suffix, the prefix alone is guessable
+        self.assertEqual(len({first[-6:], second[-6:]}), 2)
+
+    def test_track_order(self):
+        headers = {'HTTP_X_API_KEY': settings.API_KEY}
+        user = User.objects.create_user(email='tracked@example.com', password='pass12345')
+        order = Order.objects.create(user=user, total_price=5, tracking_id=generate_tracking_id())
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('track_order', args=[order.tracking_id[1:]]), **headers)
+        self.assertEqual(response.data['id'], order.id)
+        self.assertNotIn('user', response.data)
+        response = self.client.get(reverse('track_order', args=[order.tracking_id]), **headers)
+        self.assertEqual(response.data['tracking_id'], order.tracking_id)
+        self.assertEqual(self.client.get(reverse('track_order', args=['NOPE']), **headers).status_code, 404)
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name="Music")
+        self.drum = Product.objects.create(name="Drum", description="desc", price=40, stock=5, category=category)
+        self.flute = Product.objects.create(name="Flute", description="desc", price=15, stock=5, category=category)
+        self.order = Order.objects.create(shipping_cost=5, tax=2)
+
+    def totals(self, order=None):
+        order = order or self.order
+        order.refresh_from_db()
+        return order.subtotal, order.item_count, order.total_price
+
+    def test_totals_follow_the_items(self):
+        self.assertEqual(self.totals(), (0, 0, 7))
+        drum = OrderItem.objects.create(order=self.order, product=self.drum, quantity=2, price=40)
+        OrderItem.objects.create(order=self.order, product=self.flute, quantity=1, price=15)
+        self.assertEqual(self.totals(), (95, 2, 102))
+
+        drum = OrderItem.objects.get(id=drum.id)
+        drum.quantity = 1
+        # one UPDATE on the item and one F() update on the order, the items aren't read back
+        with self.assertNumQueries(2):
+            drum.save()
+        self.assertEqual(self.totals(), (55, 2, 62))
+
+        other = Order.objects.create()
+        drum.order = other
+        drum.save()
+        self.assertEqual(self.totals(), (15, 1, 22))
+        self.assertEqual(self.totals(other), (40, 1, 40))
+
+        OrderItem.objects.get(product=self.flute).delete()
+        self.assertEqual(self.totals(), (0, 0, 7))
+
+    def test_saving_a_stale_order_keeps_the_totals(self):
+        stale = Order.objects.get(id=self.order.id)
+        OrderItem.objects.create(order=self.order, product=self.drum, quantity=1, price=40)
+        stale.status = 'Paid'
+        stale.save()
+        self.assertEqual(self.totals(), (40, 1, 47))
+        self.assertEqual(self.order.status, 'Paid')
+        self.assertEqual(stale.total_price, 47)
+        # named explicitly they are written
+        stale.subtotal, stale.item_count, stale.total_price = 0, 0, 7
+        stale.save(update_fields=['subtotal', 'item_count', 'total_price'])
+        self.assertEqual(self.totals(), (0, 0, 7))
+
+    def test_shipping_and_tax_changes_move_the_total(self):
+        stale = Order.objects.get(id=self.order.id)
+        OrderItem.objects.create(order=self.order, product=self.drum, quantity=1, price=40)
+        stale.shipping_cost = 10
+        stale.save()
+        self.assertEqual(self.totals(), (40, 1, 52))
+        stale.tax = 4
+        stale.save(update_fields=['tax'])
+        self.assertEqual(self.totals(), (40, 1, 54))
+        self.assertEqual(stale.total_price, 54)
+
+    def test_reconcile_fixes_drift_in_bulk(self):
+        for _ in range(3):
+            OrderItem.objects.create(order=self.order, product=self.drum, quantity=1, price=40)
+        clean = Order.objects.create()
+        OrderItem.objects.create(order=clean, product=self.flute, quantity=2, price=15)
+        # bulk writes skip the signals
+        OrderItem.objects.bulk_create([OrderItem(order=self.order, product=self.flute, quantity=1, price=15, line_total=15)])
+        OrderItem.objects.filter(order=self.order, product=self.drum).update(line_total=30)
+
+        out = StringIO()
+        call_command('reconcile_order_totals', '--dry-run', stdout=out)
+        self.assertIn('Checked 2 orders, 1 drifted, 0 fixed', out.getvalue())
+        self.assertEqual(self.totals(), (120, 3, 127))
+
+        call_command('reconcile_order_totals', '--batch-size', '1', stdout=out)
+        self.assertEqual(self.totals(), (105, 4, 112))
+        self.assertEqual(self.totals(clean), (30, 1, 30))
+
+
+class SalesRollupTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fruit = Category.objects.create(name="Fruit")
+        self.veg = Category.objects.create(name="Veg")
+        self.apple = Product.objects.create(name="Apple", description="desc", price=2, stock=100, category=self.fruit)
+        self.pear = Product.objects.create(name="Pear", description="desc", price=3, stock=100, category=self.fruit)
+        self.kale = Product.objects.create(name="Kale", description="desc", price=5, stock=100, category=self.veg)
+        self.today = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        staff = User.objects.create_user(email='boss@example.com', password='pass12345', is_staff=True)
+        self.client.post(reverse('login_user'), {'email': staff.email, 'password': 'pass12345'},
+                         content_type='application/json', **self.headers)
+
+    def order(self, days_ago, status='Paid', **items):
+        products = {'apple': self.apple, 'pear': self.pear, 'kale': self.kale}
+        order = Order.objects.create(status=status)
+        for name, quantity in items.items():
+            OrderItem.objects.create(order=order, product=products[name], quantity=quantity, price=products[name].price)
+        created = self.today - timedelta(days=days_ago)
+        Order.objects.filter(id=order.id).update(created_at=created, updated_at=timezone.now())
+        return order
+
+    def refresh(self):
+        call_command('refresh_sales_rollups', stdout=StringIO())
+
+    def report(self, **params):
+        return self.client.get(reverse('sales_report'), params, **self.headers)
+
+    def test_rollups_per_day_product_and_category(self):
+        self.order(0, apple=3, kale=1)
+        self.order(0, pear=2)
+        self.order(1, apple=1)
+        self.order(0, status='Pending', kale=10)
+        self.refresh()
+
+        today = DailySales.objects.get(day=self.today.date(), dimension='all')
+        self.assertEqual((today.revenue, today.orders, today.units), (17, 2, 6))
+        fruit = DailySales.objects.get(day=self.today.date(), dimension='category', dimension_id=self.fruit.id)
+        self.assertEqual((fruit.revenue, fruit.orders, fruit.units), (12, 2, 5))
+        self.assertEqual(DailySales.objects.get(day=self.today.date(), dimension='product', dimension_id=self.kale.id).revenue, 5)
+
+        with self.assertNumQueries(2):
+            response = self.report(start=(self.today - timedelta(days=1)).date().isoformat())
+        self.assertEqual([day['revenue'] for day in response.data['days']], ['2.00', '17.00'])
+        self.assertEqual(response.data['totals']['average_basket'], '6.33')
+
+        response = self.report(dimension='product')
+        self.assertEqual([row['id'] for row in response.data['top']], [self.apple.id, self.pear.id, self.kale.id])
+        response = self.report(dimension='category', id=self.veg.id)
+        self.assertEqual(response.data['totals']['revenue'], '5.00')
+
+    def test_refresh_only_rebuilds_changed_days(self):
+        self.order(3, apple=1)
+        old = self.order(5, pear=1)
+        self.refresh()
+        untouched = DailySales.objects.get(day=(self.today - timedelta(days=5)).date(), dimension='all')
+        # runs overlap by a few minutes, orders older than that are left alone
+        Order.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+        self.order(3, kale=2)
+        self.refresh()
+        self.assertEqual(DailySales.objects.get(day=(self.today - timedelta(days=3)).date(), dimension='all').revenue, 12)
+        self.assertEqual(DailySales.objects.get(id=untouched.id).updated_at, untouched.updated_at)
+
+        # an order that stops counting drops out of its day
+        old.refresh_from_db()
+        old.status = 'Pending'
+        old.save()
+        self.refresh()
+        self.assertFalse(DailySales.objects.filter(day=(self.today - timedelta(days=5)).date()).exists())
+
+    def test_days_that_lose_their_orders_are_cleared(self):
+        gone = self.order(2, apple=1)
+        self.order(4, pear=1)
+        self.refresh()
+        Order.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        Order.objects.filter(id=gone.id).delete()
+        self.refresh()
+        self.assertFalse(DailySales.objects.filter(day=(self.today - timedelta(days=2)).date()).exists())
+        self.assertFalse(StaleSalesDay.objects.exists())
+
+        # a full rebuild also drops rollups that nothing points at any more
+        DailySales.objects.create(day=(self.today - timedelta(days=9)).date(), dimension='all', revenue=1, orders=1, units=1)
+        call_command('refresh_sales_rollups', '--full', stdout=StringIO())
+        self.assertEqual(set(DailySales.objects.values_list('day', flat=True)), {(self.today - timedelta(days=4)).date()})
+
+    def test_staff_only_and_bad_parameters(self):
+        self.assertEqual(self.report(start='yesterday').status_code, 400)
+        self.assertEqual(self.report(dimension='region').status_code, 400)
+        self.assertEqual(self.client_class().get(reverse('sales_report'), **self.headers).status_code, 401)
+        User.objects.create_user(email='shopper@example.com', password='pass12345')
+        shopper = self.client_class()
+        shopper.post(reverse('login_user'), {'email': 'shopper@example.com', 'password': 'pass12345'},
+                     content_type='application/json', **self.headers)
+        self.assertEqual(shopper.get(reverse('sales_report'), **self.headers).status_code, 403)
+
+
+class ExportTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Office")
+        self.chair = Product.objects.create(name="Chair", sku="CH-1", description="desc", price=50, stock=4, category=category)
+        self.desk = Product.objects.create(name="Desk", sku="DK-1", description="desc", price=120, stock=2, category=category)
+        guest = GuestUser.objects.create(email='finance@example.com')
+        for i in range(6):
+            order = Order.objects.create(guest_user=guest, tracking_id=f"#EX{i}", status='Paid' if i % 2 else 'Pending')
+            OrderItem.objects.create(order=order, product=self.chair, quantity=2, price=50)
+            OrderItem.objects.create(order=order, product=self.desk, quantity=1, price=120)
+        Order.objects.filter(tracking_id='#EX5').update(created_at=timezone.now() - timedelta(days=10))
+        staff = User.objects.create_user(email='finance-lead@example.com', password='pass12345', is_staff=True)
+        self.client.post(reverse('login_user'), {'email': staff.email, 'password': 'pass12345'},
+                         content_type='application/json', **self.headers)
+
+    def content(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_orders_csv_has_a_line_per_item(self):
+        response = self.client.get(reverse('export_orders'), {'status': 'Paid'}, **self.headers)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(self.content(response))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual({row['tracking_id'] for row in rows}, {'#EX1', '#EX3', '#EX5'})
+        self.assertEqual(rows[0]['customer_email'], 'finance@example.com')
+        self.assertEqual((rows[0]['sku'], rows[0]['line_total'], rows[0]['total_price']), ('CH-1', '100.00', '220.00'))
+
+    def test_orders_ndjson_with_date_range(self):
+        start = (timezone.now() - timedelta(days=1)).date().isoformat()
+        response = self.client.get(reverse('export_orders'), {'output': 'ndjson', 'start': start}, **self.headers)
+        orders = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([order['tracking_id'] for order in orders], [f"#EX{i}" for i in range(5)])
+        self.assertEqual([item['product_name'] for item in orders[0]['items']], ['Chair', 'Desk'])
+
+    def test_queries_grow_with_chunks_not_rows(self):
+        with CaptureQueriesContext(connection) as captured:
+            lines = list(stream_orders(export_orders(), 'csv', chunk_size=2))
+        self.assertEqual(len(lines), 13)
+        # one cursor over the orders and one items prefetch for each chunk of two
+        self.assertEqual(len(captured), 4)
+
+    def test_products_and_access(self):
+        response = self.client.get(reverse('export_products'), {'output': 'ndjson'}, **self.headers)
+        products = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([product['sku'] for product in products], ['CH-1', 'DK-1'])
+        self.assertEqual(self.client.get(reverse('export_products'), {'output': 'xml'}, **self.headers).status_code, 400)
+        self.assertEqual(self.client_class().get(reverse('export_orders'), **self.headers).status_code, 401)
+
+    def test_csv_cells_never_start_a_formula(self):
+        Product.objects.filter(id=self.chair.id).update(name='=HYPERLINK("http://evil.example")', sku='@SUM(A1)')
+        GuestUser.objects.update(email='+1@example.com')
+        products = list(csv.DictReader(StringIO(self.content(self.client.get(reverse('export_products'), **self.headers)))))
+        self.assertEqual((products[0]['name'], products[0]['sku']), ('\'=HYPERLINK("http://evil.example")', "'@SUM(A1)"))
+        orders = list(csv.DictReader(StringIO(self.content(self.client.get(reverse('export_orders'), **self.headers)))))
+        self.assertEqual((orders[0]['customer_email'], orders[0]['product_name']), ("'+1@example.com", products[0]['name']))
+        # ndjson is data, not a spreadsheet, it keeps the values as they are
+        response = self.client.get(reverse('export_products'), {'output': 'ndjson'}, **self.headers)
+        self.assertEqual(json.loads(self.content(response).splitlines()[0])['sku'], '@SUM(A1)')
+
+    def test_command_writes_the_same_rows(self):
+        out = StringIO()
+        call_command('export_data', 'products', stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[0], 'id,sku,name,category,price,stock,created_at,updated_at')
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+class AdminChangelistTest(TestCase):
+    def setUp(self):
+        admin_user = User.objects.create_superuser(email='admin@example.com', password='pass12345')
+        self.client.force_login(admin_user)
+        self.category = Category.objects.create(name="Garden")
+
+    def add_orders(self, count):
+        for i in range(count):
+            user = User.objects.create_user(email=f"buyer{Order.objects.count()}@example.com", password='x')
+            address = ShippingAddress.objects.create(user=user, street_address='1 Road', city='Nairobi', state='Nairobi',
+                                                     zip_code='00100', country='Kenya')
+            Order.objects.create(user=user, shipping_address=address, tracking_id=f"#ADM{Order.objects.count()}")
+
+    def changelist_queries(self, url, params=None):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(captured)
+
+    def test_stock_edits_of_sharded_products_go_to_the_shards(self):
+        product = Product.objects.create(name="Mower", description="desc", price=250, stock=10, category=self.category)
+        set_stock_shards(product.id, 2)
+        response = self.client.post(reverse('admin:app_product_change', args=[product.id]), {
+            'name': 'Mower', 'description': 'desc', 'price': '250', 'stock': '4', 'category': self.category.id,
+            'shard_count': '0',
+        })
+        self.assertEqual(response.status_code, 302)
+        product.refresh_from_db()
+        self.assertEqual((product.shard_count, product.stock), (2, 4))
+        self.assertEqual(list(product.stock_shards.order_by('shard').values_list('quantity', flat=True)), [2, 2])
+
+    def test_stock_edits_are_counts_on_hand(self):
+        product = Product.objects.create(name="Hose", description="desc", price=20, stock=10, category=self.category)
+        reserve_stock(product.id, 4)
+        response = self.client.post(reverse('admin:app_product_change', args=[product.id]), {
+            'name': 'Hose', 'description': 'desc', 'price': '20', 'stock': '8', 'category': self.category.id,
+        })
+        self.assertEqual(response.status_code, 302)
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 4)
+
+    def test_order_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:app_order_changelist')
+        self.add_orders(2)
+        few = self.changelist_queries(url)
+        self.add_orders(10)
+        self.assertEqual(self.changelist_queries(url), few)
+        self.assertEqual(self.changelist_queries(url, {'status__exact': 'Paid'}), few)
+
+    def test_order_search_is_exact(self):
+        self.add_orders(3)
+        response = self.client.get(reverse('admin:app_order_changelist'), {'q': '#ADM1'})
+        self.assertEqual([order.tracking_id for order in response.context['cl'].result_list], ['#ADM1'])
+        response = self.client.get(reverse('admin:app_order_changelist'), {'q': '#ADM'})
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    def test_product_filters_use_fixed_ranges(self):
+        for price in [5, 20, 30, 750]:
+            Product.objects.create(name=f"Hose {price}", description="desc", price=price, stock=price % 2, category=self.category)
+        url = reverse('admin:app_product_changelist')
+        response = self.client.get(url, {'price_range': '10-50'})
+        self.assertEqual(sorted(product.price for product in response.context['cl'].result_list), [20, 30])
+        response = self.client.get(url, {'price_range': '500-', 'in_stock': 'no'})
+        self.assertEqual([product.name for product in response.context['cl'].result_list], ['Hose 750'])
+        price_filter = response.context['cl'].filter_specs[0]
+        self.assertEqual(len(price_filter.lookup_choices), 5)
+
+    def test_order_form_uses_autocomplete(self):
+        response = self.client.get(reverse('admin:app_order_add'))
+        for field in ('user', 'guest_user', 'shipping_address'):
+            self.assertContains(response, f'data-field-name="{field}"')
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'term': 'buyer', 'app_label': 'app', 'model_name': 'order', 'field_name': 'user',
+        })
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_estimates_are_for_the_unfiltered_list_only(self):
+        self.add_orders(3)
+        paginator = EstimatedCountPaginator(Order.objects.filter(tracking_id='#ADM1'), 100)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(paginator.count, 1)
+        self.assertIn('COUNT', captured[0]['sql'].upper())
+
+    def test_users_get_hashed_passwords_from_the_admin(self):
+        response = self.client.post(reverse('admin:app_user_add'), {
+            'email': 'clerk@example.com', 'first_name': 'Clerk', 'last_name': 'One', 'phone_number': '0700',
+            'usable_password': 'true', 'password1': 'a-long-pass-123', 'password2': 'a-long-pass-123',
+        })
+        self.assertEqual(response.status_code, 302)
+        clerk = User.objects.get(email='clerk@example.com')
+        self.assertTrue(clerk.check_password('a-long-pass-123'))
+        self.assertFalse(clerk.is_staff)
+
+    def test_only_superusers_grant_privileges(self):
+        staff = User.objects.create_user(email='staff@example.com', password='pass12345', is_staff=True)
+        staff.user_permissions.set(Permission.objects.filter(codename__in=['view_user', 'change_user']))
+        shopper = User.objects.create_user(email='shopper@example.com', password='pass12345',
+                                           first_name='Shop', last_name='Per', phone_number='0700')
+        self.client.force_login(staff)
+        response = self.client.post(reverse('admin:app_user_change', args=[shopper.id]), {
+            'email': shopper.email, 'first_name': 'Shop', 'last_name': 'Per', 'phone_number': '0711',
+            'is_active': 'on', 'is_staff': 'on', 'is_superuser': 'on',
+        })
+        self.assertEqual(response.status_code, 302)
+        shopper.refresh_from_db()
+        self.assertEqual((shopper.phone_number, shopper.is_staff, shopper.is_superuser), ('0711', False, False))
+        admin_user = User.objects.get(email='admin@example.com')
+        response = self.client.post(reverse('admin:app_user_change', args=[admin_user.id]), {'email': 'taken@example.com'})
+        self.assertEqual(response.status_code, 403)
+
+
+class FlakyBackend(locmem.EmailBackend):
+    # fails the listed subjects, counts how often a connection is opened
+    failing = set()
+    opened = 0
+
+    def open(self):
+        if getattr(self, 'connection', None):
+            return False
+        self.connection = True
+        FlakyBackend.opened += 1
+        return True
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.subject in self.failing:
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b'no such user')})
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='app.tests.FlakyBackend')
+class OutboxTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        FlakyBackend.failing = set()
+        FlakyBackend.opened = 0
+
+    def test_password_reset_queues_the_otp(self):
+        user = User.objects.create_user(email='forgetful@example.com', password='pass12345')
+        response = self.client.post(reverse('_get_password_reset_otp'), {'email': user.email},
+                                    content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.recipients, email.status), ([user.email], 'Pending'))
+
+        stats = send_outbox()
+        self.assertEqual((stats['sent'], stats['batches']), (1, 1))
+        user.refresh_from_db()
+        self.assertIn(user.otp, mail.outbox[0].body)
+        # the otp doesn't stay behind in the outbox
+        self.assertEqual(OutboxEmail.objects.values_list('status', 'body').get(), ('Sent', ''))
+
+    def test_expired_emails_are_not_sent_or_retried(self):
+        FlakyBackend.failing = {'Late'}
+        late = queue_email("Late", ['late@example.com'], body='otp 123', expires_at=timezone.now() + timedelta(seconds=20))
+        stale = queue_email("Stale", ['stale@example.com'], body='otp 456', expires_at=timezone.now() - timedelta(seconds=1))
+        stats = send_outbox()
+        # the first retry would come after the expiry
+        self.assertEqual((stats['sent'], stats['retried'], stats['failed']), (0, 0, 2))
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(set(OutboxEmail.objects.values_list('status', 'body')), {('Failed', '')})
+        stale.refresh_from_db()
+        self.assertEqual((stale.attempts, stale.last_error), (0, 'Expired before it could be sent'))
+        late.refresh_from_db()
+        self.assertEqual(late.attempts, 1)
+
+    def test_slow_batches_keep_their_claim(self):
+        for i in range(3):
+            queue_email(f"Slow {i}", [f"slow{i}@example.com"], body='x')
+        leases = []
+
+        class SlowBackend(FlakyBackend):
+            def send_messages(self, messages):
+                time.sleep(0.3)
+                leases.append(OutboxEmail.objects.get(subject=messages[0].subject).next_attempt_at > timezone.now())
+                return super().send_messages(messages)
+
+        claim_seconds, outbox.CLAIM_SECONDS = outbox.CLAIM_SECONDS, 0.5
+        try:
+            send_batch(claim_batch(10, timezone.now()), SlowBackend())
+        finally:
+            outbox.CLAIM_SECONDS = claim_seconds
+        self.assertEqual(leases, [True, True, True])
+
+    def test_rolled_back_request_leaves_no_email(self):
+        with transaction.atomic():
+            queue_email("Never", ['nobody@example.com'], body='x')
+            transaction.set_rollback(True)
+        self.assertEqual(send_outbox()['sent'], 0)
+
+    def test_batches_share_one_connection(self):
+        for i in range(5):
+            queue_email(f"Receipt {i}", [f"buyer{i}@example.com"], body='thanks', html='<p>thanks</p>')
+        stats = send_outbox(batch_size=2)
+        self.assertEqual((stats['sent'], stats['batches']), (5, 3))
+        self.assertEqual(FlakyBackend.opened, 1)
+        self.assertEqual(mail.outbox[0].alternatives[0][0], '<p>thanks</p>')
+
+    def test_failures_back_off_then_give_up(self):
+        FlakyBackend.failing = {'Bounce'}
+        bounce = queue_email("Bounce", ['gone@example.com'], body='x')
+        queue_email("Fine", ['here@example.com'], body='x')
+
+        stats = send_outbox()
+        self.assertEqual((stats['sent'], stats['retried']), (1, 1))
+        bounce.refresh_from_db()
+        self.assertEqual((bounce.status, bounce.attempts), ('Pending', 1))
+        self.assertIn('SMTPRecipientsRefused', bounce.last_error)
+        self.assertGreater(bounce.next_attempt_at, timezone.now())
+        # not due yet
+        self.assertEqual(send_outbox()['retried'], 0)
+
+        delays = []
+        for _ in range(MAX_ATTEMPTS - 1):
+            OutboxEmail.objects.filter(id=bounce.id).update(next_attempt_at=timezone.now())
+            before = timezone.now()
+            send_outbox()
+            bounce.refresh_from_db()
+            delays.append(bounce.next_attempt_at - before)
+        self.assertEqual((bounce.status, bounce.attempts), ('Failed', MAX_ATTEMPTS))
+        self.assertGreater(delays[1], delays[0])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_command_sends_and_purges(self):
+        old = queue_email("Old", ['a@example.com'], body='x')
+        OutboxEmail.objects.filter(id=old.id).update(status='Sent', sent_at=timezone.now() - timedelta(days=30))
+        queue_email("New", ['b@example.com'], body='x')
+        out = StringIO()
+        call_command('send_outbox', stdout=out)
+        self.assertIn('Sent 1 emails', out.getvalue())
+        self.assertIn('1 old emails purged', out.getvalue())
+        self.assertEqual(list(OutboxEmail.objects.values_list('subject', flat=True)), ['New'])
+
+
+class OrderConfirmationRenderTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name="Kitchen")
+        self.product = Product.objects.create(name="Pan & Lid", description="desc", price=12, stock=50, category=self.category)
+
+    def place(self, count):
+        orders = []
+        for i in range(count):
+            guest = GuestUser.objects.create(email=f"cook{GuestUser.objects.count()}@example.com", first_name='Cook')
+            address = ShippingAddress.objects.create(guest_user=guest, street_address='2 Lane', city='Kisumu', state='Kisumu',
+                                                     zip_code='40100', country='Kenya')
+            order = Order.objects.create(guest_user=guest, shipping_address=address, shipping_cost=5, tax=2,
+                                         tracking_id=f"#CONF{Order.objects.count()}")
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, price=12)
+            orders.append(order)
+        return orders
+
+    def test_text_and_html_parts(self):
+        order = self.place(1)[0]
+        self.assertEqual(queue_order_confirmations([order.id]), 1)
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.recipients, [order.guest_user.email])
+        self.assertIn(f"Your order number is {order.tracking_id}.", email.body)
+        self.assertIn("- Pan & Lid: 2 x 12.00 = 24.00", email.body)
+        self.assertIn("2 Lane, Kisumu, Kisumu 40100, Kenya", email.body)
+        self.assertIn("<td>Pan &amp; Lid</td>", email.html)
+        send_outbox()
+        self.assertEqual(mail.outbox[0].body, email.body)
+        self.assertEqual(mail.outbox[0].alternatives[0][0], email.html)
+
+    def test_bulk_queries_grow_with_chunks_not_orders(self):
+        orders = self.place(7)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(queue_order_confirmations([order.id for order in orders], chunk_size=3), 7)
+        # orders, items prefetch and the outbox insert for each of the three chunks
+        self.assertEqual(len(captured), 9)
+
+    def test_missing_order_and_command(self):
+        response = self.client.post(reverse('send_email'), {'order_id': 999999},
+                                    content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 404)
+        self.place(3)
+        out = StringIO()
+        call_command('resend_order_confirmations', '--start', timezone.now().date().isoformat(), stdout=out)
+        self.assertIn('Queued 3 confirmation emails', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('resend_order_confirmations')
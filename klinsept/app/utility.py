@@ -1,19 +1,22 @@
 # helper functions will include otp generation,email generation
+import atexit
 import logging
+import os
 import random
+import secrets
 import string
+import threading
+import time
+from datetime import timedelta
 from django.conf import settings
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
-from django.core.mail import EmailMultiAlternatives
-
-
-
-import uuid
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
+OTP_LIFETIME = timedelta(minutes=2)
+
 # generate otp for password reset
 def generate_otp():
     characters = string.ascii_letters + string.digits
@@ -22,32 +25,113 @@ def generate_otp():
     return otp
 
 
-# generate random unique tracking id for order
+# tracking ids are unique by construction, no lookup against the unique column is needed:
+# 41 bits of milliseconds since TRACKING_EPOCH, 10 bits of worker id and a 12 bit sequence,
+# written as 13 crockford base32 characters so they also sort by creation time. track_order
+# only asks for the id, so 6 random characters (30 bits) follow and stop anyone from walking
+# the time / worker / sequence space to enumerate orders
+TRACKING_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+TRACKING_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+TRACKING_RANDOM_CHARS = 6
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+TRACKING_WORKER_KEY = 'tracking:worker:{}'
+TRACKING_WORKER_LEASE = 60 * 60  # seconds a leased worker id stays taken without renewal
+TRACKING_WORKER_RENEW = 60 * 10
+_tracking_lock = threading.Lock()
+_tracking_state = {'pid': None, 'worker': None, 'token': None, 'renewed': 0, 'ms': -1, 'sequence': 0}
+
+
+# every process needs its own worker id, two processes sharing one hand out the same ids.
+# TRACKING_WORKER_ID pins it, left empty (the default) each process leases a free one from the
+# shared cache, so forked workers that inherit the same environment still get their own
+def tracking_worker_id():
+    value = settings.TRACKING_WORKER_ID
+    if value in (None, ''):
+        return None
+    try:
+        worker = int(value)
+    except (TypeError, ValueError):
+        worker = -1
+    if not 0 <= worker < 1 << WORKER_BITS:
+        raise ImproperlyConfigured(
+            f"TRACKING_WORKER_ID must be empty or a number from 0 to {(1 << WORKER_BITS) - 1} unique to the "
+            f"worker process, got {value!r}"
+        )
+    return worker
+
+
+# cache.add only succeeds on a free id, probing from a random one keeps it to a single call
+def _lease_worker_id(token):
+    start = random.randrange(1 << WORKER_BITS)
+    for offset in range(1 << WORKER_BITS):
+        worker = (start + offset) % (1 << WORKER_BITS)
+        if cache.add(TRACKING_WORKER_KEY.format(worker), token, TRACKING_WORKER_LEASE):
+            return worker
+    raise RuntimeError("Every tracking worker id is leased by another process")
+
+
+# the lease is renewed while the process hands out ids, one that lapsed (and may have been
+# taken by another process) is swapped for a new worker id
+def _renew_worker_id(state):
+    key = TRACKING_WORKER_KEY.format(state['worker'])
+    if cache.get(key) == state['token']:
+        cache.touch(key, TRACKING_WORKER_LEASE)
+    else:
+        state['worker'] = _lease_worker_id(state['token'])
+    state['renewed'] = time.monotonic()
+
+
+def _release_worker_id():
+    state = _tracking_state
+    if state['token'] and state['pid'] == os.getpid():
+        key = TRACKING_WORKER_KEY.format(state['worker'])
+        if cache.get(key) == state['token']:
+            cache.delete(key)
+
+
 def generate_tracking_id():
-    characters = string.ascii_letters.upper() + string.digits
-    gen_id = ''.join(random.choices(characters,k=11 ))
-    unique_id =f"#{gen_id}"
-    # print(unique_id)
-    return unique_id
-# generate_tracking_id()
-
-# email helper function for sending otp
+    with _tracking_lock:
+        state = _tracking_state
+        if state['pid'] != os.getpid():
+            worker = tracking_worker_id()
+            token = None
+            if worker is None:
+                token = secrets.token_hex(8)
+                worker = _lease_worker_id(token)
+                if state['token'] is None:
+                    atexit.register(_release_worker_id)
+            state.update(pid=os.getpid(), worker=worker, token=token, renewed=time.monotonic(), ms=-1, sequence=0)
+        elif state['token'] and time.monotonic() - state['renewed'] > TRACKING_WORKER_RENEW:
+            _renew_worker_id(state)
+
+    # never step back, a clock that goes backwards keeps counting on the last millisecond
+        ms = max(int(time.time() * 1000) - TRACKING_EPOCH_MS, state['ms'])
+        if ms == state['ms']:
+            state['sequence'] += 1
+            if state['sequence'] >> SEQUENCE_BITS:
+                # 4096 ids in one millisecond, borrow the next one
+                ms += 1
+                state['sequence'] = 0
+        else:
+            state['sequence'] = 0
+        state['ms'] = ms
+        value = (ms << (WORKER_BITS + SEQUENCE_BITS)) | (state['worker'] << SEQUENCE_BITS) | state['sequence']
+
+    chars = []
+    for _ in range(13):
+        value, digit = divmod(value, 32)
+        chars.append(TRACKING_ALPHABET[digit])
+    suffix = ''.join(secrets.choice(TRACKING_ALPHABET) for _ in range(TRACKING_RANDOM_CHARS))
+    return '#' + ''.join(reversed(chars)) + suffix
+
+
+# email helper function for sending otp, queued in the outbox (see app/outbox.py)
 def otp_mail(otp, email):
+    from app.outbox import queue_email
+
     subject = "Your Password Reset OTP"
     message = f"Your OTP for password reset is: {otp}. It expires in 2 minutes."
-    try:
-        send_mail(subject, message, settings.EMAIL_HOST_USER, [email])
-        print(f"OTP email sent to {email}")
-    except Exception as e:
-        logger.error(f"Failed to send OTP email to {email}: {e}")
-        raise
-
-def send_email(subject, message, html_content, recipient_list):
-    # Create the email with both text and HTML content
-    email = EmailMultiAlternatives(
-        subject=subject,
-        body=message,
-        to=recipient_list
-    )
-    email.attach_alternative(html_content, "text/html")
-    email.send()
+    # a late otp is useless, it is dropped rather than retried past its lifetime
+    return queue_email(subject, [email], body=message, from_email=settings.EMAIL_HOST_USER,
+                       expires_at=timezone.now() + OTP_LIFETIME)
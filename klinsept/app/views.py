@@ -1,9 +1,10 @@
 from django.shortcuts import get_object_or_404
+from django.http import Http404, StreamingHttpResponse
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
-from app.models import User, Product,Order,OrderItem,Payment,GuestUser,ShippingAddress
-from .serializers import UserSerializer, ProductSerializer,OrderItemSerializer,OrderSerializer,PaymentSerializer,LoginResponseSerializer,PasswordResetOtpSerializer,VerifyOtpSerializer
+from app.models import User, Product,Order,OrderItem,Payment,GuestUser,ShippingAddress,StockReservation
+from .serializers import UserSerializer, ProductSerializer,OrderItemSerializer,CartItemSerializer,CartSerializer,OrderSummarySerializer,SalesRowSerializer,OrderSerializer,PaymentSerializer,LoginResponseSerializer,PasswordResetOtpSerializer,VerifyOtpSerializer
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.core.mail import send_mail
@@ -12,13 +13,31 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import permission_classes
 from django.core.validators import EmailValidator
 from django.core.exceptions import ValidationError
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import AuthenticationFailed, NotFound
 import jwt
 from datetime import datetime, timedelta, timezone
 from django.utils.timezone import now, timedelta
 from decouple import config
-from app.utility import otp_mail,generate_tracking_id,send_email
-from django.template.loader import render_to_string
+from app.utility import otp_mail,generate_tracking_id
+from app.emails import queue_order_confirmations
+from app.cache import cache_catalog_response
+from app.search import search_products
+from app.filters import parse_product_filters, filter_products, product_facets
+from app.pagination import KeysetCursorPagination
+from app.related import TOP_K, get_related_products
+from app.inventory import (
+    reserve_stock, release_reservations, touch_reservations, claim_reservations, rebalance_reservations, available_stock,
+    InsufficientStock, ReservationExpired
+)
+from app.orders import rollback_stats
+from app.reports import sales_by_day, top_sellers, range_totals
+from app.exports import EXPORT_FORMATS, export_orders, export_products, stream_orders, stream_products
+from app.cart import CartBusy, CartStore, cart_rows, line_total, parse_cart_operations, target_quantities
+from django.db import transaction, IntegrityError
+from django.db.models import prefetch_related_objects
+from app.managers import order_items_prefetch
+from django.db.models import F
+from app.conditional import product_validators, order_validators, not_modified_response, set_validators
 # from django.utils.html import strip_tags
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
@@ -130,8 +149,10 @@ def password_reset_otp(request):
 
         user = get_object_or_404(User, email=email)
 
-        user.set_otp()
-        otp_mail(user.otp,user.email)
+        # the otp and its email commit together, the send_outbox worker delivers it
+        with transaction.atomic():
+            user.set_otp()
+            otp_mail(user.otp,user.email)
 
         return Response({"Message": "OTP sent to your email."})
     except Exception as e:
@@ -213,22 +234,81 @@ class ProductPagination(PageNumberPagination):
     page_size_query_param = 'page_size'  # Allow client to change page size with ?page_size=5
     max_page_size = 100  # Limit the maximum page size
 
+# keyset pagination for infinite scroll, select it with ?pagination=cursor
+# every page costs the same since there is no OFFSET and no COUNT(*) unless ?count=true
+class ProductCursorPagination(KeysetCursorPagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering_query_param = 'ordering'
+    # the cursor holds both values, so a page filters on (price, id) past the last row
+    # instead of stepping over every product sharing its price (see app/pagination.py)
+    orderings = {
+        'created_at': ('created_at', 'id'),
+        '-created_at': ('-created_at', '-id'),
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id'),
+    }
+    default_ordering = '-created_at'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        return self.orderings.get(ordering, self.orderings[self.default_ordering])
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = queryset.count() if request.query_params.get('count') == 'true' else None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data['count'] = self.count
+        return response
+
+def get_product_paginator(request):
+    if request.query_params.get('pagination') == 'cursor':
+        return ProductCursorPagination()
+    return ProductPagination()
+
 @swagger_auto_schema(
     method="get",
+    manual_parameters=[
+        openapi.Parameter('category', openapi.IN_QUERY, description="Comma separated category ids", type=openapi.TYPE_STRING),
+        openapi.Parameter('min_price', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+        openapi.Parameter('max_price', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+        openapi.Parameter('in_stock', openapi.IN_QUERY, description="true to only list products in stock", type=openapi.TYPE_BOOLEAN),
+        openapi.Parameter('facets', openapi.IN_QUERY, description="true to include facet counts", type=openapi.TYPE_BOOLEAN),
+        openapi.Parameter('pagination', openapi.IN_QUERY, description="cursor for keyset pagination", type=openapi.TYPE_STRING),
+    ],
     responses={
         200: ProductSerializer,
-        400: "Expired cookie",
+        400: "Invalid filter",
         404: "User not found",
         500: "Internal server error",
 })
 @api_view(['GET'])
+@cache_catalog_response
 def getProducts(request):
     try:
-        products = Product.objects.all()
-        paginator = ProductPagination()
+        filters = parse_product_filters(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        products = filter_products(Product.objects.for_serializer().order_by('id'), filters)
+        paginator = get_product_paginator(request)
         paginated_products = paginator.paginate_queryset(products, request)
+        etag, last_modified = product_validators(paginated_products, listing=True)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
         serializer = ProductSerializer(paginated_products, many=True)
-        return paginator.get_paginated_response(serializer.data)
+        response = paginator.get_paginated_response(serializer.data)
+        # facet counts for the filter sidebar, opt in with ?facets=true
+        if request.query_params.get('facets') == 'true':
+            response.data['facets'] = product_facets(Product.objects.all(), filters)
+        return set_validators(response, etag, last_modified)
+    except NotFound as e:
+        return Response({'error': str(e.detail)}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
   
@@ -243,41 +323,96 @@ def getProducts(request):
 })
 
 @api_view(['GET'])
+@cache_catalog_response
 def get_product_by_id(request,id):
     try:
-        products = get_object_or_404(Product,id=id)
+        products = get_object_or_404(Product.objects.for_serializer(),id=id)
+        # lists show the reconciled stock, the detail page sums a sharded product's shards
+        products.stock = available_stock(products)
+        etag, last_modified = product_validators([products])
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
         serializer = ProductSerializer(products)
-        return Response(serializer.data,status=status.HTTP_200_OK)
+        return set_validators(Response(serializer.data,status=status.HTTP_200_OK), etag, last_modified)
 
+    except Http404:
+        return Response({'error': "Product not found"}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
-        return Response ({'error':str(e),status:status.HTTP_500_INTERNAL_SERVER_ERROR})
+        return Response ({'error':str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+RELATED_PRODUCTS_LIMIT = 10
 
 @swagger_auto_schema(
     method="get",
+    manual_parameters=[
+        openapi.Parameter('limit', openapi.IN_QUERY, description="Number of related products, at most 20", type=openapi.TYPE_INTEGER),
+    ],
     responses={
         200: ProductSerializer,
         400: "Expired cookie",
         404: "User not found",
         500: "Internal server error",
 })
-# get related products 
+# get related products, read from the precomputed RelatedProduct table
 @api_view(['GET'])
+@cache_catalog_response
 def related_products(request,id):
     try:
-        products = get_object_or_404(Product,id=id)
-        category = Product.objects.filter(category=products.category).exclude(id=products.id)
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', RELATED_PRODUCTS_LIMIT)), TOP_K))
+        except ValueError:
+            limit = RELATED_PRODUCTS_LIMIT
+
+        category = get_related_products(id, limit)
+        if not category:
+            # not refreshed yet, fall back to a bounded slice of the same category
+            products = get_object_or_404(Product,id=id)
+            category = Product.objects.for_serializer().filter(category_id=products.category_id).exclude(id=products.id).order_by('id')[:limit]
 
         serializer = ProductSerializer(category, many=True)
         
         return Response(serializer.data)
     
-    except Product.DoesNotExist:
+    except Http404:
         return Response({"message": "Product not found"}, status=404)
     
     except Exception as e:
         return Response({"message": "An error occurred while retrieving related products."}, status=500)    
 
 
+@swagger_auto_schema(
+    method="get",
+    manual_parameters=[
+        openapi.Parameter('q', openapi.IN_QUERY, description="Search terms", type=openapi.TYPE_STRING, required=True),
+        openapi.Parameter('category', openapi.IN_QUERY, description="Category id or name", type=openapi.TYPE_STRING),
+    ],
+    responses={
+        200: ProductSerializer,
+        400: "Search terms are required",
+        500: "Internal server error",
+})
+# ranked full text search over product name and description
+@api_view(['GET'])
+@cache_catalog_response
+def search_product(request):
+    terms = request.query_params.get('q', '').strip()
+    if not terms:
+        return Response({"error": "Search terms are required"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        products = Product.objects.for_serializer()
+        category = request.query_params.get('category')
+        if category:
+            products = products.filter(category_id=category) if category.isdigit() else products.filter(category__name__iexact=category)
+
+        paginator = ProductPagination()
+        paginated_products = paginator.paginate_queryset(search_products(products, terms), request)
+        serializer = ProductSerializer(paginated_products, many=True)
+        return paginator.get_paginated_response(serializer.data)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 #----------------------------------------contact the company using email --------------------------#
 @api_view(['POST'])
 def contact(request):
@@ -288,166 +423,249 @@ def contact(request):
 # add to cart
 @api_view(['POST'])
 def add_to_cart(request):
+    data = request.data
+    product_id = data.get('product_id')
     try:
-        data = request.data
-        product_id = data.get('product_id')
-        quantity = data.get('quantity',1) #default product is one 
-
-        product = get_object_or_404(Product, id=product_id)
-        # check the product stock
-        if product.stock < quantity:
-            return Response({'error': 'Insufficient stock'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Check if the product is already in the user's cart
-        cart_item, created = OrderItem.objects.get_or_create(
-            product=product,
-            defaults={'quantity': quantity, 'price': product.price}
-        )
+        quantity = int(data.get('quantity',1)) #default product is one 
+    except (TypeError, ValueError):
+        return Response({'error': 'Quantity must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+    if quantity < 1:
+        return Response({'error': 'Quantity must be at least 1'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        product = Product.objects.for_serializer().get(id=product_id)
+    except (Product.DoesNotExist, ValueError):
+        return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        if not created:
-            # If the product is already in the cart, update the quantity
-            cart_item.quantity += quantity
-            cart_item.line_total = cart_item.quantity * cart_item.price
-            cart_item.save()
-    #   reduce the items in the product stock
+    try:
+        cart = CartStore.for_request(request)
+        with cart.lock():
+            # reduce the items in the product stock, fails if someone else took it first
+            reservation = reserve_stock(product.id, quantity)
+            line = cart.add(product, quantity, reservation.id)
+            touch_reservations(cart.reservation_ids())
         product.stock -= quantity
-        product.save()
 
-        serializer = OrderItemSerializer(cart_item)
-        return Response(serializer.data, status=status.HTTP_200_OK) #to send serilized data using id to get cart items 
+        serializer = CartItemSerializer({
+            'id': product.id, 'product': product, 'quantity': line['quantity'],
+            'price': line['price'], 'line_total': line_total(line),
+        })
+        return cart.attach(Response(serializer.data, status=status.HTTP_200_OK))
 
+    except InsufficientStock:
+        return Response({'error': 'Insufficient stock'}, status=status.HTTP_400_BAD_REQUEST)
+    except Product.DoesNotExist:
+        return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
+    except CartBusy as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-# get items in cart
-# to be fixed 
+# get items in the caller's cart
 @api_view(['GET'])
 def get_cart_items(request):
     try:
-        cart_items = OrderItem.objects.all()
-        serializer = OrderItemSerializer(cart_items, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        cart = CartStore.for_request(request)
+        serializer = CartItemSerializer(cart_rows(cart.lines()), many=True)
+        return cart.attach(Response(serializer.data, status=status.HTTP_200_OK))
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-# remove from cart
+# remove a product from the cart, id is the product id
 @api_view(['DELETE'])
 def remove_from_cart(request, id):
     try:
-        cart_item = get_object_or_404(OrderItem, id=id)
-        cart_item.delete()
-        cart_items = OrderItem.objects.all()
-        serializer = OrderItemSerializer(cart_items, many=True)
-        return Response({'cart':serializer.data,'message':'Item removed from cart successfully'},
+        cart = CartStore.for_request(request)
+        with cart.lock():
+            line = cart.remove(id)
+            if line is None:
+                return Response({'error': 'Item not in cart'}, status=status.HTTP_404_NOT_FOUND)
+            # give the held stock back
+            release_reservations(StockReservation.objects.filter(id__in=line['reservations']))
+            lines = cart.lines()
+            touch_reservations(cart.reservation_ids(lines))
+        serializer = CartItemSerializer(cart_rows(lines), many=True)
+        return cart.attach(Response({'cart':serializer.data,'message':'Item removed from cart successfully'},
                             status=status.HTTP_200_OK
-                        )
+                        ))
+    except CartBusy as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# several add / update / remove operations in one request, e.g. restoring a saved cart
+# {"operations": [{"op": "add", "product_id": 1, "quantity": 2}, {"op": "remove", "product_id": 3}]}
+@api_view(['POST'])
+def cart_batch(request):
+    try:
+        operations = parse_cart_operations(request.data.get('operations'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        cart = CartStore.for_request(request)
+        with cart.lock():
+            lines = cart.lines()
+            targets = target_quantities(lines, operations)
+            # every product in the cart or the batch, in one query
+            products = Product.objects.for_serializer().in_bulk(set(lines) | set(targets))
+            missing = sorted(product_id for product_id, quantity in targets.items() if quantity and product_id not in products)
+            if missing:
+                return Response({'error': 'Product not found', 'product_ids': missing}, status=status.HTTP_404_NOT_FOUND)
+
+            changes = {
+                product_id: (lines[product_id]['reservations'] if product_id in lines else [], quantity)
+                for product_id, quantity in targets.items() if quantity or product_id in lines
+            }
+            reservations, deltas = rebalance_reservations(changes)
+
+            for product_id, (_, quantity) in changes.items():
+                if quantity:
+                    price = lines[product_id]['price'] if product_id in lines else products[product_id].price
+                    lines[product_id] = {'quantity': quantity, 'price': price, 'reservations': [reservations[product_id].id]}
+                else:
+                    lines.pop(product_id, None)
+            for product_id, delta in deltas.items():
+                if product_id in products:
+                    products[product_id].stock -= delta
+            cart.save(lines)
+            touch_reservations([
+                reservation for product_id, line in lines.items() if product_id not in changes for reservation in line['reservations']
+            ])
+
+        serializer = CartSerializer({
+            'cart': cart_rows(lines, products),
+            'count': sum(line['quantity'] for line in lines.values()),
+            'total': sum((line_total(line) for line in lines.values()), 0),
+        })
+        return cart.attach(Response(serializer.data, status=status.HTTP_200_OK))
+
+    except InsufficientStock as e:
+        return Response({'error': 'Insufficient stock', 'product_id': e.product_id}, status=status.HTTP_400_BAD_REQUEST)
+    except CartBusy as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
 
+# the order, its items and their products for the response, in one query
+def order_response(order, status_code, replayed=False):
+    prefetch_related_objects([order], order_items_prefetch())
+    serializer = OrderSerializer(order)
+    response = Response({"order": serializer.data, "order_id": order.id}, status=status_code)
+    if replayed:
+        response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+# a retry answers with the order the key already made, as long as it is the same customer's
+def replay_order(idempotency_key, user, guest_email):
+    order = Order.objects.for_serializer().filter(idempotency_key=idempotency_key).first()
+    if order is None:
+        return None
+    same_customer = order.user_id == user.id if user else (order.guest_user and order.guest_user.email == guest_email)
+    if not same_customer:
+        return Response({"error": f"{IDEMPOTENCY_HEADER} was already used for another order"},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return order_response(order, status.HTTP_201_CREATED, replayed=True)
+
+
+# everything is checked before the first write, the writes then run as one transaction:
+# guest, address, order (tracking id included), bulk items and one UPDATE claiming the reservations
 @api_view(['POST'])
 def create_order(request):
     try:
         data = request.data
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER) or None
+        if idempotency_key and len(idempotency_key) > 64:
+            return Response({"error": f"{IDEMPOTENCY_HEADER} must be at most 64 characters"}, status=status.HTTP_400_BAD_REQUEST)
+
         token = request.COOKIES.get('jwt')
         user = None
-        guest_user = None
+        guest_email = None
         if token:
             try:
                 payload = jwt.decode(token, config('SECRET'), algorithms=['HS256'])
                 user = User.objects.filter(id=payload['id']).first()
-                print(f"Authenticated user found: {user}")
             except jwt.ExpiredSignatureError:
                 return Response({"error": "Token has expired"}, status=status.HTTP_401_UNAUTHORIZED)
             except jwt.InvalidTokenError:
                 return Response({"error": "Invalid token"}, status=status.HTTP_401_UNAUTHORIZED)
-        
+
         if not user:
-            guest_first_name = request.data.get('guest_FirstName')
-            guest_last_name = request.data.get('guest_LastName')
-            guest_phone = request.data.get('guest_phone')
             guest_email = data.get('guest_email')
-
             if not guest_email:
                 return Response({"error": "Invalid email format"}, status=status.HTTP_400_BAD_REQUEST)
-            
+
             validator = EmailValidator()
             try:
                 validator(guest_email)
             except ValidationError:
                 return Response({"error": "Invalid email format"}, status=status.HTTP_400_BAD_REQUEST)
-            
-            existing_user = GuestUser.objects.filter(email=guest_email).first()
-            if existing_user:
-                # Use the existing user instead of creating a guest user
-                guest_user = existing_user
-                print(f"Using existing registered user for email: {guest_email}")
-            else:
-                # Create a new guest user if not found
-                guest_user = GuestUser.objects.create(
-                    email=guest_email,
-                    first_name=guest_first_name,
-                    last_name=guest_last_name,
-                    phone_number=guest_phone
-                )
-
-        print("Shipping Address Creating")
-
-        if user:
-            shipping_address = ShippingAddress.objects.create(
-                user=user,
-                street_address=data.get('address'),
-                city=data.get('city'),
-                state=data.get('state'),
-                zip_code=data.get('zip_code'),
-                country=data.get('country')
-            )
-        elif guest_user:
-            shipping_address = ShippingAddress.objects.create(
-                guest_user=guest_user,
-                street_address=data.get('address'),
-                city=data.get('city'),
-                state=data.get('state'),
-                zip_code=data.get('zip_code'),
-                country=data.get('country')
-            )
-        else:
-            return Response({"error": "User or guest user must be provided"}, status=status.HTTP_400_BAD_REQUEST)
-
-        print(f"Shipping Address Created: {shipping_address}")
-
-        order_item_id = data.get('order_item_id', [])
-        if not order_item_id:
-            return Response({"error": "No order items provided"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Fetch the existing OrderItems by their IDs
-        order_items = OrderItem.objects.filter(id__in=order_item_id)
-
-        # If any of the order items are not found, return an error
-        if len(order_items) != len(order_item_id):
-            return Response({"error": "Some order items not found"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Create the order with the shipping address and total amount
-        total_price = sum(item.line_total for item in order_items)  # Calculate the total amount for the order
-        order = Order.objects.create(
-            user=user,
-            guest_user=guest_user,
-            shipping_address=shipping_address,
-            total_price=total_price  # Use the total amount calculated from the order items
-        )
-        order.tracking_id = generate_tracking_id()
-
-        # Add order items to the order
-        order.items.set(order_items)  # Set the order items for this order
-    
-        order.save()
 
-        # Serialize and return the order data
-        serializer = OrderSerializer(order)
-        return Response({"order": serializer.data, "order_id": order.id}, status=status.HTTP_201_CREATED)
-        
-
-       
+        cart = CartStore.for_request(request)
+        # held until the cart is cleared, a concurrent add can't slip in between
+        with cart.lock():
+            # looked up under the lock, a concurrent retry that got here first has cleared the cart
+            if idempotency_key:
+                replayed = replay_order(idempotency_key, user, guest_email)
+                if replayed is not None:
+                    return replayed
+
+            lines = cart.lines()
+            if not lines:
+                return Response({"error": "No order items provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+            address = {
+                'street_address': data.get('address'), 'city': data.get('city'), 'state': data.get('state'),
+                'zip_code': data.get('zip_code'), 'country': data.get('country'),
+            }
+            try:
+                with transaction.atomic():
+                    guest_user = None
+                    if not user:
+                        # an existing guest with this email is reused
+                        guest_user, _ = GuestUser.objects.get_or_create(email=guest_email, defaults={
+                            'first_name': data.get('guest_FirstName'),
+                            'last_name': data.get('guest_LastName'),
+                            'phone_number': data.get('guest_phone'),
+                        })
+                    shipping_address = ShippingAddress.objects.create(user=user, guest_user=guest_user, **address)
+
+                    total_price = sum(line_total(line) for line in lines.values())  # Calculate the total amount for the order
+                    order = Order.objects.create(
+                        user=user,
+                        guest_user=guest_user,
+                        shipping_address=shipping_address,
+                        subtotal=total_price,
+                        item_count=len(lines),
+                        total_price=total_price,
+                        tracking_id=generate_tracking_id(),
+                        idempotency_key=idempotency_key,
+                    )
+                    # the cart lines become order items here, together with their stock reservations
+                    order_items = OrderItem.objects.bulk_create([
+                        OrderItem(order=order, product_id=product_id, quantity=line['quantity'],
+                                  price=line['price'], line_total=line_total(line))
+                        for product_id, line in lines.items()
+                    ])
+                    claim_reservations([(item, line['reservations']) for item, line in zip(order_items, lines.values())])
+            except IntegrityError:
+                # a concurrent retry with the same key got there first
+                replayed = replay_order(idempotency_key, user, guest_email) if idempotency_key else None
+                if replayed is None:
+                    raise
+                return replayed
+            cart.clear()
+
+        return order_response(order, status.HTTP_201_CREATED)
+
+    except ReservationExpired:
+        return Response({"error": "Your cart expired, please add the items again"}, status=status.HTTP_409_CONFLICT)
+    except CartBusy as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -463,13 +681,240 @@ def get_order(request):
 
     # Fetch the order based on the provided order ID
     try:
-        order = Order.objects.get(id=order_id)
-    except Order.DoesNotExist:
+        order = Order.objects.for_serializer().get(id=order_id)
+    except (Order.DoesNotExist, ValueError):
         return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
 
+    # answer 304 before serializing if the client copy is still current
+    etag, last_modified = order_validators(order)
+    not_modified = not_modified_response(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
     # Serialize and return the order data
     serialized = OrderSerializer(order)
-    return Response(serialized.data, status=status.HTTP_200_OK)
+    return set_validators(Response(serialized.data, status=status.HTTP_200_OK), etag, last_modified)
+
+# newest first, the cursor keeps (created_at, id) so orders placed in the same instant page by id
+class OrderCursorPagination(KeysetCursorPagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    ordering = ('-created_at', '-id')
+
+ORDER_STATUSES = ('Paid', 'Pending')
+
+@swagger_auto_schema(
+    method="get",
+    manual_parameters=[
+        openapi.Parameter('status', openapi.IN_QUERY, description="Paid or Pending", type=openapi.TYPE_STRING),
+        openapi.Parameter('guest_email', openapi.IN_QUERY, description="Guests only, with tracking_id", type=openapi.TYPE_STRING),
+        openapi.Parameter('tracking_id', openapi.IN_QUERY, description="Guests only, any of their orders", type=openapi.TYPE_STRING),
+    ],
+    responses={
+        200: OrderSummarySerializer(many=True),
+        400: "Invalid status",
+        401: "Unauthenticated",
+        404: "No orders for this guest",
+        500: "Internal server error",
+})
+# order history of the logged in user, guests show one of their tracking ids with their email instead
+@api_view(['GET'])
+def get_user_orders(request):
+    order_status = request.query_params.get('status')
+    if order_status and order_status not in ORDER_STATUSES:
+        return Response({"error": f"status must be one of {', '.join(ORDER_STATUSES)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        token = request.COOKIES.get('jwt')
+        if token:
+            try:
+                payload = jwt.decode(token, config('SECRET'), algorithms=['HS256'])
+            except jwt.ExpiredSignatureError:
+                return Response({"error": "Token has expired"}, status=status.HTTP_401_UNAUTHORIZED)
+            except jwt.InvalidTokenError:
+                return Response({"error": "Invalid token"}, status=status.HTTP_401_UNAUTHORIZED)
+            orders = Order.objects.filter(user_id=payload['id'])
+        else:
+            guest_email = request.query_params.get('guest_email')
+            tracking_id = request.query_params.get('tracking_id')
+            if not guest_email or not tracking_id:
+                return Response({"error": "Log in, or give guest_email and tracking_id"}, status=status.HTTP_401_UNAUTHORIZED)
+            guest_user_id = Order.objects.filter(
+                guest_user__email=guest_email, tracking_id=tracking_id
+            ).values_list('guest_user_id', flat=True).first()
+            if guest_user_id is None:
+                return Response({"error": "No orders found"}, status=status.HTTP_404_NOT_FOUND)
+            orders = Order.objects.filter(guest_user_id=guest_user_id)
+
+        if order_status:
+            orders = orders.filter(status=order_status)
+        paginator = OrderCursorPagination()
+        page = paginator.paginate_queryset(orders.summaries(), request)
+        serializer = OrderSummarySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    except NotFound as e:
+        return Response({"error": str(e.detail)}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@swagger_auto_schema(
+    method="get",
+    responses={
+        200: OrderSummarySerializer,
+        404: "Order not found",
+        500: "Internal server error",
+})
+# order status by tracking id, one lookup on the unique index. the leading # is optional since
+# it has to be sent as %23 in a path
+@api_view(['GET'])
+def track_order(request, tracking_id):
+    try:
+        if not tracking_id.startswith('#'):
+            tracking_id = f"#{tracking_id}"
+        order = Order.objects.summaries().filter(tracking_id=tracking_id).first()
+        if order is None:
+            return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = OrderSummarySerializer(order)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# error response for anyone but a logged in staff user, None when allowed
+def staff_only(request):
+    token = request.COOKIES.get('jwt')
+    if not token:
+        return Response({"error": "Unauthenticated"}, status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        payload = jwt.decode(token, config('SECRET'), algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return Response({"error": "Unauthenticated"}, status=status.HTTP_401_UNAUTHORIZED)
+    if not User.objects.filter(id=payload['id'], is_staff=True).exists():
+        return Response({"error": "Staff only"}, status=status.HTTP_403_FORBIDDEN)
+    return None
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+SALES_REPORT_DAYS = 30
+SALES_DIMENSIONS = ('all', 'product', 'category')
+
+@swagger_auto_schema(
+    method="get",
+    manual_parameters=[
+        openapi.Parameter('start', openapi.IN_QUERY, description="YYYY-MM-DD, 30 days ago by default", type=openapi.TYPE_STRING),
+        openapi.Parameter('end', openapi.IN_QUERY, description="YYYY-MM-DD, today by default", type=openapi.TYPE_STRING),
+        openapi.Parameter('dimension', openapi.IN_QUERY, description="all, product or category", type=openapi.TYPE_STRING),
+        openapi.Parameter('id', openapi.IN_QUERY, description="Product or category id, without it the top sellers are listed", type=openapi.TYPE_INTEGER),
+        openapi.Parameter('limit', openapi.IN_QUERY, description="Number of top sellers, at most 100", type=openapi.TYPE_INTEGER),
+    ],
+    responses={
+        200: SalesRowSerializer(many=True),
+        400: "Invalid parameters",
+        401: "Unauthenticated",
+        403: "Staff only",
+        500: "Internal server error",
+})
+# sales dashboard for staff, reads the DailySales rollups only (see refresh_sales_rollups)
+@api_view(['GET'])
+def sales_report(request):
+    denied = staff_only(request)
+    if denied is not None:
+        return denied
+
+    params = request.query_params
+    try:
+        end = parse_date(params.get('end')) or now().date()
+        start = parse_date(params.get('start')) or end - timedelta(days=SALES_REPORT_DAYS - 1)
+        dimension_id = int(params['id']) if params.get('id') else None
+        limit = min(max(int(params.get('limit', 10)), 1), 100)
+    except ValueError:
+        return Response({"error": "Dates must be YYYY-MM-DD, id and limit numbers"}, status=status.HTTP_400_BAD_REQUEST)
+    dimension = params.get('dimension', 'all')
+    if dimension not in SALES_DIMENSIONS:
+        return Response({"error": f"dimension must be one of {', '.join(SALES_DIMENSIONS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    if start > end:
+        return Response({"error": "start is after end"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        report = {'start': start, 'end': end, 'dimension': dimension}
+        if dimension != 'all' and dimension_id is None:
+            report['top'] = SalesRowSerializer(top_sellers(start, end, dimension, limit), many=True).data
+        else:
+            dimension_id = dimension_id if dimension != 'all' else None
+            days = sales_by_day(start, end, dimension, dimension_id or 0)
+            report['id'] = dimension_id
+            report['days'] = SalesRowSerializer(days, many=True).data
+            report['totals'] = SalesRowSerializer(range_totals(days)).data
+        return Response(report, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# export parameters shared by the order and product exports, returns (output, start, end) or an error response
+def export_params(request):
+    output = request.query_params.get('output', 'csv')
+    if output not in EXPORT_FORMATS:
+        return Response({"error": f"output must be one of {', '.join(EXPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        return output, parse_date(request.query_params.get('start')), parse_date(request.query_params.get('end'))
+    except ValueError:
+        return Response({"error": "Dates must be YYYY-MM-DD"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def export_response(rows, output, name):
+    response = StreamingHttpResponse(rows, content_type=EXPORT_CONTENT_TYPES[output])
+    response['Content-Disposition'] = f'attachment; filename="{name}.{output}"'
+    return response
+
+@swagger_auto_schema(
+    method="get",
+    manual_parameters=[
+        openapi.Parameter('output', openapi.IN_QUERY, description="csv (a line per item) or ndjson (an object per order)", type=openapi.TYPE_STRING),
+        openapi.Parameter('start', openapi.IN_QUERY, description="YYYY-MM-DD, orders created on or after", type=openapi.TYPE_STRING),
+        openapi.Parameter('end', openapi.IN_QUERY, description="YYYY-MM-DD, orders created on or before", type=openapi.TYPE_STRING),
+        openapi.Parameter('status', openapi.IN_QUERY, description="Paid or Pending", type=openapi.TYPE_STRING),
+    ],
+    responses={200: "Streamed file", 400: "Invalid parameters", 401: "Unauthenticated", 403: "Staff only"},
+)
+# streamed order dump with items, shipping and customer email, staff only
+@api_view(['GET'])
+def export_orders_view(request):
+    denied = staff_only(request)
+    if denied is not None:
+        return denied
+    params = export_params(request)
+    if isinstance(params, Response):
+        return params
+    output, start, end = params
+    order_status = request.query_params.get('status')
+    if order_status and order_status not in ORDER_STATUSES:
+        return Response({"error": f"status must be one of {', '.join(ORDER_STATUSES)}"}, status=status.HTTP_400_BAD_REQUEST)
+    return export_response(stream_orders(export_orders(start, end, order_status), output), output, 'orders')
+
+@swagger_auto_schema(
+    method="get",
+    manual_parameters=[
+        openapi.Parameter('output', openapi.IN_QUERY, description="csv or ndjson", type=openapi.TYPE_STRING),
+        openapi.Parameter('start', openapi.IN_QUERY, description="YYYY-MM-DD, products created on or after", type=openapi.TYPE_STRING),
+        openapi.Parameter('end', openapi.IN_QUERY, description="YYYY-MM-DD, products created on or before", type=openapi.TYPE_STRING),
+    ],
+    responses={200: "Streamed file", 400: "Invalid parameters", 401: "Unauthenticated", 403: "Staff only"},
+)
+# streamed product dump, staff only
+@api_view(['GET'])
+def export_products_view(request):
+    denied = staff_only(request)
+    if denied is not None:
+        return denied
+    params = export_params(request)
+    if isinstance(params, Response):
+        return params
+    output, start, end = params
+    return export_response(stream_products(export_products(start, end), output), output, 'products')
 
 # -------------------------------------------------------------- send order to email -----------------------------------#
 @api_view(['POST'])
@@ -479,39 +924,11 @@ def send_order_confirmation_email(request):
         return Response({"error": "Order ID is required"}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        # Fetch the order and associated data
-        order = Order.objects.get(id=order_id)
-        serializer = OrderSerializer(order)
-
-        # Render the HTML content for the email using the template
-        html_content = render_to_string("emails/order_confirmation.html", {
-            "user_name": order.user.first_name if order.user else order.guest_user.first_name,
-            "tracking_no": order.tracking_id,
-            "order_items": serializer.data['items'],
-            "total_price": order.total_price,
-            'zip_code': order.shipping_address.zip_code,
-            'country': order.shipping_address.country,
-            'city':order.shipping_address.city,
-            'state': order.shipping_address.state,
-            'street_address': order.shipping_address.street_address,
-            'shipping_cost':order.shipping_cost,
-            'tax':order.tax
-            
-        })
-
-        # Send the email using the utility function
-        recipient_email = order.user.email if order.user else order.guest_user.email
-        send_email(
-            subject="Order Confirmation - Klinsept",
-            message="",
-            html_content=html_content,
-            recipient_list=[recipient_email]
-        )
+        # two reads and one outbox insert, the email is rendered from a flat context (see app/emails.py)
+        if not queue_order_confirmations([order_id]):
+            return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"message": "Order confirmation email queued"}, status=status.HTTP_200_OK)
 
-        return Response({"message": "Order confirmation email sent successfully"}, status=status.HTTP_200_OK)
-
-    except Order.DoesNotExist:
-        return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -550,27 +967,15 @@ def create_payment(request):
 
 
 # ----------------------------------------------------------- check status on order and rollback --------------------------------------#
+# the rollback itself runs in the rollback_pending_orders command, this only reports its last run
 @api_view(["GET"])
 def check_pending_orders(request):
     try:
-        time_limit = now() - timedelta(minutes=1)
-        pending_orders = Order.objects.filter(status='Pending', created_at__lte=time_limit)
-
-        if pending_orders.exists():
-            for order in pending_orders:
-                # Rollback order by returning items to inventory
-                for item in order.items.all():
-                    product = item.product
-                    product.stock += item.quantity
-                    product.save()
-
-                # Delete the pending order
-                order.delete()
-
-            return Response({"message": "Rolled back orders."}, status=status.HTTP_200_OK)
-        else:
-            # If no orders found that are older than 1 hour
-            return Response({"message": "No orders to rollback; all pending orders are within 1 hour."}, status=status.HTTP_200_OK)
+        stats = rollback_stats()
+        if stats is None:
+            return Response({"message": "Pending orders have not been rolled back yet."}, status=status.HTTP_200_OK)
+        pending = Order.objects.filter(status='Pending').count()
+        return Response({"last_run": stats, "pending_orders": pending}, status=status.HTTP_200_OK)
 
     except Exception as e:
         return Response({"error":str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
@@ -12,7 +12,8 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
-from decouple import config
+import sys
+from decouple import config, Csv
 from datetime import timedelta #for time
 
 
@@ -96,22 +97,27 @@ WSGI_APPLICATION = 'klinsept.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-# DATABASES = {
-#     'default': {
-#         'ENGINE': 'django.db.backends.sqlite3',
-#         'NAME': BASE_DIR / 'klinsept_db.sqlite3',
-#     }
-# }
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': config('DB_NAME'),
-        'USER': config('DB_USER'),
-        'PASSWORD': config('DB_PASSWORD'),
-        'HOST': config('DB_HOST'),
-        'PORT': config('DB_PORT', default='5432'),
+# DB_ENGINE=sqlite3 runs against a local file, e.g for load data, benchmarks or the test suite without postgres
+if config('DB_ENGINE', default='postgresql') == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / config('DB_NAME', default='klinsept_db.sqlite3'),
+            # a file rather than shared memory so concurrency tests can lock and wait like a real database
+            'TEST': {'NAME': BASE_DIR / 'test_klinsept_db.sqlite3'},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME'),
+            'USER': config('DB_USER'),
+            'PASSWORD': config('DB_PASSWORD'),
+            'HOST': config('DB_HOST'),
+            'PORT': config('DB_PORT', default='5432'),
+        }
     }
-}
 
 
 # Password validation
@@ -169,18 +175,39 @@ CORS_ALLOW_HEADERS = [
     'content-type',
     'authorization',  # Allow custom Authorization headers
     'x-api-key',  # Allow X-Requested-With header (useful for AJAX requests)
+    'x-cart-id',  # anonymous cart id for clients that don't keep cookies
+    'idempotency-key',  # create_order retries return the original order
     'accept',
     'origin',
     'x-custom-header',  # Example of a custom header you'd like to allow
     'X-Frame-Options',   # Another example of a custom header
 ]
 CORS_ALLOW_CREDENTIALS = True
+CORS_EXPOSE_HEADERS = ['x-cart-id', 'idempotent-replayed']
 
+# every worker has to see the same catalog version, carts and counters, so the default is redis.
+# a local memory cache fails the app.E001 check outside DEBUG, silence it only for a single process
+# setup, e.g CACHE_BACKEND=django.core.cache.backends.locmem.LocMemCache SILENCED_SYSTEM_CHECKS=app.E001
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.redis.RedisCache'),
+        'LOCATION': config('CACHE_LOCATION', default='redis://127.0.0.1:6379/1'),
     }
 }
+SILENCED_SYSTEM_CHECKS = config('SILENCED_SYSTEM_CHECKS', default='', cast=Csv())
+if 'test' in sys.argv:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    # the test runner is a single process
+    SILENCED_SYSTEM_CHECKS = ['app.E001']
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', default=60 * 15, cast=int)  # seconds
+CART_TTL = config('CART_TTL', default=60 * 60, cast=int)  # seconds since the last cart change, held stock is released after it
+# 0-1023 and unique per worker process if set, empty leases one per process from the shared cache
+TRACKING_WORKER_ID = config('TRACKING_WORKER_ID', default='')
+PENDING_ORDER_TTL = config('PENDING_ORDER_TTL', default=60, cast=int)  # seconds an unpaid order keeps its stock, see rollback_pending_orders
 
 # configure stmp server for email configuration
 # settings.py
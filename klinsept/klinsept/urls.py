@@ -19,9 +19,10 @@ from django.contrib import admin
 from django.urls import path, re_path
 from app.views import (
     getProducts, RegisterUser, LoginUser, password_reset_otp, verify_otp,
-    Logout, get_product_by_id, contact, add_to_cart, get_cart_items,
+    Logout, get_product_by_id, contact, add_to_cart, get_cart_items, cart_batch,
     remove_from_cart, create_order, get_cookie, get_order, check_pending_orders,
-    send_order_confirmation_email, related_products
+    send_order_confirmation_email, related_products, search_product,
+    get_user_orders, track_order, sales_report, export_orders_view, export_products_view
 )
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
@@ -44,6 +45,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),  # Admin panel
     # Product endpoints
     path('api/v1.0/products/', getProducts, name='get_products'),
+    path('api/v1.0/products/search/', search_product, name='search_products'),
     path('api/v1.0/product/<int:id>/', get_product_by_id, name="get_individual_product"),
     path('api/v1.0/related_product/<int:id>/', related_products, name="get_related_products"),
     
@@ -61,13 +63,19 @@ urlpatterns = [
     # Cart endpoints
     path('api/v1.0/cart/add/', add_to_cart, name='add_to_cart'),
     path('api/v1.0/cart/', get_cart_items, name='get_items_incart'),
+    path('api/v1.0/cart/batch/', cart_batch, name='cart_batch'),
     path('api/v1.0/cart/remove/<int:id>/', remove_from_cart, name='remove_items_from_cart'),
     
     # Order endpoints
     path('api/v1.0/order/', create_order, name='create_order'),
     path('api/v1.0/user/order/', get_order, name='get__individual_order'),
+    path('api/v1.0/user/orders/', get_user_orders, name='user_orders'),
+    path('api/v1.0/order/track/<str:tracking_id>/', track_order, name='track_order'),
     path('api/v1.0/check-pending-orders/', check_pending_orders, name='check_pending_orders'),
     path('api/v1.0/send/email/', send_order_confirmation_email, name='send_email'),
+    path('api/v1.0/reports/sales/', sales_report, name='sales_report'),
+    path('api/v1.0/export/orders/', export_orders_view, name='export_orders'),
+    path('api/v1.0/export/products/', export_products_view, name='export_products'),
 ]
 
 # Swagger and ReDoc documentation endpoints